@@ -0,0 +1,362 @@
+##############################################################################
+#
+# Copyright (c) 2014 Shoobx, Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""asyncio Support
+
+`AsyncPJDataManager` runs all statements on a psycopg2 asynchronous
+connection and waits for them without blocking the event loop. Objects are
+serialized and deserialized by the regular `ObjectReader` and
+`ObjectWriter`, the methods doing I/O have awaitable variants prefixed with
+`a`.
+"""
+import asyncio
+import time
+import uuid
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+from pjpersist import datamanager, serialize
+
+ISOLATION_LEVELS = {
+    psycopg2.extensions.ISOLATION_LEVEL_READ_UNCOMMITTED: 'READ UNCOMMITTED',
+    psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED: 'READ COMMITTED',
+    psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ: 'REPEATABLE READ',
+    psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE: 'SERIALIZABLE',
+}
+
+
+class NotLoadedError(Exception):
+    """The document of an object was not loaded.
+
+    An `AsyncPJDataManager` cannot read documents while activating a ghost,
+    load them with `aload()`, `aload_many()` or `aprefetch()` first.
+    """
+
+
+async def wait(conn):
+    """Wait until the current operation of an asynchronous connection is
+    done, without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        if state == psycopg2.extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError('Bad poll state: %s' % state)
+        ready = loop.create_future()
+        add(conn.fileno(), ready.set_result, None)
+        try:
+            await ready
+        finally:
+            remove(conn.fileno())
+
+
+async def connect(*args, **kwargs):
+    """Open an asynchronous connection, arguments are passed to
+    `psycopg2.connect()`."""
+    conn = psycopg2.connect(*args, async_=True, **kwargs)
+    await wait(conn)
+    return conn
+
+
+class _RecordingCursor(object):
+    # Collects the statements the synchronous write code executes, so they
+    # can be executed asynchronously afterwards.
+
+    def __init__(self, statements):
+        self.statements = statements
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, args=None, **kwargs):
+        self.statements.append((sql, args))
+
+
+class AsyncPJDataManager(datamanager.PJDataManager):
+    """A data manager for asyncio applications.
+
+    It uses an asynchronous connection, see `connect()`, and manages its own
+    transaction: `acommit()` and `aabort()` end it, it does not join the
+    `transaction` package's transactions.
+
+    Objects are loaded with `aload()`, references are ghosts which must be
+    loaded with `aprefetch()` before they are used. The classes of referenced
+    objects are only known without reading their documents when they are
+    stored in a table of their own, declared with `serialize.table`.
+
+    Objects with `IColumnSerialization` and references to other databases are
+    not supported. Tables are not created automatically, use `acreate_tables()`.
+    """
+
+    def __init__(self, conn):
+        self._async_conn = conn
+        self._pool = None
+        self._reader = serialize.ObjectReader(self)
+        self._writer = serialize.ObjectWriter(self)
+        self._query_report = datamanager.QueryReport()
+        self.skipped_writes = 0
+        self._write_behind = None
+        self._recording = None
+        self._reset_data_manager()
+
+    def _reset_data_manager(self):
+        super(AsyncPJDataManager, self)._reset_data_manager()
+        self._conn = self._async_conn
+        self.database = datamanager.get_database_name_from_dsn(
+            self._async_conn.dsn)
+        # We manage the transaction ourselves.
+        self._needs_to_join = False
+        self._txn_open = False
+
+    def _join_txn(self):
+        pass
+
+    def getCursor(self, flush=True, itersize=None):
+        if self._recording is None:
+            raise NotImplementedError(
+                'AsyncPJDataManager cannot execute blocking statements, '
+                'use aexecute().')
+        return _RecordingCursor(self._recording)
+
+    def _get_doc(self, database, table, id):
+        raise NotLoadedError(serialize.DBRef(table, id, database))
+
+    def _get_docs(self, database, table, ids):
+        raise NotLoadedError(table, ids)
+
+    def _get_doc_py_type(self, database, table, id):
+        raise NotLoadedError(serialize.DBRef(table, id, database))
+
+    def _prefetch_docs(self, dbrefs):
+        # Documents are only read by `aprefetch()`.
+        pass
+
+    def cacheGC(self, size=None):
+        # Ghosts cannot read their documents again while they are activated,
+        # keep all loaded objects.
+        pass
+
+    def _release(self, obj):
+        # See `cacheGC()`.
+        return False
+
+    def _flush_write_batch(self):
+        # Keep collecting, `aflush()` writes the whole batch at the end.
+        pass
+
+    def flush(self, flush_hint=None):
+        raise NotImplementedError('Use aflush().')
+
+    async def _run_recorded(self, func, *args):
+        # Call `func` and execute the statements it would have executed.
+        self._recording = statements = []
+        try:
+            result = func(*args)
+        finally:
+            self._recording = None
+        for sql, sql_args in statements:
+            await self.aexecute(sql, sql_args, flush=False)
+        return result
+
+    async def _abegin(self):
+        if self._txn_open:
+            return
+        sql = 'BEGIN'
+        if self._isolation_level is not None:
+            sql += ' ISOLATION LEVEL %s' % ISOLATION_LEVELS.get(
+                self._isolation_level, self._isolation_level)
+        if self._readonly:
+            sql += ' READ ONLY'
+        if self._deferrable:
+            sql += ' DEFERRABLE'
+        self._txn_open = True
+        await self._aexecute(sql)
+
+    async def _aexecute(self, sql, args=None, cursor=None):
+        cur = cursor or self._conn.cursor(
+            cursor_factory=psycopg2.extras.DictCursor)
+        started = time.time()
+        try:
+            cur.execute(sql, args)
+            await wait(self._conn)
+        except psycopg2.Error as e:
+            datamanager.check_for_conflict(e, sql)
+            datamanager.check_for_disconnect(e, sql)
+            raise
+        finally:
+            self._record_query(sql, args, time.time() - started)
+        return cur
+
+    def _record_query(self, sql, args, duration):
+        if datamanager.PJ_ACCESS_LOGGING:
+            datamanager.TABLE_LOG.debug(
+                "%s,\n args:%r,\n time:%sms", sql, args, duration*1000)
+        if datamanager.PJ_ENABLE_QUERY_STATS:
+            self._query_report.record(sql, args, duration, self.database)
+        for rep in datamanager.GLOBAL_QUERY_STATS_LISTENERS:
+            rep.record(sql, args, duration, self.database)
+
+    async def aexecute(self, sql, args=None, flush=True):
+        """Execute a statement in the transaction and return the cursor.
+
+        All changed objects are written before reading, unless `flush` is
+        false.
+        """
+        if not isinstance(sql, str):
+            sql = sql.__sqlrepr__('postgres')
+        firstWord = sql.strip().split()[0].lower()
+        sqlCommandType = datamanager.SQL_FIRST_WORDS.get(firstWord, 'write')
+        if sqlCommandType in ('write', 'ddl'):
+            self.setDirty()
+        if flush and sqlCommandType == 'read':
+            await self.aflush()
+        await self._abegin()
+        return await self._aexecute(sql, args)
+
+    async def aiterate(self, sql, args=None, itersize=None):
+        """Iterate over the rows of a query.
+
+        With `itersize` the rows are fetched in chunks of that size from a
+        server side cursor.
+        """
+        if itersize is None:
+            cur = await self.aexecute(sql, args)
+            for row in cur.fetchall():
+                yield row
+            return
+        if not isinstance(sql, str):
+            sql = sql.__sqlrepr__('postgres')
+        name = 'pj_cursor_%s' % uuid.uuid4().hex
+        await self.aexecute(
+            'DECLARE "%s" CURSOR WITHOUT HOLD FOR %s' % (name, sql), args)
+        try:
+            while True:
+                cur = await self._aexecute(
+                    'FETCH %i FROM "%s"' % (itersize, name))
+                rows = cur.fetchall()
+                for row in rows:
+                    yield row
+                if len(rows) < itersize:
+                    break
+        finally:
+            if not self._conn.closed and self._txn_open:
+                await self._aexecute('CLOSE "%s"' % name)
+
+    async def acreate_tables(self, tables):
+        """Create the document tables, if they do not exist yet."""
+        if isinstance(tables, str):
+            tables = [tables]
+        for table in tables:
+            await self.aexecute('''
+                CREATE TABLE IF NOT EXISTS %s (
+                    id VARCHAR(24) NOT NULL PRIMARY KEY,
+                    data JSONB)''' % table)
+            await self.aexecute('''
+                CREATE INDEX IF NOT EXISTS %s_data_gin
+                ON %s USING GIN (data)''' % (table, table))
+
+    async def _aprefetch_docs(self, dbrefs):
+        tables = {}
+        for dbref in dbrefs:
+            if dbref in self._latest_states:
+                continue
+            obj = self._get_cached_object(dbref)
+            if obj is not None and obj._p_changed is not None:
+                continue
+            if dbref.database != self.database:
+                raise NotImplementedError(
+                    'Cannot load objects of a different database.', dbref)
+            tables.setdefault(dbref.table, set()).add(dbref.id)
+        for table, ids in tables.items():
+            cur = await self.aexecute(
+                "SELECT id, data FROM %s WHERE id = ANY(%%s)" % table,
+                (list(ids),))
+            for row in cur.fetchall():
+                self._latest_states[
+                    serialize.DBRef(table, row['id'], self.database)] = \
+                    row['data']
+
+    async def aload(self, dbref, klass=None):
+        """Load an object."""
+        await self._aprefetch_docs([dbref])
+        return self.load(dbref, klass)
+
+    async def aload_many(self, dbrefs):
+        """Load many objects with one query per table."""
+        dbrefs = list(dbrefs)
+        await self._aprefetch_docs(dbrefs)
+        return [self.load(dbref) for dbref in dbrefs]
+
+    async def aprefetch(self, objs):
+        """Activate all ghosts of the given objects."""
+        ghosts = [obj for obj in objs
+                  if obj._p_oid is not None and obj._p_changed is None]
+        await self._aprefetch_docs([obj._p_oid for obj in ghosts])
+        for obj in ghosts:
+            obj._p_activate()
+
+    async def ainsert(self, obj, oid=None):
+        """Insert an object."""
+        return await self._run_recorded(self.insert, obj, oid)
+
+    async def aremove(self, obj):
+        """Remove an object."""
+        await self.aprefetch([obj])
+        await self._run_recorded(self.remove, obj)
+
+    async def aflush(self):
+        """Write all changed objects."""
+        if not self._registered_objects:
+            return
+        self._write_batch = datamanager.WriteBatch()
+        try:
+            self._flush_objects(None)
+            batch = self._write_batch
+        finally:
+            self._write_batch = None
+        await self._run_recorded(self._write_docs, batch)
+
+    async def acommit(self):
+        """Write all changes and commit the transaction."""
+        await self.aflush()
+        try:
+            if self._txn_open:
+                await self._aexecute('COMMIT')
+        finally:
+            self._reset_data_manager()
+
+    async def aabort(self):
+        """Abort the transaction."""
+        try:
+            if self._txn_open and not self._conn.closed:
+                await self._aexecute('ROLLBACK')
+        finally:
+            self._reset_data_manager()
+
+    async def aclose(self):
+        """Abort the transaction and close the connection."""
+        await self.aabort()
+        self._conn.close()
+
+    def __del__(self):
+        pass
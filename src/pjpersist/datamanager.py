@@ -14,6 +14,7 @@
 ##############################################################################
 """PostGreSQL/JSONB Persistent Data Manager"""
 import binascii
+import concurrent.futures
 import hashlib
 import logging
 import os
@@ -25,11 +26,14 @@ import threading
 import time
 import traceback
 import uuid
+import weakref
 from collections.abc import MutableMapping
 from typing import Optional
 
+import persistent
 import psycopg2
 import psycopg2.errorcodes
+import psycopg2.errors
 import psycopg2.extensions
 import psycopg2.extras
 import transaction
@@ -37,7 +41,7 @@ import transaction
 import pjpersist.sqlbuilder as sb
 import zope.interface
 from pjpersist import interfaces, serialize
-from pjpersist.querystats import QueryReport
+from pjpersist.querystats import NPlusOneDetector, QueryReport
 
 # Flag enabling full two-phase-commit support. Note, that this requires
 # postgres database to set max_prepared_transactions setting to positive value.
@@ -58,9 +62,134 @@ GLOBAL_QUERY_STATS_LISTENERS = set()
 # Maximum query length to output with query log
 MAX_QUERY_ARGUMENT_LENGTH = 500
 
+# Maximum number of documents written with a single INSERT or UPDATE
+# statement when flushing. Set to 1 to write every document with its own
+# statement.
+FLUSH_BATCH_SIZE = 100
+
+# Set to a `pjpersist.doccache.DocumentCache` to share loaded documents
+# between transactions. Every load still asks the database, but the document
+# is only transferred and decoded again when its row changed.
+SHARED_DOCUMENT_CACHE = None
+
+# Set to True to execute the data manager's own point queries (load, insert,
+# update and remove of a single document) as server side prepared
+# statements. The statements are prepared once per connection. Note that
+# connections are then not reset with DISCARD ALL when released, so session
+# state set by other code survives, and poolers that discard the session
+# state (e.g. pgbouncer in transaction mode) are not supported.
+PJ_PREPARED_STATEMENTS = False
+
+# connection -> set of names of the statements prepared on it.
+PREPARED_STATEMENTS = weakref.WeakKeyDictionary()
+
+# SQL expression of the version of a row. It changes with every write.
+ROW_VERSION = "(xmin::text || ':' || ctid::text)"
 
 PJ_AUTO_CREATE_TABLES = True
 
+# database name -> set of the tables known to exist in it. Statements that
+# only use known tables are executed without a savepoint, even when
+# PJ_AUTO_CREATE_TABLES is on. The set of a database is read from the catalog
+# on first use, see `forget_known_tables()`.
+KNOWN_TABLES = {}
+
+# Write the documents collected by a flush in a background thread, while the
+# application continues. Every statement, commit and abort first waits for
+# these writes to finish.
+PJ_WRITE_BEHIND = False
+
+# Flush only the objects of the tables a query reads, when the caller did
+# not pass a `flush_hint` and all the tables are known, see
+# `PJDataManager._get_flush_hint`.
+PJ_AUTO_FLUSH_HINT = True
+
+# Set to a `pjpersist.querystats.TransactionBudget` to limit the statements,
+# time, rows and documents of every transaction.
+PJ_TRANSACTION_BUDGET = None
+
+# Statements running longer than this many seconds are explained, their
+# plan is passed to the query stats, see `PJPersistCursor._explain()`.
+PJ_EXPLAIN_THRESHOLD = None
+
+# Statements that can be explained.
+EXPLAINABLE_FIRST_WORDS = ('select', 'with', 'insert', 'update', 'delete')
+
+# Log the statements every transaction executes in a loop, see
+# `pjpersist.querystats.NPlusOneDetector`.
+PJ_DETECT_N_PLUS_ONE = False
+
+# The number of loaded objects a data manager keeps for the transaction.
+# When more objects are loaded, the least recently loaded unmodified objects
+# are turned into ghosts and their documents are dropped, see
+# `PJDataManager.cacheGC()`. None keeps all loaded objects.
+PJ_OBJECT_CACHE_SIZE = None
+
+# Read-only transactions of data managers with a `replica_pool` are executed
+# on the replica. Set to True to route only transactions that are read-only
+# and deferrable.
+PJ_REPLICA_REQUIRE_DEFERRABLE = False
+
+# Maximum replication lag of the replica in seconds. When the replica lags
+# behind more, the transaction is executed on the primary. Checking the lag
+# costs one query per transaction, None turns the check off.
+PJ_REPLICA_MAX_LAG = None
+
+# Seconds after a thread committed a write, during which its read-only
+# transactions are still executed on the primary, so they see their own
+# writes. None turns pinning off.
+PJ_REPLICA_PIN_AFTER_WRITE = None
+
+# The time the current thread last committed a write, see
+# PJ_REPLICA_PIN_AFTER_WRITE.
+REPLICA_PINS = threading.local()
+
+# Replication lag of a server in seconds, 0 for the primary and for replicas
+# that replayed everything they received.
+REPLICA_LAG_SQL = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END'''
+
+_TABLE_NAME = r'(?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))?'
+# A table name with an optional alias.
+_TABLE_REF = (
+    r'%s(?:\s+(?:AS\s+)?(?!(?:WHERE|JOIN|INNER|LEFT|RIGHT|FULL|CROSS|'
+    r'NATURAL|ON|USING|GROUP|ORDER|LIMIT|OFFSET|HAVING|WINDOW|UNION|'
+    r'INTERSECT|EXCEPT|FOR|SET|VALUES|RETURNING|DEFAULT|SELECT|FETCH|'
+    r'TABLESAMPLE)\b)\w+)?' % _TABLE_NAME)
+# Matches the tables following the keywords that introduce them.
+SQL_TABLES_RE = re.compile(
+    r'\b(?:FROM|JOIN|INTO|UPDATE|TABLE(?:\s+IF(?:\s+NOT)?\s+EXISTS)?)\s+'
+    r'(%s(?:\s*,\s*%s)*)' % (_TABLE_REF, _TABLE_REF), re.IGNORECASE)
+_TABLE_NAME_RE = re.compile(_TABLE_NAME)
+# Matches the names followed by an opening parenthesis, an optional `AS`
+# marks a column alias list instead of a call.
+SQL_CALLS_RE = re.compile(
+    r'(\bAS\s+)?(?<![\w."])(%s)\s*\(' % _TABLE_NAME, re.IGNORECASE)
+# Keywords followed by a parenthesis and functions that cannot read tables.
+# Queries calling other functions flush all objects, see `_get_flush_hint`.
+SQL_SAFE_CALLS = frozenset([
+    'all', 'and', 'any', 'array', 'as', 'between', 'by', 'else', 'except',
+    'exists', 'filter', 'from', 'in', 'intersect', 'join', 'lateral',
+    'limit', 'not', 'offset', 'on', 'or', 'over', 'select', 'some', 'then',
+    'union', 'using', 'values', 'when', 'where', 'with',
+    'char', 'character', 'decimal', 'numeric', 'timestamp', 'timestamptz',
+    'varchar',
+    'abs', 'array_agg', 'array_length', 'avg', 'bool_and', 'bool_or',
+    'cast', 'coalesce', 'concat', 'count', 'date_trunc', 'extract',
+    'greatest', 'json_agg', 'jsonb_agg', 'jsonb_array_elements',
+    'jsonb_array_elements_text', 'jsonb_array_length', 'jsonb_build_array',
+    'jsonb_build_object', 'jsonb_each', 'jsonb_extract_path',
+    'jsonb_extract_path_text', 'jsonb_object_keys', 'jsonb_set',
+    'jsonb_typeof', 'least', 'length', 'lower', 'max', 'min', 'now',
+    'nullif', 'octet_length', 'rank', 'round', 'row', 'row_number',
+    'string_agg', 'substring', 'sum', 'to_json', 'to_jsonb', 'trim',
+    'unnest', 'upper',
+])
+
 # set to True to automatically create IColumnSerialization columns
 # will also create tables regardless of the PJ_AUTO_CREATE_TABLES setting
 # so this is super expensive
@@ -164,12 +293,79 @@ class Json(psycopg2.extras.Json):
             return '<%s>' % (self.__class__.__name__, )
 
 
+class WriteBatch(object):
+    """Documents collected by a flush to be written together.
+
+    Both `inserts` and `updates` map `(database, table)` to a dict keyed by
+    id. Inserts hold the documents, updates hold `(doc, removed)` pairs, see
+    `PJDataManager._update_doc`.
+    """
+
+    def __init__(self):
+        self.inserts = {}
+        self.updates = {}
+
+    def __len__(self):
+        return (sum(len(docs) for docs in self.inserts.values()) +
+                sum(len(docs) for docs in self.updates.values()))
+
+    def add_update(self, database, table, id, doc, removed=None):
+        updates = self.updates.setdefault((database, table), {})
+        if removed is not None and id in updates:
+            # Apply the partial update on top of the queued one.
+            queued_doc, queued_removed = updates[id]
+            merged = dict(queued_doc)
+            for key in removed:
+                merged.pop(key, None)
+            merged.update(doc)
+            if queued_removed is not None:
+                removed = sorted(
+                    set(queued_removed).difference(doc).union(removed))
+            else:
+                removed = None
+            doc = merged
+        updates[id] = (doc, removed)
+
+    def __bool__(self):
+        return bool(self.inserts or self.updates)
+
+
 class PJPersistCursor(psycopg2.extras.DictCursor):
     def __init__(self, datamanager, flush, *args, **kwargs):
         super(PJPersistCursor, self).__init__(*args, **kwargs)
         self.datamanager = datamanager
         self.flush = flush
 
+    def _record_rows(self, count):
+        # The rows of named (server side) cursors are counted for the
+        # transaction budget as they are fetched.
+        if self.name is None or not count:
+            return
+        usage = self.datamanager._budget_usage
+        if usage is not None:
+            usage.record_rows(count)
+
+    def fetchone(self):
+        row = super(PJPersistCursor, self).fetchone()
+        if row is not None:
+            self._record_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super(PJPersistCursor, self).fetchmany(size)
+        self._record_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super(PJPersistCursor, self).fetchall()
+        self._record_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in super(PJPersistCursor, self).__iter__():
+            self._record_rows(1)
+            yield row
+
     def log_query(self, sql, args, duration):
 
         txn = transaction.get()
@@ -179,13 +375,42 @@ class PJPersistCursor(psycopg2.extras.DictCursor):
             "%s,\n args:%r,\n TXN:%s,\n time:%sms",
             sql, args, txn, duration*1000)
 
-    def _autoCreateTables(self, sql, args, beacon):
+    def _plain_execute(self, sql, args=None):
+        # Named (server side) cursors can execute just one query, so other
+        # statements go through a regular cursor.
+        if self.name is None:
+            return super(PJPersistCursor, self).execute(sql, args)
+        with self.connection.cursor() as cur:
+            return cur.execute(sql, args)
+
+    def _execute_prepared(self, sql, args):
+        prepared = PREPARED_STATEMENTS.setdefault(self.connection, set())
+        name, prepared_sql = get_prepared_statement(sql)
+        if name not in prepared:
+            super(PJPersistCursor, self).execute(
+                'PREPARE %s AS %s' % (name, prepared_sql))
+            prepared.add(name)
+        placeholders = ', '.join(['%s'] * len(args))
+        try:
+            return super(PJPersistCursor, self).execute(
+                'EXECUTE %s (%s)' % (name, placeholders), args)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # Someone discarded the session state, prepare again next time.
+            prepared.clear()
+            raise
+
+    def _uses_known_tables(self, sql):
+        tables = get_sql_tables(sql)
+        return bool(tables) and all(
+            self.datamanager._is_known_table(table) for table in tables)
+
+    def _autoCreateTables(self, sql, args, beacon, prepare=False):
         # XXX: need to set a savepoint, just in case the real execute
         #      fails, it would take down all further commands
-        super(PJPersistCursor, self).execute("SAVEPOINT before_execute;")
+        self._plain_execute("SAVEPOINT before_execute;")
 
         try:
-            return self._execute_and_log(sql, args)
+            return self._execute_and_log(sql, args, prepare=prepare)
         except psycopg2.Error as e:
             # XXX: ugly: we're creating here missing tables on the fly
             msg = str(e)
@@ -195,8 +420,7 @@ class PJPersistCursor(psycopg2.extras.DictCursor):
             if m:
                 # need to rollback to the above savepoint, otherwise
                 # PG would just ignore any further command
-                super(PJPersistCursor, self).execute(
-                    "ROLLBACK TO SAVEPOINT before_execute;")
+                self._plain_execute("ROLLBACK TO SAVEPOINT before_execute;")
 
                 # we extract the tableName from the exception message
                 tableName = m.group(1)
@@ -205,21 +429,29 @@ class PJPersistCursor(psycopg2.extras.DictCursor):
                     self.datamanager.database, tableName)
 
                 try:
-                    return self._execute_and_log(sql, args)
+                    if self.name is None:
+                        return self._execute_and_log(
+                            sql, args, prepare=prepare)
+                    # A named cursor cannot execute again, but declaring
+                    # it by hand lets us fetch from it as usual.
+                    return self._execute_and_log(
+                        'DECLARE "%s" CURSOR WITHOUT HOLD FOR %s' % (
+                            self.name, sql),
+                        args, plain=True)
                 except psycopg2.Error:
                     # Join the transaction, because failed queries require
                     # aborting the transaction.
-                    self.datamanager._join_txn()
+                    self._join_and_doom_txn(doom=False)
             # Join the transaction, because failed queries require
             # aborting the transaction.
-            self.datamanager._join_txn()
-            self.datamanager._doom_txn()
+            self._join_and_doom_txn()
             check_for_conflict(e, sql, beacon=beacon)
             check_for_disconnect(e, sql, beacon=beacon)
             # otherwise let it fly away
             raise
 
-    def execute(self, sql, args=None, beacon=None, flush_hint=None):
+    def execute(self, sql, args=None, beacon=None, flush_hint=None,
+                prepare=False):
         """execute a SQL statement
         sql - SQL string or SQLBuilder expression
         args - optional list of args for the SQL string
@@ -227,7 +459,11 @@ class PJPersistCursor(psycopg2.extras.DictCursor):
                  debugging errors. Going to be added to all possible
                  exceptions and log entries
         flush_hint - list of tables to flush before querying database
-                     or None to flush all
+                     or None to flush all, respectively the tables used
+                     by the query with PJ_AUTO_FLUSH_HINT
+        prepare - execute the statement as a prepared statement, when
+                  PJ_PREPARED_STATEMENTS is enabled. Only for SQL strings
+                  with `%s` placeholders and a fixed shape.
         """
         # Convert SQLBuilder object to string
         if not isinstance(sql, str):
@@ -240,30 +476,76 @@ class PJPersistCursor(psycopg2.extras.DictCursor):
         sqlCommandType = SQL_FIRST_WORDS.get(firstWord, 'write')
         if sqlCommandType in ('write', 'ddl'):
             self.datamanager.setDirty()
+        if firstWord in ('alter', 'drop'):
+            self.datamanager._forget_tables(get_sql_tables(sql))
 
-        if self.flush and sqlCommandType == 'read' and flush_hint != []:
-            # Flush the data manager before any select.
-            # We do this to have the written data available for queries
-            self.datamanager.flush(flush_hint=flush_hint)
+        if self.flush and sqlCommandType == 'read':
+            if flush_hint is None and PJ_AUTO_FLUSH_HINT:
+                flush_hint = self.datamanager._get_flush_hint(sql)
+            if flush_hint != []:
+                # Flush the data manager before any select.
+                # We do this to have the written data available for queries
+                self.datamanager.flush(flush_hint=flush_hint)
+
+        # Statements must not overtake the documents written in the
+        # background.
+        self.datamanager._wait_for_writes()
 
         # XXX: Optimization opportunity to store returned JSONB docs in the
         # cache of the data manager. (SR)
 
-        if PJ_AUTO_CREATE_TABLES:
-            self._autoCreateTables(sql, args, beacon)
+        prepare = (prepare and PJ_PREPARED_STATEMENTS and self.name is None
+                   and bool(args))
+
+        if PJ_AUTO_CREATE_TABLES and not self._uses_known_tables(sql):
+            self._autoCreateTables(sql, args, beacon, prepare=prepare)
         else:
             try:
                 # otherwise just execute the given sql
-                return self._execute_and_log(sql, args)
+                return self._execute_and_log(sql, args, prepare=prepare)
             except psycopg2.Error as e:
+                m = re.search('relation "(.*?)" does not exist', str(e))
+                if m:
+                    # The table was dropped behind our back.
+                    self.datamanager._forget_tables([m.group(1)])
                 # Join the transaction, because failed queries require
                 # aborting the transaction.
-                self.datamanager._join_txn()
-                self.datamanager._doom_txn()
+                self._join_and_doom_txn()
                 check_for_conflict(e, sql, beacon=beacon)
                 check_for_disconnect(e, sql, beacon=beacon)
                 raise
 
+    def _join_and_doom_txn(self, doom=True):
+        # The transactions are per thread, the writer thread of
+        # PJ_WRITE_BEHIND leaves them to the thread waiting for its writes.
+        if self.datamanager._in_writer():
+            return
+        self.datamanager._join_txn()
+        if doom:
+            self.datamanager._doom_txn()
+
+    def _explain(self, sql, args):
+        # Return the plan of a statement as `EXPLAIN (FORMAT JSON)` returns
+        # it, or None. The statement is not executed again. A separate cursor
+        # keeps our results and a savepoint keeps the transaction usable, if
+        # the statement cannot be explained.
+        if sql.lstrip().split(None, 1)[0].lower() not in \
+                EXPLAINABLE_FIRST_WORDS:
+            return None
+        self.datamanager._wait_for_writes()
+        with self.connection.cursor(
+                cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.execute("SAVEPOINT pj_explain")
+            try:
+                cur.execute("EXPLAIN (FORMAT JSON) " + sql, args)
+                plan = cur.fetchone()[0][0]
+            except psycopg2.Error:
+                TABLE_LOG.debug("Explaining %s failed", sql, exc_info=True)
+                cur.execute("ROLLBACK TO SAVEPOINT pj_explain")
+                return None
+            cur.execute("RELEASE SAVEPOINT pj_explain")
+        return plan
+
     def _sanitize_arg(self, arg):
         r = repr(arg)
         if len(r) > MAX_QUERY_ARGUMENT_LENGTH:
@@ -271,14 +553,26 @@ class PJPersistCursor(psycopg2.extras.DictCursor):
             return r
         return arg
 
-    def _execute_and_log(self, sql, args):
+    def _execute_and_log(self, sql, args, plain=False, prepare=False):
         # Very useful logging of every SQL command with traceback to code.
         __traceback_info__ = (self.datamanager.database, sql, args)
         started = time.time()
+        duration = None
+        plan = None
         try:
-            res = super(PJPersistCursor, self).execute(sql, args)
-        finally:
+            if plain:
+                res = self._plain_execute(sql, args)
+            elif prepare:
+                res = self._execute_prepared(sql, args)
+            else:
+                res = super(PJPersistCursor, self).execute(sql, args)
             duration = time.time() - started
+            if (PJ_EXPLAIN_THRESHOLD is not None and not plain and
+                    duration > PJ_EXPLAIN_THRESHOLD):
+                plan = self._explain(sql, args)
+        finally:
+            if duration is None:
+                duration = time.time() - started
             db = self.datamanager.database
 
             debug = (PJ_ACCESS_LOGGING or PJ_ENABLE_QUERY_STATS)
@@ -290,18 +584,115 @@ class PJPersistCursor(psycopg2.extras.DictCursor):
                 # We don't want to do expensive sanitization in prod mode
                 saneargs = args
 
-            if PJ_ACCESS_LOGGING:
+            # The writer thread of PJ_WRITE_BEHIND has no transaction.
+            if PJ_ACCESS_LOGGING and not self.datamanager._in_writer():
                 self.log_query(sql, saneargs, duration)
 
             if PJ_ENABLE_QUERY_STATS:
                 self.datamanager._query_report.record(
-                    sql, saneargs, duration, db)
+                    sql, saneargs, duration, db, plan=plan)
 
             for rep in GLOBAL_QUERY_STATS_LISTENERS:
-                rep.record(sql, saneargs, duration, db)
+                if plan is not None and getattr(rep, 'accepts_plan', False):
+                    rep.record(sql, saneargs, duration, db, plan=plan)
+                else:
+                    rep.record(sql, saneargs, duration, db)
+        detector = self.datamanager._n_plus_one
+        if detector is not None:
+            detector.record(sql)
+        usage = self.datamanager._budget_usage
+        if usage is not None:
+            # Only count the rows of statements returning rows. Named
+            # cursors count their rows as they are fetched.
+            rows = 0
+            if self.name is None and self.description is not None:
+                rows = max(self.rowcount, 0)
+            usage.record_statement(duration, rows)
         return res
 
 
+_PREPARED_STATEMENT_CACHE = {}
+
+
+def forget_prepared_statements(conn):
+    """Forget the statements prepared on a connection.
+
+    Call this after resetting the session of a connection outside of
+    pjpersist, e.g. with `conn.reset()` or `DISCARD ALL`.
+    """
+    PREPARED_STATEMENTS.pop(conn, None)
+
+
+def get_prepared_statement(sql):
+    """Return the statement name and the SQL for PREPARE of a query using
+    `%s` placeholders."""
+    try:
+        return _PREPARED_STATEMENT_CACHE[sql]
+    except KeyError:
+        pass
+    counter = iter(range(1, len(sql)))
+    prepared_sql = re.sub(
+        '%[%s]',
+        lambda m: '%' if m.group(0) == '%%' else '$%i' % next(counter),
+        sql)
+    name = 'pj_' + hashlib.md5(sql.encode('utf-8')).hexdigest()
+    _PREPARED_STATEMENT_CACHE[sql] = name, prepared_sql
+    return name, prepared_sql
+
+
+def forget_known_tables(database=None):
+    """Forget the tables known to exist in a database or in all databases.
+
+    Call this after dropping or renaming tables outside of pjpersist.
+    """
+    if database is None:
+        KNOWN_TABLES.clear()
+    else:
+        KNOWN_TABLES.pop(database, None)
+
+
+def normalize_table_name(name):
+    """Return the name of a table as it is stored in the catalog."""
+    if not name.endswith('"'):
+        # Unquoted names are folded to lower case.
+        return name.rsplit('.', 1)[-1].lower()
+    return name[name.rindex('"', 0, -1) + 1:-1]
+
+
+def get_sql_tables(sql):
+    """Return the names of the tables used by an SQL statement.
+
+    This is a cheap approximation: it finds the tables of the statements
+    pjpersist and sqlbuilder generate, but can also return names that are
+    not tables, e.g. of set returning functions.
+    """
+    tables = set()
+    for match in SQL_TABLES_RE.finditer(sql):
+        for ref in match.group(1).split(','):
+            name = _TABLE_NAME_RE.match(ref.strip()).group(0)
+            tables.add(normalize_table_name(name))
+    return tables
+
+
+def get_sql_calls(sql):
+    """Return the names of the functions called by an SQL statement.
+
+    Like `get_sql_tables()` this is an approximation, keywords followed by
+    a parenthesis are returned as well.
+    """
+    calls = set()
+    for match in SQL_CALLS_RE.finditer(sql):
+        if match.group(1) is not None:
+            continue
+        name = match.group(2)
+        if '"' not in name:
+            name = name.lower()
+            if name.startswith('pg_catalog.'):
+                name = name[len('pg_catalog.'):]
+        calls.add(name)
+    return calls
+
+
 def check_for_conflict(e, sql, beacon=None):
     """Check whether exception indicates serialization failure and raise
     ConflictError in this case.
@@ -359,15 +750,21 @@ class Root(MutableMapping):
         self._jar = jar
         if table is not None:
             self.table = table
-        if PJ_AUTO_CREATE_TABLES:
-            self._init_table()
 
     def _init_table(self):
+        # The table is checked when the root is used, so that creating a
+        # data manager does not join the transaction.
+        if not PJ_AUTO_CREATE_TABLES:
+            return
         with self._jar.getCursor(False) as cur:
+            if self._jar._is_known_table(self.table):
+                return
             cur.execute(
                 "SELECT * FROM information_schema.tables where table_name=%s",
-                (self.table,))
+                (normalize_table_name(self.table),))
             if cur.rowcount:
+                self._jar._created_tables.add(
+                    normalize_table_name(self.table))
                 return
 
             LOG.info("Creating table %s" % self.table)
@@ -377,9 +774,10 @@ class Root(MutableMapping):
                     name TEXT,
                     dbref TEXT[])
                 ''' % self.table)
-            self._jar._conn.commit()
+            self._jar._created_tables.add(normalize_table_name(self.table))
 
     def __getitem__(self, key):
+        self._init_table()
         with self._jar.getCursor(False) as cur:
             tbl = sb.Table(self.table)
             cur.execute(
@@ -391,6 +789,7 @@ class Root(MutableMapping):
             return self._jar.load(dbref)
 
     def __setitem__(self, key, value):
+        self._init_table()
         dbref = self._jar.insert(value)
         if self.get(key) is not None:
             del self[key]
@@ -407,6 +806,7 @@ class Root(MutableMapping):
             cur.execute(sb.Delete(self.table, tbl.name == key))
 
     def keys(self):
+        self._init_table()
         with self._jar.getCursor(False) as cur:
             cur.execute(sb.Select(sb.Field(self.table, 'name')))
             return [doc['name'] for doc in cur.fetchall()]
@@ -418,6 +818,38 @@ class Root(MutableMapping):
         return len(self.keys())
 
 
+def _collect_sub_objects(value, subs, seen):
+    # Collect the persistent sub-objects within the state.
+    if isinstance(value, interfaces.PJ_NATIVE_TYPES) or id(value) in seen:
+        return
+    seen.add(id(value))
+    if isinstance(value, persistent.Persistent):
+        if value._p_oid is not None:
+            # Another document.
+            return
+        subs.append(value)
+        value = value.__dict__
+    if isinstance(value, dict):
+        for item in value.values():
+            _collect_sub_objects(item, subs, seen)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            _collect_sub_objects(item, subs, seen)
+    elif hasattr(value, '__dict__') and not isinstance(value, type):
+        _collect_sub_objects(value.__dict__, subs, seen)
+
+
+class _DetachedState(object):
+    # The state of a document object turned into a ghost by `cacheGC()`. The
+    # persistent sub-objects of the state refer to it, so it lives as long as
+    # one of them, and the ghost gets the state back instead of reading its
+    # document. Changes of sub-objects referenced elsewhere are kept so.
+    __slots__ = ('state', '__weakref__')
+
+    def __init__(self, state):
+        self.state = state
+
+
 @zope.interface.implementer(interfaces.IPJDataManager)
 class PJDataManager(object):
 
@@ -435,23 +867,31 @@ class PJDataManager(object):
     _readonly: Optional[bool]
     _deferrable: Optional[bool]
 
-    def __init__(self, pool, root_table=None):
+    def __init__(self, pool, root_table=None, replica_pool=None):
         self._pool = pool
+        # Pool of a read replica for read-only transactions, see
+        # PJ_REPLICA_REQUIRE_DEFERRABLE.
+        self._replica_pool = replica_pool
+        # Executor writing documents in the background, see PJ_WRITE_BEHIND.
+        self._write_behind = None
         self._reader = serialize.ObjectReader(self)
         self._writer = serialize.ObjectWriter(self)
         self.transaction_manager = transaction.manager
         self._query_report = QueryReport()
+        # Number of documents not written, because they did not change.
+        self.skipped_writes = 0
+        # The name of the database is known once the first connection is
+        # acquired, unless the pool tells it.
+        self._database = getattr(pool, 'database', None)
         self._reset_data_manager()
 
         if self.root is None:
-            # Getting Root can call self._join_txn when the table gets
-            # auto-created, that calls self._begin, that might set
-            # self._tpc_activated, so do this after setting self._tpc_activated
             self.root = Root(self, root_table)
 
     def _reset_data_manager(self):
         self._conn = None
-        self.database = None
+        # The pool the connection is from.
+        self._conn_pool = None
         # All of the following object lists are keys by object id. This is
         # needed when testing containment, since that can utilize `__cmp__()`
         # which can have undesired side effects. `id()` is guaranteed to not
@@ -466,24 +906,78 @@ class PJDataManager(object):
         # To quickly find objects to flush.
         self._registered_by_table = {}
 
+        # dict[int, set[int]] - registered objects by the id of their
+        # document object, and the reverse mapping. To quickly find the
+        # registered sub-objects of a removed document.
+        self._registered_by_doc = {}
+        self._registered_doc_ids = {}
+
+        # WriteBatch - documents to be written by `_flush_write_batch`.
+        # It is only set while flushing.
+        self._write_batch = None
+
+        # Objects that got an id when they were first referenced, but their
+        # document is not yet inserted. Keyed by the object's DBRef.
+        self._pending_inserts = {}
+
         self._readonly = None
         self._deferrable = None
         self._isolation_level = None
 
+        # The work done by the transaction, see PJ_TRANSACTION_BUDGET.
+        self._budget_usage = None
+        # See PJ_DETECT_N_PLUS_ONE.
+        self._n_plus_one = None
+
+        # Futures of the batches written in the background, see
+        # PJ_WRITE_BEHIND.
+        self._pending_writes = []
+
+        # Tables created in the current transaction, they become known tables
+        # once it is committed.
+        self._created_tables = set()
+
         # The latest states written to the database.
         self._latest_states = {}
         self._needs_to_join = True
+        # Loaded objects by the `(database, table, id)` of their reference.
         self._object_cache = {}
+        # Ghosts removed from the object cache by `cacheGC()`, they are kept
+        # as long as they are referenced.
+        self._weak_object_cache = weakref.WeakValueDictionary()
+        # The `_DetachedState` of ghosts by the key of the object cache.
+        self._detached_states = weakref.WeakValueDictionary()
         self.annotations = {}
 
         self._txn_active = False
         self._tpc_activated = False
 
-    def getCursor(self, flush=True):
+    @property
+    def database(self):
+        if self._database is None:
+            # Connecting tells the name of the database.
+            self._join_txn()
+        return self._database
+
+    @database.setter
+    def database(self, database):
+        self._database = database
+
+    def getCursor(self, flush=True, itersize=None):
+        """Return a cursor of the current transaction.
+
+        With `itersize` a named (server side) cursor is returned, which
+        fetches the result in chunks of `itersize` rows while iterating.
+        """
         self._join_txn()
         def factory(*args, **kwargs):
             return PJPersistCursor(self, flush, *args, **kwargs)
-        cur = self._conn.cursor(cursor_factory=factory)
+        if itersize is None:
+            cur = self._conn.cursor(cursor_factory=factory)
+        else:
+            cur = self._conn.cursor(
+                'pj_cursor_%s' % uuid.uuid4().hex, cursor_factory=factory)
+            cur.itersize = itersize
 
         if not self._txn_active:
             # clear any traceback before starting next txn
@@ -503,6 +997,56 @@ class PJDataManager(object):
 
         with self.getCursor(False) as cur:
             cur.connection.commit()
+        self._remember_created_tables()
+
+    def _known_tables(self):
+        tables = KNOWN_TABLES.get(self.database)
+        if tables is None:
+            # Read all the tables of the database at once.
+            self._join_txn()
+            self._wait_for_writes()
+            with self._conn.cursor() as cur:
+                cur.execute(
+                    "SELECT relname FROM pg_catalog.pg_class "
+                    "WHERE relkind IN ('r', 'p', 'f') "
+                    "AND pg_catalog.pg_table_is_visible(oid)")
+                tables = KNOWN_TABLES.setdefault(
+                    self.database, {row[0] for row in cur.fetchall()})
+        return tables
+
+    def _is_known_table(self, table):
+        table = normalize_table_name(table)
+        return table in self._created_tables or table in self._known_tables()
+
+    def _get_flush_hint(self, sql):
+        # Return the tables with registered objects used by a query, or
+        # None, when we cannot tell which tables it reads.
+        if not self._registered_objects:
+            return []
+        tables = get_sql_tables(sql)
+        if not tables or not all(self._is_known_table(t) for t in tables):
+            # Views, functions and common table expressions may read any
+            # table.
+            return None
+        if not get_sql_calls(sql) <= SQL_SAFE_CALLS:
+            # So may the functions called by the query.
+            return None
+        return [table for table in self._registered_by_table
+                if normalize_table_name(table) in tables]
+
+    def _forget_tables(self, tables):
+        known = KNOWN_TABLES.get(self.database, set())
+        for table in tables:
+            table = normalize_table_name(table)
+            known.discard(table)
+            self._created_tables.discard(table)
+
+    def _remember_created_tables(self):
+        # Call this once the tables created by the transaction are committed.
+        known = KNOWN_TABLES.get(self.database)
+        if known is not None:
+            known.update(self._created_tables)
+        self._created_tables = set()
 
     def _create_doc_table(self, database, table, extra_columns=''):
         if self.database != database:
@@ -510,10 +1054,13 @@ class PJDataManager(object):
                 'Cannot store an object of a different database.',
                 self.database, database)
 
+        if self._is_known_table(table):
+            return
         with self.getCursor(False) as cur:
             cur.execute(
                 "SELECT * FROM information_schema.tables WHERE table_name=%s",
-                (table,))
+                (normalize_table_name(table),))
+            self._created_tables.add(normalize_table_name(table))
             if not cur.rowcount:
                 LOG.info("Creating data table %s" % table)
                 if extra_columns:
@@ -546,10 +1093,18 @@ class PJDataManager(object):
 
                 self._create_doc_table(self.database, table, columns)
 
-    def _insert_doc(self, database, table, doc, id=None, column_data=None):
+    def _insert_doc(self, database, table, doc, id=None, column_data=None,
+                    batched=True):
         # Create id if it is None.
         if id is None:
             id = self.createId()
+        if (batched and self._write_batch is not None
+                and column_data is None):
+            # We are flushing, so the document is written later together
+            # with all other new documents of the same table.
+            inserts = self._write_batch.inserts
+            inserts.setdefault((database, table), {})[id] = doc
+            return id
         # Insert the document into the table.
         with self.getCursor() as cur:
             builtins = dict(id=id, data=Json(doc))
@@ -569,10 +1124,34 @@ class PJDataManager(object):
                 table, columns, placeholders)
 
             cur.execute(sql, tuple(values),
-                        beacon="%s:%s:%s" % (database, table, id))
+                        beacon="%s:%s:%s" % (database, table, id),
+                        prepare=True)
         return id
 
-    def _update_doc(self, database, table, doc, id, column_data=None):
+    def _update_doc(self, database, table, doc, id, column_data=None,
+                    removed=None, batched=True):
+        # With `removed` being a list of keys, this is a partial update:
+        # `doc` only holds the changed top-level keys, which are merged into
+        # the stored document after the removed keys are dropped from it.
+        if SHARED_DOCUMENT_CACHE is not None:
+            # The cached version is outdated by our own write.
+            SHARED_DOCUMENT_CACHE.invalidate((database, table, id))
+        if (batched and self._write_batch is not None
+                and column_data is None):
+            # We are flushing, so the document is written later together
+            # with all other documents of the same table. A later state of
+            # the same document replaces the earlier one.
+            self._write_batch.add_update(database, table, id, doc, removed)
+            return id
+        if removed is not None:
+            with self.getCursor() as cur:
+                cur.execute(
+                    "UPDATE %s SET data = (data - %%s::text[]) || %%s::jsonb "
+                    "WHERE id = %%s" % table,
+                    (list(removed), Json(doc), id),
+                    beacon="%s:%s:%s" % (database, table, id),
+                    prepare=True)
+            return id
         # Insert the document into the table.
         with self.getCursor() as cur:
             builtins = dict(data=Json(doc))
@@ -590,29 +1169,222 @@ class PJDataManager(object):
             sql = "UPDATE %s SET %s WHERE id = %%s" % (table, columns)
 
             cur.execute(sql, tuple(values) + (id,),
-                        beacon="%s:%s:%s" % (database, table, id))
+                        beacon="%s:%s:%s" % (database, table, id),
+                        prepare=True)
         return id
 
+    def _update_docs(self, database, table, docs):
+        # Write many documents of one table with as few statements as
+        # possible, `docs` maps ids to `(doc, removed)` pairs.
+        if len(docs) == 1:
+            [(id, (doc, removed))] = docs.items()
+            self._update_doc(database, table, doc, id, removed=removed,
+                             batched=False)
+            return
+        items = list(docs.items())
+        with self.getCursor() as cur:
+            for start in range(0, len(items), FLUSH_BATCH_SIZE):
+                chunk = items[start:start + FLUSH_BATCH_SIZE]
+                args = []
+                if all(removed is None for id, (doc, removed) in chunk):
+                    values = ', '.join(['(%s, %s::jsonb)'] * len(chunk))
+                    sql = ("UPDATE %s SET data = v.data "
+                           "FROM (VALUES %s) AS v(id, data) "
+                           "WHERE %s.id = v.id" % (table, values, table))
+                    for id, (doc, removed) in chunk:
+                        args.extend((id, Json(doc)))
+                else:
+                    # Some documents are only partially updated.
+                    values = ', '.join(
+                        ['(%s, %s::jsonb, %s::text[])'] * len(chunk))
+                    sql = ("UPDATE %s SET data = CASE WHEN v.removed IS NULL "
+                           "THEN v.data "
+                           "ELSE (%s.data - v.removed) || v.data END "
+                           "FROM (VALUES %s) AS v(id, data, removed) "
+                           "WHERE %s.id = v.id" % (
+                               table, table, values, table))
+                    for id, (doc, removed) in chunk:
+                        args.extend((
+                            id, Json(doc),
+                            list(removed) if removed is not None else None))
+                cur.execute(sql, tuple(args),
+                            beacon="%s:%s:%s" % (database, table, chunk[0][0]))
+
+    def _insert_docs(self, database, table, docs):
+        # Insert many new documents of one table with as few statements as
+        # possible, `docs` maps ids to documents.
+        if len(docs) == 1:
+            [(id, doc)] = docs.items()
+            self._insert_doc(database, table, doc, id, batched=False)
+            return
+        items = list(docs.items())
+        with self.getCursor() as cur:
+            for start in range(0, len(items), FLUSH_BATCH_SIZE):
+                chunk = items[start:start + FLUSH_BATCH_SIZE]
+                values = ', '.join(['(%s, %s)'] * len(chunk))
+                sql = "INSERT INTO %s (id, data) VALUES %s" % (table, values)
+                args = []
+                for id, doc in chunk:
+                    args.extend((id, Json(doc)))
+                cur.execute(sql, tuple(args),
+                            beacon="%s:%s:%s" % (database, table, chunk[0][0]))
+
+    def _flush_write_batch(self):
+        # Write all documents collected while flushing.
+        if not self._write_batch:
+            return
+        batch = self._write_batch
+        self._write_batch = WriteBatch()
+        if PJ_WRITE_BEHIND:
+            if self._write_behind is None:
+                self._write_behind = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='pjpersist-writer')
+            self._pending_writes.append(
+                self._write_behind.submit(self._write_docs_behind, batch))
+        else:
+            self._write_docs(batch)
+
+    def _write_docs_behind(self, batch):
+        try:
+            self._write_docs(batch)
+        except Exception as e:
+            # Conflict tracebacks are recorded per thread, hand ours over.
+            e.pj_conflict_traceback = getattr(
+                CONFLICT_TRACEBACK_INFO, 'traceback', None)
+            raise
+
+    def _write_docs(self, batch):
+        # An object inserted by this batch might also have been updated
+        # by it, so all inserts go first.
+        for (database, table), docs in batch.inserts.items():
+            self._insert_docs(database, table, docs)
+        for (database, table), docs in batch.updates.items():
+            self._update_docs(database, table, docs)
+
+    def _wait_for_writes(self, abort=False):
+        # Wait for the documents written in the background. Their errors are
+        # raised, unless we are aborting anyway.
+        if not self._pending_writes or self._in_writer():
+            return
+        pending, self._pending_writes = self._pending_writes, []
+        for future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                if abort:
+                    continue
+                tb = getattr(e, 'pj_conflict_traceback', None)
+                if tb is not None:
+                    # Show where we waited for the writer, too.
+                    CONFLICT_TRACEBACK_INFO.traceback = (
+                        traceback.format_stack() + tb)
+                self._doom_txn()
+                raise
+
+    def _in_writer(self):
+        thread = threading.current_thread()
+        return thread.name.startswith('pjpersist-writer')
+
     def _get_doc(self, database, table, id):
-        tbl = sb.Table(table)
+        cache = SHARED_DOCUMENT_CACHE
+        if cache is not None:
+            return self._get_cached_doc(cache, database, table, id)
         with self.getCursor() as cur:
-            cur.execute(sb.Select(sb.Field(table, '*'), tbl.id == id),
+            cur.execute("SELECT data FROM %s WHERE id = %%s" % table, (id,),
                         beacon="%s:%s:%s" % (database, table, id),
-                        flush_hint=[table])
+                        flush_hint=[table], prepare=True)
             res = cur.fetchone()
             return res['data'] if res is not None else None
 
+    def _get_cached_doc(self, cache, database, table, id):
+        # The row version changes with every write of the row, so the
+        # document is only sent when the cached one is outdated. The length
+        # of the JSON text estimates the size of the decoded document, the
+        # stored size depends on the compression of the row.
+        key = (database, table, id)
+        cached = cache.get(key)
+        version = cached[0] if cached is not None else None
+        with self.getCursor() as cur:
+            cur.execute(
+                "SELECT %s AS version, "
+                "CASE WHEN %s = %%s THEN NULL ELSE data END AS data, "
+                "CASE WHEN %s = %%s THEN NULL "
+                "ELSE octet_length(data::text) END AS size "
+                "FROM %s WHERE id = %%s" % (
+                    ROW_VERSION, ROW_VERSION, ROW_VERSION, table),
+                (version, version, id),
+                beacon="%s:%s:%s" % (database, table, id),
+                flush_hint=[table])
+            res = cur.fetchone()
+        if res is None:
+            cache.invalidate(key)
+            return None
+        if cached is not None and res['version'] == version:
+            cache.record(True)
+            return cached[1]
+        cache.record(False)
+        doc = res['data']
+        cache.put(key, res['version'], doc, res['size'])
+        return doc
+
+    def _get_docs(self, database, table, ids):
+        # Read many documents of one table with a single query. Returns a
+        # dict of the found documents keyed by id.
+        ids = list(ids)
+        beacon = "%s:%s:%s" % (database, table, ids[0])
+        cache = SHARED_DOCUMENT_CACHE
+        if cache is None:
+            with self.getCursor() as cur:
+                cur.execute(
+                    "SELECT id, data FROM %s WHERE id = ANY(%%s)" % table,
+                    (ids,), beacon=beacon, flush_hint=[table])
+                return {row['id']: row['data'] for row in cur.fetchall()}
+
+        cached = {}
+        for id in ids:
+            entry = cache.get((database, table, id))
+            if entry is not None:
+                cached[id] = entry
+        # Every row is compared with the cached version of its own id.
+        with self.getCursor() as cur:
+            cur.execute(
+                "SELECT t.id, t.version, "
+                "CASE WHEN t.version = c.version THEN NULL "
+                "ELSE t.data END AS data, "
+                "CASE WHEN t.version = c.version THEN NULL "
+                "ELSE octet_length(t.data::text) END AS size "
+                "FROM (SELECT id, %s AS version, data FROM %s "
+                "WHERE id = ANY(%%s)) AS t "
+                "LEFT JOIN unnest(%%s::text[], %%s::text[]) "
+                "AS c(id, version) ON c.id = t.id" % (ROW_VERSION, table),
+                (ids, list(cached),
+                 [version for version, doc in cached.values()]),
+                beacon=beacon, flush_hint=[table])
+            rows = cur.fetchall()
+        docs = {}
+        for row in rows:
+            id = row['id']
+            entry = cached.get(id)
+            if entry is not None and entry[0] == row['version']:
+                cache.record(True)
+                docs[id] = entry[1]
+            else:
+                cache.record(False)
+                cache.put((database, table, id),
+                          row['version'], row['data'], row['size'])
+                docs[id] = row['data']
+        return docs
+
     def _get_doc_by_dbref(self, dbref):
         return self._get_doc(dbref.database, dbref.table, dbref.id)
 
     def _get_doc_py_type(self, database, table, id):
-        tbl = sb.Table(table)
         with self.getCursor() as cur:
-            datafld = sb.Field(table, 'data')
             cur.execute(
-                sb.Select(sb.JGET(datafld, interfaces.PY_TYPE_ATTR_NAME),
-                          tbl.id == id),
-                beacon="%s:%s:%s" % (database, table, id))
+                "SELECT data -> '%s' FROM %s WHERE id = %%s" % (
+                    interfaces.PY_TYPE_ATTR_NAME, table),
+                (id,), beacon="%s:%s:%s" % (database, table, id),
+                prepare=True)
             res = cur.fetchone()
             return res[0] if res is not None else None
 
@@ -625,6 +1397,22 @@ class PJDataManager(object):
         #
         # While writing objects, new sub-objects might be registered
         # that also need saving. We are flushing until nothing left to flush.
+        #
+        # New and updated documents are collected in `_write_batch` and
+        # written per table at the end, saving a round trip per document.
+        # A nested flush (e.g. caused by a query while serializing) writes
+        # everything collected so far, so the query sees the latest data.
+        outermost = self._write_batch is None
+        if outermost:
+            self._write_batch = WriteBatch()
+        try:
+            self._flush_objects(flush_hint)
+            self._flush_write_batch()
+        finally:
+            if outermost:
+                self._write_batch = None
+
+    def _flush_objects(self, flush_hint):
         while True:
             # Write every registered object, but make sure we write each
             # object just once.
@@ -656,12 +1444,25 @@ class PJDataManager(object):
 
                 # Deregister the object. Note, that another nested flush may
                 # have already took care of this object.
-                if obj_id in self._registered_objects:
-                    del self._registered_objects[obj_id]
+                self._unregister(obj_id)
 
                 # Reset a flushed object as if it was not modified:
                 obj._p_changed = False
 
+                if (PJ_WRITE_BEHIND and self._write_batch is not None and
+                        len(self._write_batch) >= FLUSH_BATCH_SIZE):
+                    # Start writing while we serialize the other objects.
+                    self._flush_write_batch()
+
+    def _unregister(self, obj_id):
+        self._registered_objects.pop(obj_id, None)
+        doc_id = self._registered_doc_ids.pop(obj_id, None)
+        if doc_id is not None:
+            objs = self._registered_by_doc[doc_id]
+            objs.discard(obj_id)
+            if not objs:
+                del self._registered_by_doc[doc_id]
+
     def _get_doc_object(self, obj):
         seen = []
         # Make sure we write the object representing a document in a
@@ -675,6 +1476,10 @@ class PJDataManager(object):
 
     def _join_txn(self):
         if self._needs_to_join:
+            if PJ_TRANSACTION_BUDGET is not None:
+                self._budget_usage = PJ_TRANSACTION_BUDGET.start()
+            if PJ_DETECT_N_PLUS_ONE:
+                self._n_plus_one = NPlusOneDetector()
             self._acquire_conn()
             # once we have a working connection, we can join the transaction
             transaction = self.transaction_manager.get()
@@ -697,7 +1502,7 @@ class PJDataManager(object):
         self.setDirty()
         if id(obj) in self._registered_objects:
             obj._p_changed = False
-            del self._registered_objects[id(obj)]
+            self._unregister(id(obj))
         return res
 
     def load(self, dbref, klass=None):
@@ -714,6 +1519,138 @@ class PJDataManager(object):
 
         return self._reader.get_ghost(dbref, klass)
 
+    def load_many(self, dbrefs):
+        """Load many objects, reading their documents with one query per
+        table.
+
+        The returned objects are ghosts, activating them does not hit the
+        database anymore.
+        """
+        dbrefs = list(dbrefs)
+        self._prefetch_docs(dbrefs)
+        return [self.load(dbref) for dbref in dbrefs]
+
+    def prefetch(self, objs):
+        """Activate all ghosts of the given objects, reading their documents
+        with one query per table."""
+        ghosts = [obj for obj in objs
+                  if obj._p_oid is not None and obj._p_changed is None]
+        self._prefetch_docs([obj._p_oid for obj in ghosts])
+        for obj in ghosts:
+            obj._p_activate()
+
+    def _prefetch_docs(self, dbrefs):
+        # Read the documents of the given references into `_latest_states`,
+        # where `resolve()` and `setstate()` look for them first.
+        self._join_txn()
+        by_database = {}
+        for dbref in dbrefs:
+            if dbref in self._latest_states:
+                continue
+            obj = self._get_cached_object(dbref)
+            if obj is not None and obj._p_changed is not None:
+                # The object is already loaded.
+                continue
+            tables = by_database.setdefault(dbref.database, {})
+            tables.setdefault(dbref.table, set()).add(dbref.id)
+
+        for database, tables in by_database.items():
+            dm = self
+            if database != self.database:
+                dmp = zope.component.getUtility(
+                    interfaces.IPJDataManagerProvider)
+                dm = dmp.get(database)
+                dm._join_txn()
+            for table, ids in tables.items():
+                docs = dm._get_docs(database, table, ids)
+                for id, doc in docs.items():
+                    dm._latest_states[
+                        serialize.DBRef(table, id, database)] = doc
+
+    def _get_cached_object(self, dbref):
+        key = dbref.as_tuple()
+        obj = self._object_cache.get(key)
+        if obj is None:
+            obj = self._weak_object_cache.get(key)
+        return obj
+
+    def cacheGC(self, size=None):
+        """Reduce the object cache to `size` objects.
+
+        The least recently loaded objects that are not modified are turned
+        into ghosts and their documents are dropped. Objects with volatile
+        attributes only drop their documents. The objects are kept as long as
+        they are referenced, so loading them again returns the same object,
+        and a ghost reads its document again when it is used.
+
+        While a persistent sub-object of a ghost, like a `PersistentDict`,
+        is referenced from elsewhere, the ghost gets its previous state back
+        when it is used, so changes of the sub-object are not lost. As with
+        the ZODB cache, do not keep other non-persistent parts of the state
+        of an unmodified object, they are replaced when the object is loaded
+        again.
+        """
+        if size is None:
+            size = PJ_OBJECT_CACHE_SIZE or 0
+        excess = len(self._object_cache) - size
+        if excess <= 0:
+            return
+        # Walk from the least recently loaded object and stop once enough
+        # objects are released. Ghosts only move to the weak object cache.
+        ghosts = []
+        released = []
+        kept = []
+        for key, obj in self._object_cache.items():
+            if excess <= 0:
+                break
+            if obj._p_changed is None:
+                ghosts.append(key)
+                excess -= 1
+            elif self._releasable(obj):
+                released.append(obj)
+                excess -= 1
+            else:
+                kept.append(key)
+        for key in ghosts:
+            self._weak_object_cache[key] = self._object_cache.pop(key)
+        for obj in released:
+            self._release(obj)
+        # Objects that cannot be released are in use, move them to the end,
+        # so that they are not looked at again by every call.
+        for key in kept:
+            self._object_cache[key] = self._object_cache.pop(key)
+
+    def _releasable(self, obj):
+        # Objects being loaded are marked as changed.
+        return (obj._p_changed is False
+                and id(obj) not in self._registered_by_doc
+                and id(obj) not in self._inserted_objects
+                and id(obj) not in self._removed_objects)
+
+    def _release(self, obj):
+        # Drop the document of an unmodified object and move the object to
+        # the weak object cache, see `cacheGC()`. Tell whether it was done.
+        key = obj._p_oid.as_tuple()
+        if (self._object_cache.get(key) is not obj
+                or not self._releasable(obj)):
+            return False
+        del self._object_cache[key]
+        self._loaded_objects.pop(id(obj), None)
+        self._latest_states.pop(obj._p_oid, None)
+        # Ghosts lose their volatile attributes, like the name and parent
+        # of container items, keep such objects active.
+        if not any(name.startswith('_v_') for name in obj.__dict__):
+            subs = []
+            _collect_sub_objects(obj.__dict__, subs, set())
+            if subs:
+                detached = _DetachedState(obj.__getstate__())
+                for sub in subs:
+                    sub._v_pj_detached_state = detached
+                self._detached_states[key] = detached
+            obj._p_deactivate()
+        self._weak_object_cache[key] = obj
+        return True
+
     def reset(self):
         # we need to issue rollback on self._conn too, to get the latest
         # DB updates, not just reset PJDataManager state
@@ -721,18 +1658,81 @@ class PJDataManager(object):
 
     def _acquire_conn(self):
         """Get connection from connection pool"""
-        self._conn = self._pool.getconn()
+        self._conn = None
+        if self._use_replica():
+            conn = self._replica_pool.getconn()
+            if self._replica_is_current(conn):
+                self._conn = conn
+                self._conn_pool = self._replica_pool
+            else:
+                self._replica_pool.putconn(conn)
+        if self._conn is None:
+            self._conn = self._pool.getconn()
+            self._conn_pool = self._pool
         assert self._conn.status == psycopg2.extensions.STATUS_READY
         self.database = get_database_name_from_dsn(self._conn.dsn)
 
+    def on_replica(self):
+        """Tell whether the current transaction is executed on the replica."""
+        return (self._conn_pool is not None and
+                self._conn_pool is self._replica_pool)
+
+    def _use_replica(self):
+        if self._replica_pool is None or not self._readonly:
+            return False
+        if PJ_REPLICA_REQUIRE_DEFERRABLE and not self._deferrable:
+            return False
+        last_write = getattr(REPLICA_PINS, 'last_write', None)
+        if (PJ_REPLICA_PIN_AFTER_WRITE is not None and
+                last_write is not None and
+                time.monotonic() - last_write < PJ_REPLICA_PIN_AFTER_WRITE):
+            return False
+        return True
+
+    def _replica_is_current(self, conn):
+        if PJ_REPLICA_MAX_LAG is None:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute(REPLICA_LAG_SQL)
+                lag = cur.fetchone()[0]
+            # Transaction options can only be set outside of a transaction.
+            conn.rollback()
+        except psycopg2.Error:
+            LOG.warning('Checking the replication lag failed, '
+                        'using the primary.', exc_info=True)
+            return False
+        if lag is None or lag > PJ_REPLICA_MAX_LAG:
+            LOG.info('Replica lags behind by %s seconds, using the primary.',
+                     lag)
+            return False
+        return True
+
     def _release_conn(self, conn):
         """Release the connection after transaction is complete
         """
+        self._wait_for_writes(abort=True)
+        if self._write_behind is not None:
+            # Do not keep an idle thread around for every data manager.
+            self._write_behind.shutdown()
+            self._write_behind = None
         if not conn.closed:
             # Set transaction options back to their default values so that next
             # transaction is not affected
-            conn.reset()
-        self._pool.putconn(conn)
+            if PJ_PREPARED_STATEMENTS:
+                # reset() discards all session state, including the prepared
+                # statements we want to reuse.
+                if (self._tpc_activated and
+                        conn.status != psycopg2.extensions.STATUS_READY):
+                    conn.tpc_rollback()
+                else:
+                    conn.rollback()
+                conn.set_session(isolation_level='DEFAULT',
+                                 readonly='DEFAULT', deferrable='DEFAULT')
+            else:
+                conn.reset()
+                forget_prepared_statements(conn)
+        self._conn_pool.putconn(conn)
         self._reset_data_manager()
 
     def insert(self, obj, oid=None):
@@ -742,7 +1742,7 @@ class PJDataManager(object):
         res = self._writer.store(obj, id=oid)
         self.setDirty()
         obj._p_changed = False
-        self._object_cache[hash(obj._p_oid)] = obj
+        self._object_cache[obj._p_oid.as_tuple()] = obj
         self._inserted_objects[id(obj)] = obj
         return res
 
@@ -758,11 +1758,17 @@ class PJDataManager(object):
         with self.getCursor() as cur:
             cur.execute('DELETE FROM %s WHERE id = %%s' % table,
                         (obj._p_oid.id,),
-                        beacon="%s:%s:%s" % (dbname, table, obj._p_oid.id))
+                        beacon="%s:%s:%s" % (dbname, table, obj._p_oid.id),
+                        prepare=True)
             self.setDirty()
-        if hash(obj._p_oid) in self._object_cache:
-            del self._object_cache[hash(obj._p_oid)]
-
+        self._object_cache.pop(obj._p_oid.as_tuple(), None)
+        self._weak_object_cache.pop(obj._p_oid.as_tuple(), None)
+        if SHARED_DOCUMENT_CACHE is not None:
+            SHARED_DOCUMENT_CACHE.invalidate((dbname, table, obj._p_oid.id))
+
+        # Edge case: The object was only referenced so far, its document was
+        # never written.
+        self._pending_inserts.pop(obj._p_oid, None)
         # Edge case: The object was just added in this transaction.
         if id(obj) in self._inserted_objects:
             # but it still had to be removed from PostGreSQL, because insert
@@ -773,9 +1779,9 @@ class PJDataManager(object):
         # Just in case the object was modified before removal, let's remove it
         # from the modification list. Note that all sub-objects need to be
         # deleted too!
-        for key, reg_obj in list(self._registered_objects.items()):
-            if self._get_doc_object(reg_obj) is obj:
-                del self._registered_objects[key]
+        for key in self._registered_by_doc.pop(id(obj), ()):
+            self._registered_objects.pop(key, None)
+            del self._registered_doc_ids[key]
         # We are not doing anything fancy here, since the object might be
         # added again with some different state.
 
@@ -784,14 +1790,31 @@ class PJDataManager(object):
         # transaction, because we keep an active object cache that gets stale
         # after the transaction is complete and must be cleaned.
         self._join_txn()
+        # The object becomes the most recently loaded one.
+        key = obj._p_oid.as_tuple()
+        if (self._object_cache.pop(key, None) is not None
+                or self._weak_object_cache.pop(key, None) is not None):
+            self._object_cache[key] = obj
+        if (PJ_OBJECT_CACHE_SIZE is not None
+                and len(self._object_cache) > PJ_OBJECT_CACHE_SIZE):
+            self.cacheGC()
         # If the doc is None, but it has been loaded before, we look it
         # up. This acts as a great hook for optimizations that load many
         # documents at once. They can now dump the states into the
         # _latest_states dictionary.
+        detached = self._detached_states.pop(key, None)
+        if detached is not None:
+            # A sub-object of the state released by `cacheGC()` is still
+            # around, so use that state, it may have been changed.
+            obj.__setstate__(detached.state)
+            self._loaded_objects[id(obj)] = obj
+            return
         if doc is None:
             doc = self._latest_states.get(obj._p_oid, None)
         self._reader.set_ghost_state(obj, doc)
         self._loaded_objects[id(obj)] = obj
+        if self._budget_usage is not None:
+            self._budget_usage.record_documents()
 
     def oldstate(self, obj, tid):
         # I cannot find any code using this method. Also, since we do not keep
@@ -822,11 +1845,16 @@ class PJDataManager(object):
                 reg_for_table = self._registered_by_table.setdefault(table, set())
                 reg_for_table.add(obj_id)
 
+                self._registered_by_doc.setdefault(
+                    id(docobj), set()).add(obj_id)
+                self._registered_doc_ids[obj_id] = id(docobj)
+
     def abort(self, transaction):
         if self._conn is None:
             # Connection was never aqcuired - nothing to abort
             return
         self._report_stats()
+        self._wait_for_writes(abort=True)
         try:
             if self._tpc_activated:
                 self._conn.tpc_rollback()
@@ -861,16 +1889,24 @@ class PJDataManager(object):
             self._deferrable = deferrable
 
     def _begin(self, transaction):
-        self._conn.set_session(isolation_level=self._isolation_level,
+        isolation_level = self._isolation_level
+        on_replica = self.on_replica()
+        if on_replica and isolation_level in (
+                psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE,
+                'SERIALIZABLE'):
+            # Replicas do not support serializable transactions.
+            isolation_level = 'REPEATABLE READ'
+        self._conn.set_session(isolation_level=isolation_level,
                                deferrable=self._deferrable,
                                readonly=self._readonly)
 
         # This function is called when PJDataManager joins transaction. When
         # two phase commit is requested, we will assign transaction id to
         # underlying connection.
-        if not PJ_TWO_PHASE_COMMIT_ENABLED:
+        if not PJ_TWO_PHASE_COMMIT_ENABLED or on_replica:
             # We don't need to do anything special when two phase commit is
-            # disabled. Transaction starts automatically.
+            # disabled. Transaction starts automatically. Read-only
+            # transactions on a replica have nothing to prepare.
             return
 
         assert self._pristine, ("Error attempting to add data manager "
@@ -905,20 +1941,28 @@ class PJDataManager(object):
 
     def commit(self, transaction):
         self.flush()
+        self._wait_for_writes()
         self._report_stats()
         self._log_rw_stats()
 
         if not self._tpc_activated:
             try:
                 self._might_execute_with_error(self._conn.commit)
-                self._dirty = False
+                self._committed()
             finally:
                 self._release_conn(self._conn)
 
+    def _committed(self):
+        if self._dirty:
+            REPLICA_PINS.last_write = time.monotonic()
+        self._dirty = False
+        self._remember_created_tables()
+
     def tpc_begin(self, transaction):
         pass
 
     def tpc_vote(self, transaction):
+        self._wait_for_writes()
         if self._tpc_activated:
             assert self._conn.status == psycopg2.extensions.STATUS_BEGIN
             if self.isDirty():
@@ -940,7 +1984,7 @@ class PJDataManager(object):
             self._report_stats()
             try:
                 self._might_execute_with_error(self._conn.tpc_commit)
-                self._dirty = False
+                self._committed()
             finally:
                 self._release_conn(self._conn)
 
@@ -953,6 +1997,12 @@ class PJDataManager(object):
         return 'PJDataManager:0'
 
     def _report_stats(self):
+        if self._n_plus_one is not None:
+            report = self._n_plus_one.report()
+            if report:
+                LOG.warning(report)
+            self._n_plus_one.clear()
+
         if not PJ_ENABLE_QUERY_STATS:
             return
 
@@ -999,7 +2049,11 @@ def register_query_stats_listener(listener):
     object.
 
     `listener` object has to implement `record(sql, args, time, db)` method.
-    QueryReport object may be used for this for detailed query analysis.
+    With `PJ_EXPLAIN_THRESHOLD`, the plan of slow statements is passed as
+    the `plan` keyword argument to listeners with a true `accepts_plan`
+    attribute.
+    QueryReport object may be used for this for detailed query analysis,
+    QueryAggregator has bounded memory and can stay registered.
     """
     GLOBAL_QUERY_STATS_LISTENERS.add(listener)
 
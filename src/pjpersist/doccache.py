@@ -0,0 +1,95 @@
+##############################################################################
+#
+# Copyright (c) 2014 Shoobx, Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Process wide cache of decoded documents"""
+import threading
+from collections import OrderedDict
+
+# Default memory budget of a document cache in bytes.
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+
+class DocumentCache(object):
+    """Size bounded LRU cache of decoded documents shared between transactions.
+
+    Entries are keyed by `(database, table, id)` and hold the row version the
+    document was read at. The data manager sends the cached version along
+    with every read and only receives the document again when the row
+    changed, so a cached document is never served stale.
+
+    Cached documents are shared by all threads and must not be modified.
+
+    The size of an entry is the length of the JSON text of the document, an
+    estimate of its decoded size that does not depend on how the database
+    compresses it. The cache evicts the least recently used entries once
+    `max_size` is exceeded.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> (version, doc, size)
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Return `(version, doc)` for the key or `None`."""
+        with self._lock:
+            try:
+                version, doc, size = self._entries[key]
+            except KeyError:
+                return None
+            self._entries.move_to_end(key)
+            return version, doc
+
+    def put(self, key, version, doc, size):
+        """Store a document read at the given row version."""
+        with self._lock:
+            self._remove(key)
+            if size is None or size > self.max_size:
+                return
+            self._entries[key] = (version, doc, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, _, old_size) = self._entries.popitem(last=False)
+                self.size -= old_size
+
+    def record(self, hit):
+        """Count a revalidation result."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
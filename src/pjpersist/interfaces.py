@@ -50,10 +50,25 @@ class ReadOnlyDataManagerError(transaction.interfaces.TransactionError):
     """Attempt to modify objects governed by a read-only data manager."""
 
 
+class TransactionBudgetExceeded(Exception):
+    """The transaction used more than its budget, see
+    `pjpersist.querystats.TransactionBudget`."""
+
+
+class TransactionBudgetWarning(UserWarning):
+    """The transaction used more than its budget."""
+
+
 class IObjectSerializer(zope.interface.Interface):
     """An object serializer allows for custom serialization output for
     objects."""
 
+    py_type = zope.interface.Attribute(
+        """The `_py_type` of the states this serializer reads, or None.
+
+        With a `py_type`, `can_read()` is not called, all dicts with this
+        `_py_type` are read by the serializer.""")
+
     def can_read(state):
         """Returns a boolean indicating whether this serializer can deserialize
         this state."""
@@ -138,6 +153,10 @@ class IPJDataManager(persistent.interfaces.IPersistentDataManager):
     root = zope.interface.Attribute(
         """Get the root object, which is a mapping.""")
 
+    skipped_writes = zope.interface.Attribute(
+        """Number of changed objects that were not written, because their
+        document was the same as the one in the database.""")
+
     def create_tables(tables):
         """Create passed tables and persistence_name_map, use this instead
         of PJ_AUTO_CREATE_TABLES"""
@@ -157,9 +176,30 @@ class IPJDataManager(persistent.interfaces.IPersistentDataManager):
         Note: The returned object is in the ghost state.
         """
 
+    def load_many(dbrefs):
+        """Load the objects of many DBRefs.
+
+        The documents are read with one query per table. The returned objects
+        are in the ghost state, but activating them does not query the
+        database again.
+        """
+
+    def prefetch(objs):
+        """Activate all ghosts of the given objects.
+
+        The documents are read with one query per table.
+        """
+
     def flush():
         """Flush all changes to PostGreSQL."""
 
+    def cacheGC(size=None):
+        """Reduce the object cache to `size` objects.
+
+        The least recently loaded unmodified objects are turned into ghosts.
+        `size` defaults to `pjpersist.datamanager.PJ_OBJECT_CACHE_SIZE`.
+        """
+
     def insert(obj, id=None):
         """Insert an object into PostGreSQL.
 
@@ -193,9 +233,14 @@ class IPJDataManager(persistent.interfaces.IPersistentDataManager):
         isolation_level: int = None) -> None:
         """Set the options for the future transaction
 
-        Options can only be set before the postgres transaction has started
+        Options can only be set before the postgres transaction has started.
+        Read-only transactions are executed on the replica, when the data
+        manager has a replica pool.
         """
 
+    def on_replica() -> bool:
+        """Tell whether the current transaction is executed on the replica."""
+
 
 class IPJDataManagerProvider(zope.interface.Interface):
     """Utility to get a PJ data manager.
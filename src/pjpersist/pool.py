@@ -14,7 +14,12 @@
 """Thread-aware PG/JSONB Connection Pool"""
 import logging
 import threading
+import time
+
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import transaction
 import zope.interface
 
 from pjpersist import datamanager, interfaces
@@ -23,35 +28,321 @@ log = logging.getLogger('pjpersist')
 
 LOCAL = threading.local()
 
-# XXX: THIS SEEMS MAJORLY BROKEN< SINCE CONNECTIONS ARE NEVER RETURNED TO THE
-# POOL.
+
+@zope.interface.implementer(interfaces.IPJConnectionPool)
+class PJConnectionPool(object):
+    """A thread safe pool of connections to one database.
+
+    `minconn` connections are opened right away, up to `maxconn` are opened
+    on demand. When all connections are in use, `getconn()` waits up to
+    `timeout` seconds (forever with `None`) for one to be returned and raises
+    `psycopg2.pool.PoolError` after that.
+
+    Connections older than `max_lifetime` seconds are closed when they are
+    returned, connections idle for more than `max_idle` seconds are closed as
+    long as more than `minconn` connections are open. Connections idle for
+    more than `check_idle` seconds are pinged before they are handed out, so
+    connections killed by the server or the network are replaced.
+
+    All other arguments are passed to `psycopg2.connect()`.
+    """
+
+    def __init__(self, minconn, maxconn, *args, timeout=30.0,
+                 max_lifetime=None, max_idle=None, check_idle=5.0, **kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_idle = check_idle
+        self._args = args
+        self._kwargs = kwargs
+        self._cond = threading.Condition()
+        # Idle connections as `(conn, idle since)`, the most recently used
+        # last.
+        self._idle = []
+        # id(conn) -> conn
+        self._used = {}
+        # id(conn) -> time the connection was opened
+        self._opened = {}
+        # Connections being opened right now.
+        self._opening = 0
+        self.closed = False
+        self._reset_stats()
+        self._open_min()
+
+    def _reset_stats(self):
+        self.waiters = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.connections_opened = 0
+        self.connections_closed = 0
+        self.checkout_time = 0.0
+        self.max_checkout_time = 0.0
+
+    @property
+    def database(self):
+        """Name of the database, known without connecting, or None."""
+        return self._kwargs.get('database', self._kwargs.get('dbname'))
+
+    @property
+    def size(self):
+        """Number of open connections."""
+        return len(self._idle) + len(self._used) + self._opening
+
+    def stats(self):
+        """Return the pool metrics as a dict.
+
+        `checkout_time` is the total time `getconn()` took, including the
+        time spent waiting for a connection.
+        """
+        with self._cond:
+            return {
+                'size': self.size,
+                'idle': len(self._idle),
+                'in_use': len(self._used),
+                'waiters': self.waiters,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'connections_opened': self.connections_opened,
+                'connections_closed': self.connections_closed,
+                'checkout_time': self.checkout_time,
+                'max_checkout_time': self.max_checkout_time,
+            }
+
+    def _connect(self):
+        conn = psycopg2.connect(*self._args, **self._kwargs)
+        with self._cond:
+            self._opened[id(conn)] = time.monotonic()
+            self.connections_opened += 1
+        return conn
+
+    def _close(self, conn):
+        with self._cond:
+            self._opened.pop(id(conn), None)
+            self.connections_closed += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _open_min(self):
+        for i in range(self.minconn - self.size):
+            conn = self._connect()
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+
+    def _expired(self, conn, now):
+        return (self.max_lifetime is not None and
+                now - self._opened.get(id(conn), now) > self.max_lifetime)
+
+    def _prune_idle(self, now):
+        # Return the idle connections to close, the caller holds the lock.
+        pruned = []
+        keep = []
+        # The least recently used connections come first.
+        for conn, since in self._idle:
+            too_long = (self.max_idle is not None and
+                        now - since > self.max_idle and
+                        self.size - len(pruned) > self.minconn)
+            if conn.closed or too_long or self._expired(conn, now):
+                pruned.append(conn)
+            else:
+                keep.append((conn, since))
+        self._idle = keep
+        return pruned
+
+    def _is_alive(self, conn):
+        try:
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+            finally:
+                conn.autocommit = False
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self):
+        """Get a connection, waiting for one when all are in use."""
+        started = time.monotonic()
+        while True:
+            conn, since = self._checkout(started)
+            if conn is None:
+                # We got a free slot, open a new connection.
+                try:
+                    conn = self._connect()
+                finally:
+                    with self._cond:
+                        self._opening -= 1
+                        if conn is not None:
+                            self._used[id(conn)] = conn
+                        self._cond.notify()
+                break
+            if (self.check_idle is None or
+                    time.monotonic() - since <= self.check_idle or
+                    self._is_alive(conn)):
+                break
+            log.info('Replacing dead connection of the pool.')
+            with self._cond:
+                del self._used[id(conn)]
+            self._close(conn)
+
+        duration = time.monotonic() - started
+        with self._cond:
+            self.checkouts += 1
+            self.checkout_time += duration
+            self.max_checkout_time = max(self.max_checkout_time, duration)
+        return conn
+
+    def _checkout(self, started):
+        # Return an idle connection and the time it got idle, or reserve a
+        # slot for a new connection and return `None`.
+        to_close = []
+        try:
+            with self._cond:
+                while True:
+                    if self.closed:
+                        raise psycopg2.pool.PoolError(
+                            "connection pool is closed")
+                    to_close.extend(self._prune_idle(time.monotonic()))
+                    if self._idle:
+                        conn, since = self._idle.pop()
+                        self._used[id(conn)] = conn
+                        return conn, since
+                    if self.size < self.maxconn:
+                        self._opening += 1
+                        return None, None
+                    remaining = None
+                    if self.timeout is not None:
+                        remaining = started + self.timeout - time.monotonic()
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            raise psycopg2.pool.PoolError(
+                                "timed out waiting for a connection")
+                    self.waiters += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self.waiters -= 1
+        finally:
+            for conn in to_close:
+                self._close(conn)
+
+    def putconn(self, conn, key=None, close=False):
+        """Return a connection to the pool."""
+        with self._cond:
+            if self.closed:
+                # closeall() already closed the connection.
+                return
+            if self._used.pop(id(conn), None) is None:
+                raise psycopg2.pool.PoolError(
+                    "trying to put unkeyed connection")
+        if not conn.closed and not close:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                # The connection is broken.
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+        now = time.monotonic()
+        with self._cond:
+            keep = (not close and not conn.closed and not self.closed and
+                    not self._expired(conn, now))
+            if keep:
+                self._idle.append((conn, now))
+            self._cond.notify()
+        if not keep:
+            self._close(conn)
+
+    def closeall(self):
+        """Close all connections, including the ones in use."""
+        with self._cond:
+            self.closed = True
+            conns = [conn for conn, since in self._idle]
+            conns.extend(self._used.values())
+            self._idle = []
+            self._used = {}
+            self._cond.notify_all()
+        for conn in conns:
+            self._close(conn)
+
+    def reopen(self):
+        """Reopen the pool after it was closed."""
+        with self._cond:
+            self.closed = False
+        self._open_min()
+
 
 @zope.interface.implementer(interfaces.IPJDataManagerProvider)
 class PJDataManagerProvider(object):
+    """Provide a data manager per thread and transaction.
+
+    A `PJConnectionPool` is created for each database, extra keyword
+    arguments are passed to it. With a `replica_host`, a second pool per
+    database connects to the read replica, read-only transactions are
+    executed there.
+    """
 
     def __init__(self, user=None, password=None, host='localhost', port=5432,
-                 pool_min_conn=1, pool_max_conn=8):
+                 pool_min_conn=1, pool_max_conn=8, replica_host=None,
+                 replica_port=None, **pool_kwargs):
         self.user = user
         self.password = password
         self.host = host
         self.port = port
+        self.replica_host = replica_host
+        self.replica_port = replica_port or port
+        self.pool_min_conn = pool_min_conn
+        self.pool_max_conn = pool_max_conn
+        self.pool_kwargs = pool_kwargs
         self.pools = {}
+        self.replica_pools = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self, pools, database, host, port):
+        with self._lock:
+            if database not in pools:
+                pools[database] = PJConnectionPool(
+                    self.pool_min_conn, self.pool_max_conn,
+                    database=database, user=self.user,
+                    password=self.password, host=host, port=port,
+                    **self.pool_kwargs)
+            return pools[database]
+
+    def get_pool(self, database):
+        return self._get_pool(self.pools, database, self.host, self.port)
+
+    def get_replica_pool(self, database):
+        if self.replica_host is None:
+            return None
+        return self._get_pool(
+            self.replica_pools, database, self.replica_host,
+            self.replica_port)
 
     def get(self, database):
         # Make sure the dict containing the local data managers exists.
-        if not hatattr(LOCAL, 'dms'):
+        if not hasattr(LOCAL, 'dms'):
             LOCAL.dms = {}
-        # Get the data manager, if it exists.
+        # Get the data manager, if it exists for the current transaction.
+        # Data managers must not be reused across transactions with two
+        # phase commit.
+        txn = transaction.get()
         try:
-            return LOCAL.dms[database]
+            dm_txn, dm = LOCAL.dms[database]
         except KeyError:
             pass
-        # Create a new pool, if necessary.
-        if database not in self.pools:
-            self.pools[database] = psycopg2.pool.PersistentConnectionPool(
-                database=database, user=self.user, password=self.password,
-                host=self.host, port=self.port)
-        # Create a new data manager and return it.
-        LOCAL.dms[database] = datamanager.PJDataManager(
-            self.pools[database].getconn())
-        return LOCAL.dms[database]
+        else:
+            if dm_txn is txn:
+                return dm
+        # Create a new data manager and return it, it returns its connection
+        # to the pool when the transaction ends.
+        dm = datamanager.PJDataManager(
+            self.get_pool(database),
+            replica_pool=self.get_replica_pool(database))
+        LOCAL.dms[database] = (txn, dm)
+        return dm
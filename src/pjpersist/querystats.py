@@ -13,18 +13,37 @@
 #
 ##############################################################################
 """Statistics on executed queries"""
+import collections
+import logging
+import math
+import random
+import re
 import sys
+import threading
+import warnings
 from collections import namedtuple
 
 from zope.exceptions import exceptionformatter
 
+from pjpersist import interfaces
+
+LOG = logging.getLogger(__name__)
+
 
 QueryStats = namedtuple("QueryStats",
-                        ["query", "args", "time", "traceback", "database"])
+                        ["query", "args", "time", "traceback", "database",
+                         "plan"], defaults=[None])
 
 QueryTotals = namedtuple('QueryTotals',
                          ["total_queries", "total_time", "sorted_queries"])
 
+NPlusOne = namedtuple('NPlusOne', ["fingerprint", "call_site", "count"])
+
+FingerprintTotals = namedtuple(
+    'FingerprintTotals',
+    ["fingerprint", "count", "total_time", "min_time", "max_time",
+     "p50", "p95", "p99", "tracebacks", "plan"])
+
 
 # Number of most expensive queries to print out
 NUM_OF_QUERIES_TO_REPORT = 10
@@ -35,19 +54,47 @@ REPORT_TRACEBACK = False
 TB_LIMIT = 15  # 15 should be sufficient to figure
 
 
+def format_plan(plan, indent=''):
+    """Format a plan returned by `EXPLAIN (FORMAT JSON)` as text, one line
+    per node."""
+    lines = []
+
+    def add(node, prefix):
+        text = node['Node Type']
+        if 'Index Name' in node:
+            text += ' using %s' % node['Index Name']
+        if 'Relation Name' in node:
+            text += ' on %s' % node['Relation Name']
+        text += ' (cost=%.2f..%.2f rows=%s)' % (
+            node.get('Startup Cost', 0), node.get('Total Cost', 0),
+            node.get('Plan Rows'))
+        lines.append(prefix + text)
+        for child in node.get('Plans', ()):
+            add(child, prefix + '  ')
+
+    add(plan['Plan'], indent)
+    return '\n'.join(lines)
+
+
 class QueryReport(object):
+
+    # `record()` takes the plan of explained queries.
+    accepts_plan = True
+
     def __init__(self):
         self.qlog = []
         self.report_traceback = REPORT_TRACEBACK
 
-    def record(self, query, args, elapsed_time, database=None):
+    def record(self, query, args, elapsed_time, database=None, plan=None):
         """Record executed query
 
         elapsed_time is time, elapsed by executing query, in secodes
+        plan is the `EXPLAIN (FORMAT JSON)` plan of slow queries, see
+        `datamanager.PJ_EXPLAIN_THRESHOLD`
         """
         traceback = self._collect_traceback()
         self.qlog.append(QueryStats(query, args, elapsed_time,
-                                    traceback, database))
+                                    traceback, database, plan))
 
     def calc_totals(self):
         """Calculate totals and return QueryTotals object
@@ -76,6 +123,9 @@ class QueryReport(object):
             p("*** %s" % q.query)
             p("... ARGS: %s" % (q.args,))
             p("... TIME: %.4fms" % (q.time * 1000))
+            if q.plan:
+                p("... PLAN:")
+                p(format_plan(q.plan, indent='    '))
             if self.report_traceback and q.traceback:
                 p(q.traceback)
             p("")
@@ -98,3 +148,407 @@ class QueryReport(object):
                 sys.exc_info()[2].tb_frame.f_back, limit=TB_LIMIT)
             tb = ''.join(stack[:-2])
             return tb
+
+
+_FINGERPRINT_RES = [
+    # Comments
+    (r'--[^\n]*', ' ', 0),
+    (r'/\*.*?\*/', ' ', re.DOTALL),
+    # String literals, with backslash escapes and dollar quoted
+    (r"\b[Ee]'(?:[^'\\]|\\.|'')*'", '?', re.DOTALL),
+    (r"'(?:[^']|'')*'", '?', 0),
+    (r'\$(\w*)\$.*?\$\1\$', '?', re.DOTALL),
+    # Names of server side cursors
+    (r'\bpj_cursor_[0-9a-f]+', 'pj_cursor_?', 0),
+    # Numbers and parameters
+    (r'(?<![\w$.])\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b', '?', 0),
+    (r'%(?:\(\w+\))?s|\$\d+', '?', 0),
+    # Lists of values, their length does not matter
+    (r'\(\s*\?(?:::[\w\[\]]+)?'
+     r'(?:\s*,\s*\?(?:::[\w\[\]]+)?)*\s*\)', '(...)', 0),
+    (r'\bARRAY\s*\[[\s?,]*\]', 'ARRAY[...]', re.IGNORECASE),
+    (r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+', '(...)', 0),
+    (r'\s+', ' ', 0),
+]
+_FINGERPRINT_RES = [
+    (re.compile(regex, flags), repl)
+    for regex, repl, flags in _FINGERPRINT_RES]
+
+# Maximum number of statements whose fingerprint is cached.
+FINGERPRINT_CACHE_SIZE = 10000
+
+_FINGERPRINT_CACHE = {}
+
+
+def fingerprint(sql):
+    """Return the statement with literals and parameters replaced by `?`,
+    so all executions of the same statement have the same fingerprint."""
+    try:
+        return _FINGERPRINT_CACHE[sql]
+    except KeyError:
+        pass
+    fp = sql
+    for regex, repl in _FINGERPRINT_RES:
+        fp = regex.sub(repl, fp)
+    fp = fp.strip()
+    if len(_FINGERPRINT_CACHE) >= FINGERPRINT_CACHE_SIZE:
+        _FINGERPRINT_CACHE.clear()
+    _FINGERPRINT_CACHE[sql] = fp
+    return fp
+
+
+class LogHistogram(object):
+    """Streaming quantile sketch with bounded relative error.
+
+    Values are counted in logarithmic buckets, a quantile is accurate within
+    `relative_accuracy` of the value. At most `max_buckets` buckets are kept,
+    the lowest buckets are merged beyond that.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048,
+                 min_value=1e-6):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.min_value = min_value
+        self.buckets = {}
+        # Values below `min_value`
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value < self.min_value:
+            self.zeros += 1
+            return
+        key = math.ceil(math.log(value) / self._log_gamma)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        if len(self.buckets) > self.max_buckets:
+            lowest = sorted(self.buckets)[:2]
+            self.buckets[lowest[1]] += self.buckets.pop(lowest[0])
+
+    def quantile(self, q):
+        """Return the value below which `q` (0 to 1) of the values are."""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(q * self.count))
+        seen = self.zeros
+        if seen >= rank:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen >= rank:
+                # The middle of the bucket, in relative terms.
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+class _Fingerprint(object):
+
+    def __init__(self, relative_accuracy):
+        self.count = 0
+        self.total_time = 0.0
+        self.min_time = None
+        self.max_time = None
+        self.histogram = LogHistogram(relative_accuracy)
+        self.tracebacks = []
+        # The plan of the slowest explained execution
+        self.plan = None
+        self.plan_time = None
+
+    def quantile(self, q):
+        # The exact minimum and maximum are known.
+        return min(max(self.histogram.quantile(q), self.min_time),
+                   self.max_time)
+
+
+class QueryAggregator(QueryReport):
+    """Aggregate query statistics by statement fingerprint.
+
+    Unlike `QueryReport`, memory does not grow with the number of executed
+    queries, so it can be registered permanently with
+    `datamanager.register_query_stats_listener()`. Count, total, minimum and
+    maximum time and a `LogHistogram` are kept per fingerprint. Queries with
+    new fingerprints beyond `max_fingerprints` are counted as
+    `OTHER_FINGERPRINT`. Tracebacks are only collected for a
+    `traceback_sample_rate` fraction of the queries, at most
+    `max_tracebacks` per fingerprint.
+    """
+
+    OTHER_FINGERPRINT = '<other>'
+
+    def __init__(self, max_fingerprints=1000, relative_accuracy=0.01,
+                 traceback_sample_rate=0.01, max_tracebacks=3):
+        self.max_fingerprints = max_fingerprints
+        self.relative_accuracy = relative_accuracy
+        self.traceback_sample_rate = traceback_sample_rate
+        self.max_tracebacks = max_tracebacks
+        self.report_traceback = REPORT_TRACEBACK
+        self._lock = threading.Lock()
+        self.clear()
+
+    def record(self, query, args, elapsed_time, database=None, plan=None):
+        """Record executed query
+
+        elapsed_time is time, elapsed by executing query, in secodes
+        """
+        fp = fingerprint(query)
+        with self._lock:
+            stats = self.fingerprints.get(fp)
+            if stats is None:
+                if len(self.fingerprints) >= self.max_fingerprints:
+                    fp = self.OTHER_FINGERPRINT
+                    stats = self.fingerprints.get(fp)
+                if stats is None:
+                    stats = self.fingerprints[fp] = _Fingerprint(
+                        self.relative_accuracy)
+            stats.count += 1
+            stats.total_time += elapsed_time
+            if stats.min_time is None or elapsed_time < stats.min_time:
+                stats.min_time = elapsed_time
+            if stats.max_time is None or elapsed_time > stats.max_time:
+                stats.max_time = elapsed_time
+            stats.histogram.add(elapsed_time)
+            if plan is not None and (stats.plan_time is None or
+                                     elapsed_time >= stats.plan_time):
+                stats.plan = plan
+                stats.plan_time = elapsed_time
+            sample = (len(stats.tracebacks) < self.max_tracebacks and
+                      random.random() < self.traceback_sample_rate)
+        if sample:
+            traceback = self._collect_traceback()
+            with self._lock:
+                if len(stats.tracebacks) < self.max_tracebacks:
+                    stats.tracebacks.append(traceback)
+
+    def stats(self):
+        """Return `FingerprintTotals` of all fingerprints, the ones with the
+        highest total time first."""
+        with self._lock:
+            totals = [
+                FingerprintTotals(
+                    fp, stats.count, stats.total_time, stats.min_time,
+                    stats.max_time, stats.quantile(0.5),
+                    stats.quantile(0.95), stats.quantile(0.99),
+                    list(stats.tracebacks), stats.plan)
+                for fp, stats in self.fingerprints.items()]
+        return sorted(totals, key=lambda t: t.total_time, reverse=True)
+
+    def calc_totals(self):
+        """Calculate totals and return QueryTotals object, the queries are
+        `FingerprintTotals` sorted by total time.
+        """
+        stats = self.stats()
+        return QueryTotals(sum(t.count for t in stats),
+                           sum(t.total_time for t in stats),
+                           stats[::-1])
+
+    def calc_and_report(self):
+        """Calculate totals and print out report
+        """
+        totals = self.calc_totals()
+        if not totals.total_queries:
+            return "Query report: no queries were executed"
+        sep = '-' * 60
+
+        report = []
+        p = report.append
+
+        p("Query report:")
+        p(sep)
+        p("%s most expensive statements:" % NUM_OF_QUERIES_TO_REPORT)
+        for q in totals.sorted_queries[-NUM_OF_QUERIES_TO_REPORT:]:
+            p("*** %s" % q.fingerprint)
+            p("... COUNT: %s" % q.count)
+            p("... TIME: %.4fms (min %.4fms, max %.4fms)" % (
+                q.total_time * 1000, q.min_time * 1000, q.max_time * 1000))
+            p("... P50: %.4fms, P95: %.4fms, P99: %.4fms" % (
+                q.p50 * 1000, q.p95 * 1000, q.p99 * 1000))
+            if q.plan:
+                p("... PLAN:")
+                p(format_plan(q.plan, indent='    '))
+            if self.report_traceback and q.tracebacks:
+                p(q.tracebacks[0])
+            p("")
+        p(sep)
+        p("Queries executed: %s" % totals.total_queries)
+        p("Time spent: %.4fms" % (totals.total_time * 1000))
+
+        return "\n".join(report)
+
+    def clear(self):
+        self.fingerprints = {}
+
+
+# Policies of a TransactionBudget
+BUDGET_WARN = 'warn'
+BUDGET_LOG = 'log'
+BUDGET_RAISE = 'raise'
+
+# Frames of these modules are not reported as call sites, unless they are
+# tests.
+INTERNAL_MODULES = ('pjpersist.', 'persistent.', 'transaction.')
+
+
+def get_call_site(depth=1):
+    """Return the application frame calling into pjpersist as
+    `file:line in function`."""
+    frame = sys._getframe(depth)
+    while frame is not None:
+        name = frame.f_globals.get('__name__', '')
+        if (not name.startswith(INTERNAL_MODULES) or
+                '.tests.' in name):
+            code = frame.f_code
+            return '%s:%s in %s' % (
+                code.co_filename, frame.f_lineno, code.co_name)
+        frame = frame.f_back
+    return '<unknown>'
+
+
+class TransactionBudget(object):
+    """Limits of the work of one transaction.
+
+    Set `datamanager.PJ_TRANSACTION_BUDGET` to an instance to limit the
+    number of statements, the time spent executing them in seconds, the rows
+    they returned and the documents loaded by every transaction. `None`
+    means no limit.
+
+    The `policy` decides what happens once a limit is exceeded, the first
+    time per limit and transaction: `BUDGET_WARN` issues a
+    `TransactionBudgetWarning`, `BUDGET_LOG` logs a warning and
+    `BUDGET_RAISE` raises `TransactionBudgetExceeded`. The report names the
+    `call_sites` application frames that executed the most statements.
+    """
+
+    def __init__(self, max_statements=None, max_time=None, max_rows=None,
+                 max_documents=None, policy=BUDGET_WARN, call_sites=5):
+        self.max_statements = max_statements
+        self.max_time = max_time
+        self.max_rows = max_rows
+        self.max_documents = max_documents
+        self.policy = policy
+        self.call_sites = call_sites
+
+    def start(self):
+        """Return the `BudgetUsage` of a new transaction."""
+        return BudgetUsage(self)
+
+
+class BudgetUsage(object):
+    """The work done by one transaction, checked against its budget."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.statements = 0
+        self.time = 0.0
+        self.rows = 0
+        self.documents = 0
+        # call site -> number of statements
+        self.call_sites = collections.Counter()
+        # Names of the limits that were exceeded already.
+        self.exceeded = set()
+
+    def record_statement(self, duration, rows=0):
+        self.statements += 1
+        self.time += duration
+        self.rows += rows
+        self.call_sites[get_call_site(2)] += 1
+        self._check()
+
+    def record_rows(self, count):
+        self.rows += count
+        self._check()
+
+    def record_documents(self, count=1):
+        self.documents += count
+        self._check()
+
+    def _check(self):
+        budget = self.budget
+        exceeded = [
+            (name, used, limit) for name, used, limit in [
+                ('statements', self.statements, budget.max_statements),
+                ('time', self.time, budget.max_time),
+                ('rows', self.rows, budget.max_rows),
+                ('documents', self.documents, budget.max_documents)]
+            if limit is not None and used > limit and
+            name not in self.exceeded]
+        if not exceeded:
+            return
+        self.exceeded.update(name for name, used, limit in exceeded)
+        report = self.report(exceeded)
+        if budget.policy == BUDGET_RAISE:
+            raise interfaces.TransactionBudgetExceeded(report)
+        if budget.policy == BUDGET_LOG:
+            LOG.warning(report)
+        else:
+            warnings.warn(report, interfaces.TransactionBudgetWarning,
+                          stacklevel=4)
+
+    def report(self, exceeded=()):
+        """Return a report of the work done, naming the exceeded limits and
+        the top call sites."""
+        report = []
+        p = report.append
+        for name, used, limit in exceeded:
+            p("Transaction budget exceeded: %s %s (max %s)" % (
+                name, used, limit))
+        p("Statements: %s, time: %.4fms, rows: %s, documents: %s" % (
+            self.statements, self.time * 1000, self.rows, self.documents))
+        if self.call_sites:
+            p("Top call sites:")
+            for site, count in self.call_sites.most_common(
+                    self.budget.call_sites):
+                p("  %s statements: %s" % (count, site))
+        return "\n".join(report)
+
+
+# Number of times the same statement must be executed from the same call
+# site in one transaction to be reported by the NPlusOneDetector.
+N_PLUS_ONE_THRESHOLD = 10
+
+_POINT_QUERY_RE = re.compile(r'\bWHERE\s+(?:\w+\.)?id\s*=\s*\?',
+                             re.IGNORECASE)
+
+
+class NPlusOneDetector(object):
+    """Find statements executed in a loop.
+
+    Statements are grouped by their fingerprint and the application frame
+    executing them, see `get_call_site()`. Groups executed at least
+    `threshold` times are reported, most of them would be better served by
+    a single query, e.g. by loading the documents with
+    `PJDataManager.load_many()` or `WHERE id = ANY(...)`.
+    """
+
+    def __init__(self, threshold=None):
+        self.threshold = threshold or N_PLUS_ONE_THRESHOLD
+        self.clear()
+
+    def record(self, query, call_site=None):
+        if call_site is None:
+            call_site = get_call_site(2)
+        self.counts[(fingerprint(query), call_site)] += 1
+
+    def findings(self):
+        """Return the `NPlusOne` statements, the most frequent first."""
+        return [NPlusOne(fp, call_site, count)
+                for (fp, call_site), count in self.counts.most_common()
+                if count >= self.threshold]
+
+    def report(self):
+        """Return a report of the findings."""
+        report = []
+        p = report.append
+        for finding in self.findings():
+            p("Statement executed %s times from %s:" % (
+                finding.count, finding.call_site))
+            p("*** %s" % finding.fingerprint)
+            if _POINT_QUERY_RE.search(finding.fingerprint):
+                p("... Load the documents in bulk, e.g. with "
+                  "PJDataManager.load_many() or WHERE id = ANY(...)")
+        return "\n".join(report)
+
+    def clear(self):
+        # (fingerprint, call site) -> number of executions
+        self.counts = collections.Counter()
@@ -18,6 +18,8 @@ import logging
 import collections.abc
 import copyreg
 import datetime
+import functools
+import sys
 import warnings
 
 import persistent.interfaces
@@ -32,6 +34,17 @@ from pjpersist import interfaces
 LOG = logging.getLogger(__name__)
 
 ALWAYS_READ_FULL_DOC = True
+# When loading a document, read the documents of all its references, whose
+# class cannot be resolved without them, with one query per table.
+# Requires ALWAYS_READ_FULL_DOC.
+PREFETCH_REFERENCES = True
+# Do not write documents that did not change since they were loaded or
+# written last in the transaction.
+SKIP_UNCHANGED_WRITES = True
+# Only write the changed top-level keys of a document, when less than this
+# share of its keys changed since it was loaded or last written. Set to 0 to
+# always write full documents.
+PARTIAL_UPDATE_RATIO = 0.5
 
 SERIALIZERS = []
 AVAILABLE_NAME_MAPPINGS = set()
@@ -48,6 +61,11 @@ FMT_DATETIME_LENGTH = 26
 FMT_TIME_BBB = "%H:%M:%S"
 FMT_DATETIME_BBB = "%Y-%m-%dT%H:%M:%S"
 
+# The number of recently read date, time and datetime values whose objects
+# are kept, see `parse_datetime()`. Change it with `set_datetime_cache_size()`,
+# which rebuilds the caches.
+DATETIME_CACHE_SIZE = 4096
+
 # actually we should extract this somehow from psycopg2
 PYTHON_TO_PG_TYPES = {
     str: "text",
@@ -118,6 +136,51 @@ def get_dotted_name(obj, escape=False):
     return name
 
 
+def _parse_date(value):
+    """Read a date written with `FMT_DATE`."""
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        # Years shorter than 4 digits were not padded.
+        return datetime.datetime.strptime(value, FMT_DATE).date()
+
+
+def _parse_time(value):
+    """Read a time written with `FMT_TIME` and an optional UTC offset.
+
+    A `ValueError` is raised for other formats.
+    """
+    if value[8:9] == '.':
+        return datetime.time.fromisoformat(value)
+    return datetime.datetime.strptime(value, FMT_TIME).time()
+
+
+def _parse_datetime(value):
+    """Read a datetime written with `FMT_DATETIME` and an optional UTC offset.
+
+    `fromisoformat()` is much faster than `strptime()`, which is only used
+    for years that were not padded to 4 digits. A `ValueError` is raised for
+    other formats.
+    """
+    if value[19:20] == '.':
+        return datetime.datetime.fromisoformat(value)
+    return datetime.datetime.strptime(value, FMT_DATETIME)
+
+
+def set_datetime_cache_size(size):
+    """Set `DATETIME_CACHE_SIZE` and replace the caches of `parse_date()`,
+    `parse_time()` and `parse_datetime()` by empty ones of that size."""
+    global DATETIME_CACHE_SIZE, parse_date, parse_time, parse_datetime
+    DATETIME_CACHE_SIZE = size
+    cache = functools.lru_cache(maxsize=size)
+    parse_date = cache(_parse_date)
+    parse_time = cache(_parse_time)
+    parse_datetime = cache(_parse_datetime)
+
+
+set_datetime_cache_size(DATETIME_CACHE_SIZE)
+
+
 def link_to_parent(obj, pobj):
     if obj._p_jar is None:
         if pobj is not None and  getattr(pobj, '_p_jar', None) is not None:
@@ -161,15 +224,23 @@ class PersistentList(persistent.list.PersistentList):
 
 
 class DBRef(object):
+    __slots__ = ('_table', '_id', '_database', '_key', 'hash')
 
     def __init__(self, table, id, database=None):
+        # Table and database names are shared by many references.
+        if type(table) is str:
+            table = sys.intern(table)
+        if type(database) is str:
+            database = sys.intern(database)
         self._table = table
         self._id = id
         self._database = database
-        self.__calculate_hash()
+        self._key = (database, table, id)
+        self.hash = hash(self._key)
 
-    def __calculate_hash(self):
-        self.hash = hash(str(self.database)+str(self.table)+str(self.id))
+    def __calculate_key(self):
+        self._key = (self._database, self._table, self._id)
+        self.hash = hash(self._key)
 
     @property
     def database(self):
@@ -178,7 +249,7 @@ class DBRef(object):
     @database.setter
     def database(self, value):
         self._database = value
-        self.__calculate_hash()
+        self.__calculate_key()
 
     @property
     def table(self):
@@ -187,7 +258,7 @@ class DBRef(object):
     @table.setter
     def table(self, value):
         self._table = value
-        self.__calculate_hash()
+        self.__calculate_key()
 
     @property
     def id(self):
@@ -196,7 +267,7 @@ class DBRef(object):
     @id.setter
     def id(self, value):
         self._id = value
-        self.__calculate_hash()
+        self.__calculate_key()
 
     def __setstate__(self, state):
         self.__init__(state['table'], state['id'], state['database'])
@@ -211,7 +282,7 @@ class DBRef(object):
 
     def __eq__(self, other):
         try:
-            return self.hash == other.hash
+            return self._key == other._key
         except AttributeError:
             # `other` is not a DBRef or is None
             return False
@@ -220,7 +291,7 @@ class DBRef(object):
         return 'DBRef(%r, %r, %r)' %(self.table, self.id, self.database)
 
     def as_tuple(self):
-        return self.database, self.table, self.id
+        return self._key
 
     def as_json(self):
         return {'_py_type': 'DBREF',
@@ -234,6 +305,9 @@ class Binary(str):
 
 @zope.interface.implementer(interfaces.IObjectSerializer)
 class ObjectSerializer(object):
+    # The `_py_type` of the states the serializer reads. Serializers
+    # without it are asked for every state.
+    py_type = None
 
     def can_read(self, state):
         raise NotImplementedError
@@ -248,6 +322,23 @@ class ObjectSerializer(object):
         raise NotImplementedError
 
 
+class WriteDispatch(object):
+    """The methods `ObjectWriter.get_state()` uses by writer class and type.
+
+    The serializers of `SERIALIZERS` are not part of it, `get_state()` asks
+    them for every object first, since `can_write()` may look at the object.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.handlers = {}
+
+
+WRITE_DISPATCH = WriteDispatch()
+
+
 @zope.interface.implementer(interfaces.IObjectWriter)
 class ObjectWriter(object):
 
@@ -329,46 +420,101 @@ class ObjectWriter(object):
 
     def get_state(self, obj, pobj=None):
         objectType = type(obj)
-        __traceback_info__ = obj, objectType, pobj
         if objectType in interfaces.PJ_NATIVE_TYPES:
             # If we have a native type, we'll just use it as the state.
             return obj
-        if type(obj) == bytes:
-            return {
-                '_py_type': 'BINARY',
-                'data': base64.b64encode(obj).decode('ascii')
-            }
-        if type(obj) == str:
-            return obj
         # Some objects might not naturally serialize well and create a very
         # ugly JSONB entry. Thus, we allow custom serializers to be
         # registered, which can encode/decode different types of objects.
-        for serializer in SERIALIZERS:
-            if serializer.can_write(obj):
-                return serializer.write(obj)
+        if SERIALIZERS and objectType is not bytes:
+            for serializer in SERIALIZERS:
+                if serializer.can_write(obj):
+                    return serializer.write(obj)
+        handlers = WRITE_DISPATCH.handlers
+        key = (type(self), objectType)
+        try:
+            handler = handlers[key]
+        except KeyError:
+            handler = handlers[key] = self._get_state_handler(obj)
+        __traceback_info__ = obj, objectType, pobj
+        return handler(self, obj, pobj)
 
+    def _get_state_handler(self, obj):
+        # Find the method converting objects of the type of `obj`, the
+        # result is kept in `WRITE_DISPATCH` for the class of this writer,
+        # since subclasses may override the methods.
+        objectType = type(obj)
+        cls = type(self)
+        if objectType == bytes:
+            return cls._get_binary_state
         if objectType == datetime.date:
-            return {'_py_type': 'datetime.date',
-                    'value': obj.strftime(FMT_DATE).zfill(FMT_DATE_LENGTH)}
+            return cls._get_date_state
         if objectType == datetime.time:
-            return {'_py_type': 'datetime.time',
-                    'value': obj.strftime(FMT_TIME)}
+            return cls._get_time_state
         if objectType == datetime.datetime:
-            return {'_py_type': 'datetime.datetime',
-                    'value': obj.strftime(FMT_DATETIME).zfill(FMT_DATETIME_LENGTH)}
+            return cls._get_datetime_state
 
         # Let's handle only specific MappingView subclasses for now
         if objectType in COLLECTIONS_ABC_MAPPINGVIEWS:
-            # Just convert all such objects to a list
-            # That was anyway the python 2.x behavior for mapping (keys|values|items)
-            return self.get_state(list(obj))
+            return cls._get_mapping_view_state
 
         if isinstance(obj, type):
-            # We frequently store class and function paths as meta-data, so we
-            # need to be able to properly encode those.
-            return {'_py_type': 'type',
-                    'path': get_dotted_name(obj)}
+            return cls._get_type_state
 
+        if objectType in (tuple, list):
+            return cls._get_sequence_state
+        if objectType == dict:
+            return cls._get_mapping_state
+
+        if isinstance(obj, (tuple, list, PersistentList)):
+            handler = cls._get_sequence_state
+        elif isinstance(obj, (dict, PersistentDict)):
+            handler = cls._get_mapping_state
+        elif isinstance(obj, persistent.Persistent):
+            handler = cls._get_persistent_or_sub_object_state
+        else:
+            handler = cls._get_reduced_state
+
+        def get_state(self, obj, pobj):
+            self._set_doc_object(obj, pobj)
+            return handler(self, obj, pobj)
+        return get_state
+
+    def _get_binary_state(self, obj, pobj):
+        return {
+            '_py_type': 'BINARY',
+            'data': base64.b64encode(obj).decode('ascii')
+        }
+
+    # The ISO formats are the same as `FMT_DATE`, `FMT_TIME` and
+    # `FMT_DATETIME` with a padded year, followed by the UTC offset of
+    # timezone aware values.
+
+    def _get_date_state(self, obj, pobj):
+        return {'_py_type': 'datetime.date',
+                'value': obj.isoformat()}
+
+    def _get_time_state(self, obj, pobj):
+        return {'_py_type': 'datetime.time',
+                'value': obj.isoformat(timespec='microseconds')}
+
+    def _get_datetime_state(self, obj, pobj):
+        return {'_py_type': 'datetime.datetime',
+                'value': obj.isoformat(timespec='microseconds')}
+
+    def _get_mapping_view_state(self, obj, pobj):
+        # Just convert all such objects to a list
+        # That was anyway the python 2.x behavior for mapping
+        # (keys|values|items)
+        return self.get_state(list(obj))
+
+    def _get_type_state(self, obj, pobj):
+        # We frequently store class and function paths as meta-data, so we
+        # need to be able to properly encode those.
+        return {'_py_type': 'type',
+                'path': get_dotted_name(obj)}
+
+    def _set_doc_object(self, obj, pobj):
         # We need to make sure that the object's jar and doc-object are
         # set. This is important for the case when a sub-object was just
         # added.
@@ -379,40 +525,43 @@ class ObjectWriter(object):
                     obj._p_jar = pobj._p_jar
                 setattr(obj, interfaces.DOC_OBJECT_ATTR_NAME, pobj)
 
-        if isinstance(obj, (tuple, list, PersistentList)):
-            # Make sure that all values within a list are serialized
-            # correctly. Also convert any sequence-type to a simple list.
-            return [self.get_state(value, pobj) for value in obj]
-        if isinstance(obj, (dict, PersistentDict)):
-            # Same as for sequences, make sure that the contained values are
-            # properly serialized.
-            # Note: see comments at the definition of DICT_NON_STRING_KEY_MARKER
-            has_non_compliant_key = False
-            data = []
-            for key, value in obj.items():
-                data.append((key, self.get_state(value, pobj)))
-                if (not isinstance(key, str) or  # non-string
-                        # a key with our special marker
-                        key==DICT_NON_STRING_KEY_MARKER):
-                    has_non_compliant_key = True
-            if not has_non_compliant_key:
-                # The easy case: all keys are compliant:
-                return dict(data)
-            else:
-                # We first need to reduce the keys and then produce a data
-                # structure.
-                data = [(self.get_state(key, pobj), value)
-                        for key, value in data]
-                return {DICT_NON_STRING_KEY_MARKER: data}
-
-        if isinstance(obj, persistent.Persistent):
-            # Only create a persistent reference, if the object does not want
-            # to be a sub-document.
-            if not getattr(obj, interfaces.SUB_OBJECT_ATTR_NAME, False):
-                return self.get_persistent_state(obj)
-            # This persistent object is a sub-document, so it is treated like
-            # a non-persistent object.
-
+    def _get_sequence_state(self, obj, pobj):
+        # Make sure that all values within a list are serialized
+        # correctly. Also convert any sequence-type to a simple list.
+        return [self.get_state(value, pobj) for value in obj]
+
+    def _get_mapping_state(self, obj, pobj):
+        # Same as for sequences, make sure that the contained values are
+        # properly serialized.
+        # Note: see comments at the definition of DICT_NON_STRING_KEY_MARKER
+        has_non_compliant_key = False
+        data = []
+        for key, value in obj.items():
+            data.append((key, self.get_state(value, pobj)))
+            if (not isinstance(key, str) or  # non-string
+                    # a key with our special marker
+                    key==DICT_NON_STRING_KEY_MARKER):
+                has_non_compliant_key = True
+        if not has_non_compliant_key:
+            # The easy case: all keys are compliant:
+            return dict(data)
+        else:
+            # We first need to reduce the keys and then produce a data
+            # structure.
+            data = [(self.get_state(key, pobj), value)
+                    for key, value in data]
+            return {DICT_NON_STRING_KEY_MARKER: data}
+
+    def _get_persistent_or_sub_object_state(self, obj, pobj):
+        # Only create a persistent reference, if the object does not want
+        # to be a sub-document.
+        if not getattr(obj, interfaces.SUB_OBJECT_ATTR_NAME, False):
+            return self.get_persistent_state(obj)
+        # This persistent object is a sub-document, so it is treated like
+        # a non-persistent object.
+        return self._get_reduced_state(obj, pobj)
+
+    def _get_reduced_state(self, obj, pobj):
         try:
             res = self.get_non_persistent_state(obj)
         except RuntimeError as re:
@@ -454,13 +603,14 @@ class ObjectWriter(object):
             # We only want to get OID quickly. Trying to reduce the full state
             # might cause infinite recursion loop. (Example: 2 new objects
             # reference each other.)
-            doc = {}
+            # So we just allocate the id, the document is inserted with its
+            # full state by the next flush.
+            obj._p_oid = DBRef(table_name, self._jar.createId(), db_name)
+            self._jar._object_cache[obj._p_oid.as_tuple()] = obj
+            self._jar._pending_inserts[obj._p_oid] = obj
             # Make sure that the object gets saved fully later.
             self._jar.register(obj)
-
-            #doc_id = self._jar.createId()
-            #oid = DBRef(table_name, doc_id, db_name)
-            #return oid
+            return obj._p_oid
         else:
             # XXX: Handle newargs; see ZODB.serialize.ObjectWriter.serialize
             # Go through each attribute and search for persistent references.
@@ -482,13 +632,42 @@ class ObjectWriter(object):
             obj._p_oid = DBRef(table_name, doc_id, db_name)
             # Make sure that any other code accessing this object in this
             # session, gets the same instance.
-            self._jar._object_cache[hash(obj._p_oid)] = obj
-        else:
-            self._jar._update_doc(
+            self._jar._object_cache[obj._p_oid.as_tuple()] = obj
+        elif self._jar._pending_inserts.pop(obj._p_oid, None) is not None:
+            # The id was allocated when the object was first referenced, now
+            # we write its document for the first time.
+            self._jar._insert_doc(
                 db_name, table_name, doc, obj._p_oid.id, column_data)
             stored = True
+        elif (SKIP_UNCHANGED_WRITES and column_data is None and
+              is_same_doc(doc, self._jar._latest_states.get(obj._p_oid))):
+            # The object was marked as changed, but its document is the same
+            # as the one in the database, save the UPDATE.
+            self._jar.skipped_writes += 1
+        else:
+            latest = self._jar._latest_states.get(obj._p_oid)
+            changed = removed = None
+            if (PARTIAL_UPDATE_RATIO and column_data is None
+                    and latest is not None):
+                changed, removed = diff_doc(doc, latest)
+                if (len(changed) + len(removed) >=
+                        PARTIAL_UPDATE_RATIO * len(doc)):
+                    changed = removed = None
+            if removed is not None:
+                self._jar._update_doc(
+                    db_name, table_name, changed, obj._p_oid.id,
+                    removed=removed)
+            else:
+                self._jar._update_doc(
+                    db_name, table_name, doc, obj._p_oid.id, column_data)
+            stored = True
         # let's call the hook here, to always have _p_jar and _p_oid set
         if interfaces.IPersistentSerializationHooks.providedBy(obj):
+            # The hook expects the document to be in the database already,
+            # so write out any documents collected by a flush and wait for
+            # the writes in the background.
+            self._jar._flush_write_batch()
+            self._jar._wait_for_writes()
             obj._pj_after_store_hook(self._jar._conn)
 
         if stored:
@@ -498,6 +677,37 @@ class ObjectWriter(object):
         return obj._p_oid
 
 
+def is_same_doc(doc, other):
+    """Check whether two documents result in the same JSON.
+
+    Unlike `==` this does not consider `1`, `1.0` and `True` to be equal.
+    """
+    if doc != other:
+        return False
+    if type(doc) is not type(other):
+        return False
+    if isinstance(doc, dict):
+        return all(is_same_doc(value, other[key])
+                   for key, value in doc.items())
+    if isinstance(doc, list):
+        return all(is_same_doc(value, other_value)
+                   for value, other_value in zip(doc, other))
+    return True
+
+
+def diff_doc(doc, other):
+    """Return the top-level keys changed and removed in `doc` compared to
+    `other`.
+
+    The changed keys are returned as a dict with their new values, the
+    removed keys as a list.
+    """
+    changed = {key: value for key, value in doc.items()
+               if key not in other or not is_same_doc(value, other[key])}
+    removed = [key for key in other if key not in doc]
+    return changed, removed
+
+
 @zope.interface.implementer(interfaces.IObjectReader)
 class ObjectReader(object):
 
@@ -617,72 +827,20 @@ class ObjectReader(object):
         return sub_obj
 
     def get_object(self, state, obj):
-        # stateIsDict and state_py_type: optimization to avoid X lookups
-        # the code was:
-        # if isinstance(state, dict) and state.get('_py_type') == 'DBREF':
         # this methods gets called a gazillion times, so being fast is crucial
+        dispatch = READ_DISPATCH
+        if (dispatch.serializers is not SERIALIZERS or
+                dispatch.count != len(SERIALIZERS)):
+            dispatch.reset()
         stateIsDict = isinstance(state, dict)
         if stateIsDict:
-            state_py_type = state.get('_py_type')
-            if state_py_type == 'BINARY':
-                # Binary data in Python 2 is presented as a string. We will
-                # convert back to binary when serializing again.
-                return base64.b64decode(state['data'])
-            if state_py_type == 'DBREF':
-                # Load a persistent object. Using the _jar.load() method to make
-                # sure we're loading from right database and caching is properly
-                # applied.
-                dbref = DBRef(state['table'], state['id'], state['database'])
-                return self._jar.load(dbref)
-            if state_py_type == 'type':
-                # Convert a simple object reference, mostly classes.
-                return self.simple_resolve(state['path'])
-            if state_py_type == 'datetime.date':
-                return datetime.datetime.strptime(
-                    state['value'], FMT_DATE).date()
-            if state_py_type == 'datetime.time':
-                try:
-                    return datetime.datetime.strptime(
-                        state['value'], FMT_TIME).time()
-                except ValueError:
-                    # BBB: We originally did not track sub-seconds.
-                    warnings.warn(
-                        "Data in old time format found. Support for the "
-                        "old format will be removed in pjpersist 2.0.",
-                        DeprecationWarning)
-                    return datetime.datetime.strptime(
-                        state['value'], FMT_TIME_BBB).time()
-            if state_py_type == 'datetime.datetime':
-                try:
-                    return datetime.datetime.strptime(
-                        state['value'], FMT_DATETIME)
-                except ValueError:
-                    # BBB: We originally did not track sub-seconds.
-                    warnings.warn(
-                        "Data in old date/time format found. Support for the "
-                        "old format will be removed in pjpersist 2.0.",
-                        DeprecationWarning)
-                    return datetime.datetime.strptime(
-                        state['value'], FMT_DATETIME_BBB)
-            if state_py_type in COLLECTIONS_ABC_MAPPINGVIEWS_STR:
-                klass = self.simple_resolve(state_py_type)
-                if '_mapping' in state:
-                    # Leaving this around, just in case we decide to persist the real
-                    # view object or find something with state
-                    sub_obj = self.get_object(state['_mapping'], obj)
-                else:
-                    # BBB: We previously FAILED to store the mapping state itself.
-                    #      Provide something that does not break the world and log.
-                    #      Do not raise an exception, that would break object loading.
-                    sub_obj = {}
-                    # How to provide more info on the state?
-                    # A traceback would be nice, but that sounds too involved
-                    LOG.error(
-                        "Found a broken %s state, returning empty {}", state_py_type)
-                return klass(sub_obj)
-
-        # Give the custom serializers a chance to weigh in.
-        for serializer in SERIALIZERS:
+            handler = dispatch.handlers.get(state.get('_py_type'))
+            if handler is not None:
+                return handler(self, state, obj)
+
+        # Give the custom serializers without a `py_type` a chance to weigh
+        # in.
+        for serializer in dispatch.fallback:
             if serializer.can_read(state):
                 return serializer.read(state)
 
@@ -736,6 +894,90 @@ class ObjectReader(object):
             return sub_obj
         return state
 
+    def _get_binary(self, state, obj):
+        # Binary data in Python 2 is presented as a string. We will
+        # convert back to binary when serializing again.
+        return base64.b64decode(state['data'])
+
+    def _get_dbref_object(self, state, obj):
+        # Load a persistent object. Using the _jar.load() method to make
+        # sure we're loading from right database and caching is properly
+        # applied.
+        dbref = DBRef(state['table'], state['id'], state['database'])
+        return self._jar.load(dbref)
+
+    def _get_type(self, state, obj):
+        # Convert a simple object reference, mostly classes.
+        return self.simple_resolve(state['path'])
+
+    def _get_date(self, state, obj):
+        return parse_date(state['value'])
+
+    def _get_time(self, state, obj):
+        try:
+            return parse_time(state['value'])
+        except ValueError:
+            # BBB: We originally did not track sub-seconds.
+            warnings.warn(
+                "Data in old time format found. Support for the "
+                "old format will be removed in pjpersist 2.0.",
+                DeprecationWarning)
+            return datetime.datetime.strptime(
+                state['value'], FMT_TIME_BBB).time()
+
+    def _get_datetime(self, state, obj):
+        try:
+            return parse_datetime(state['value'])
+        except ValueError:
+            # BBB: We originally did not track sub-seconds.
+            warnings.warn(
+                "Data in old date/time format found. Support for the "
+                "old format will be removed in pjpersist 2.0.",
+                DeprecationWarning)
+            return datetime.datetime.strptime(
+                state['value'], FMT_DATETIME_BBB)
+
+    def _get_mapping_view(self, state, obj):
+        state_py_type = state['_py_type']
+        klass = self.simple_resolve(state_py_type)
+        if '_mapping' in state:
+            # Leaving this around, just in case we decide to persist the real
+            # view object or find something with state
+            sub_obj = self.get_object(state['_mapping'], obj)
+        else:
+            # BBB: We previously FAILED to store the mapping state itself.
+            #      Provide something that does not break the world and log.
+            #      Do not raise an exception, that would break object loading.
+            sub_obj = {}
+            # How to provide more info on the state?
+            # A traceback would be nice, but that sounds too involved
+            LOG.error(
+                "Found a broken %s state, returning empty {}", state_py_type)
+        return klass(sub_obj)
+
+    def prefetch_references(self, state):
+        # Resolving a reference to a table holding several classes requires
+        # its document, so read all of them at once instead of one by one.
+        dbrefs = []
+        self._collect_unresolved_refs(state, dbrefs)
+        if len(dbrefs) > 1:
+            self._jar._prefetch_docs(dbrefs)
+
+    def _collect_unresolved_refs(self, state, dbrefs):
+        if isinstance(state, dict):
+            if state.get('_py_type') == 'DBREF':
+                dbref = DBRef(state['table'], state['id'], state['database'])
+                klasses = TABLE_KLASS_MAP.get(dbref.table)
+                if ((klasses is None or len(klasses) != 1)
+                        and self._jar._get_cached_object(dbref) is None):
+                    dbrefs.append(dbref)
+                return
+            for value in state.values():
+                self._collect_unresolved_refs(value, dbrefs)
+        elif isinstance(state, list):
+            for value in state:
+                self._collect_unresolved_refs(value, dbrefs)
+
     def set_ghost_state(self, obj, doc=None):
         __traceback_info__ = (obj, doc)
         # Check whether the object state was stored on the object itself.
@@ -747,10 +989,16 @@ class ObjectReader(object):
         # Check that we really have a state doc now.
         if doc is None:
             raise ImportError(obj._p_oid)
-        # Remove unwanted attributes.
-        doc.pop(interfaces.PY_TYPE_ATTR_NAME, None)
+        # Remove unwanted attributes. The doc itself must not be changed,
+        # since it might be shared with the document cache.
+        state_doc = doc
+        if interfaces.PY_TYPE_ATTR_NAME in doc:
+            state_doc = dict(doc)
+            del state_doc[interfaces.PY_TYPE_ATTR_NAME]
+        if ALWAYS_READ_FULL_DOC and PREFETCH_REFERENCES:
+            self.prefetch_references(state_doc)
         # Now convert the document to a proper Python state dict.
-        state = dict(self.get_object(doc, obj))
+        state = dict(self.get_object(state_doc, obj))
         if obj._p_oid not in self._jar._latest_states:
             # Sometimes this method is called to update the object state
             # before storage. Only update the latest states when the object is
@@ -765,9 +1013,12 @@ class ObjectReader(object):
     def get_ghost(self, dbref, klass=None):
         # If we can, we return the object from cache.
         try:
-            return self._jar._object_cache[hash(dbref)]
+            return self._jar._object_cache[dbref.as_tuple()]
         except KeyError:
             pass
+        obj = self._jar._weak_object_cache.get(dbref.as_tuple())
+        if obj is not None:
+            return obj
         if klass is None:
             klass = self.resolve(dbref)
         obj = klass.__new__(klass)
@@ -780,10 +1031,57 @@ class ObjectReader(object):
         setattr(obj, interfaces.TABLE_ATTR_NAME, dbref.table)
         # Adding the object to the cache is very important, so that we get the
         # same object reference throughout the transaction.
-        self._jar._object_cache[hash(dbref)] = obj
+        self._jar._object_cache[dbref.as_tuple()] = obj
         return obj
 
 
+# The conversions of `ObjectReader.get_object()` by the `_py_type` of the
+# state.
+PY_TYPE_READERS = {
+    'BINARY': ObjectReader._get_binary,
+    'DBREF': ObjectReader._get_dbref_object,
+    'type': ObjectReader._get_type,
+    'datetime.date': ObjectReader._get_date,
+    'datetime.time': ObjectReader._get_time,
+    'datetime.datetime': ObjectReader._get_datetime,
+}
+for _py_type in COLLECTIONS_ABC_MAPPINGVIEWS_STR:
+    PY_TYPE_READERS[_py_type] = ObjectReader._get_mapping_view
+
+
+class ReadDispatch(object):
+    """The conversions `ObjectReader.get_object()` uses by `_py_type`.
+
+    Serializers of `SERIALIZERS` with a `py_type` are added to
+    `PY_TYPE_READERS`, replacing the built-in conversion of the `_py_type`,
+    the first one registered wins. The other serializers are asked for
+    every state. The handlers are reset when serializers are added or
+    removed.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.handlers = dict(PY_TYPE_READERS)
+        self.fallback = []
+        py_types = set()
+        for serializer in SERIALIZERS:
+            py_type = getattr(serializer, 'py_type', None)
+            if py_type is None:
+                self.fallback.append(serializer)
+            elif py_type not in py_types:
+                py_types.add(py_type)
+                self.handlers[py_type] = (
+                    lambda self, state, obj, serializer=serializer:
+                        serializer.read(state))
+        self.serializers = SERIALIZERS
+        self.count = len(SERIALIZERS)
+
+
+READ_DISPATCH = ReadDispatch()
+
+
 class table(object):
     """Declare the table used by the class.
 
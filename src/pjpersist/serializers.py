@@ -18,6 +18,7 @@ from pjpersist import serialize
 
 class DateSerializer(serialize.ObjectSerializer):
 
+    py_type = 'datetime.date'
     fmt = "%Y-%m-%d"
     fmtLength = 10
 
@@ -38,6 +39,7 @@ class DateSerializer(serialize.ObjectSerializer):
 
 class TimeSerializer(serialize.ObjectSerializer):
 
+    py_type = 'datetime.time'
     fmt = "%H:%M:%S"
 
     def can_read(self, state):
@@ -57,6 +59,7 @@ class TimeSerializer(serialize.ObjectSerializer):
 
 class DateTimeSerializer(serialize.ObjectSerializer):
 
+    py_type = 'datetime.datetime'
     # XXX: timezone?
     fmt = "%Y-%m-%dT%H:%M:%S"
     fmtLength = 19
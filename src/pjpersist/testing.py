@@ -67,6 +67,7 @@ class DummyConnectionPool:
         if self._available is None:
             raise psycopg2.pool.PoolError("Connection is already taken")
         self._available.reset()
+        datamanager.forget_prepared_statements(self._available)
         self._available.set_isolation_level(
             psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE)
         self._taken = self._available
@@ -101,6 +102,14 @@ def getConnection(database=None):
     return conn
 
 
+async def getAsyncConnection(database=None):
+    from pjpersist import aio
+    return await aio.connect(
+        database=database or 'template1',
+        host='localhost', port=5432,
+        user='pjpersist', password='pjpersist')
+
+
 def createDB():
     dropDB()
     conn = getConnection()
@@ -137,6 +146,7 @@ def cleanDB(conn=None):
             if not res[0].startswith('pg_') and not res[0].startswith('sql_'):
                 cur.execute('DROP TABLE ' + res[0])
     conn.commit()
+    datamanager.forget_known_tables()
 
 
 def setUpSerializers(test):
@@ -249,6 +259,7 @@ def resetCaches():
     serialize.AVAILABLE_NAME_MAPPINGS.__init__()
     serialize.PATH_RESOLVE_CACHE = {}
     serialize.TABLE_KLASS_MAP = {}
+    datamanager.forget_known_tables()
 
 
 def log_sql_to_file(fname, add_tb=True, tb_limit=15):
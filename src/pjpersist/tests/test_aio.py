@@ -0,0 +1,136 @@
+##############################################################################
+#
+# Copyright (c) 2014 Shoobx, Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""asyncio support tests"""
+import asyncio
+import doctest
+
+import persistent
+
+from pjpersist import aio, serialize, testing
+
+
+@serialize.table('aio_foo')
+class Foo(persistent.Persistent):
+
+    def __init__(self, name=None):
+        self.name = name
+
+
+def doctest_AsyncPJDataManager():
+    r"""AsyncPJDataManager: persistence for asyncio applications
+
+      >>> run = asyncio.run
+      >>> aconn = run(testing.getAsyncConnection(testing.DBNAME))
+      >>> adm = aio.AsyncPJDataManager(aconn)
+
+    Tables are not created automatically:
+
+      >>> run(adm.acreate_tables('aio_foo'))
+
+    Objects are inserted and written when the transaction is committed:
+
+      >>> foo = Foo('one')
+      >>> foo.friend = Foo('two')
+      >>> foo_ref = run(adm.ainsert(foo))
+      >>> run(adm.acommit())
+      >>> sorted(row['data']['name'] for row in dumpTable('aio_foo'))
+      ['one', 'two']
+
+    Loading an object reads its document:
+
+      >>> foo = run(adm.aload(foo_ref))
+      >>> foo.name
+      'one'
+
+    Documents of referenced objects must be loaded before they are used:
+
+      >>> foo.friend.name
+      Traceback (most recent call last):
+      ...
+      pjpersist.aio.NotLoadedError: DBRef('aio_foo', '...', 'pjpersist_test')
+      >>> run(adm.aprefetch([foo.friend]))
+      >>> foo.friend.name
+      'two'
+
+    Changed objects are written by `aflush()` and before queries:
+
+      >>> foo.name = 'ONE'
+      >>> async def names():
+      ...     cur = await adm.aexecute(
+      ...         "SELECT data->>'name' AS name FROM aio_foo ORDER BY 1")
+      ...     return [row['name'] for row in cur.fetchall()]
+      >>> run(names())
+      ['ONE', 'two']
+
+    The transaction can be aborted:
+
+      >>> run(adm.aabort())
+      >>> run(names())
+      ['one', 'two']
+
+    Big results can be read in chunks:
+
+      >>> async def iterate():
+      ...     return [row['data']['name'] async for row in adm.aiterate(
+      ...         "SELECT data FROM aio_foo ORDER BY data->>'name'", itersize=1)]
+      >>> run(iterate())
+      ['one', 'two']
+
+    Objects are removed right away:
+
+      >>> foo = run(adm.aload(foo_ref))
+      >>> run(adm.aremove(foo))
+      >>> run(adm.acommit())
+      >>> [row['data']['name'] for row in dumpTable('aio_foo')]
+      ['two']
+
+    Blocking access is not possible:
+
+      >>> adm.getCursor()
+      Traceback (most recent call last):
+      ...
+      NotImplementedError: AsyncPJDataManager cannot execute blocking
+      statements, use aexecute().
+
+      >>> run(adm.aclose())
+    """
+
+
+def setUp(test):
+    testing.setUp(test)
+
+    def rows(table):
+        # dumpTable prints, return the rows instead.
+        with test.globs['conn'].cursor() as cur:
+            cur.execute('SELECT data FROM ' + table)
+            rows = [{'data': row[0]} for row in cur.fetchall()]
+        test.globs['conn'].rollback()
+        return rows
+    test.globs['dumpTable'] = rows
+
+
+def tearDown(test):
+    aconn = test.globs.get('aconn')
+    if aconn is not None and not aconn.closed:
+        aconn.close()
+    testing.tearDown(test)
+
+
+def test_suite():
+    suite = doctest.DocTestSuite(
+        setUp=setUp, tearDown=tearDown,
+        checker=testing.checker,
+        optionflags=testing.OPTIONFLAGS)
+    suite.layer = testing.db_layer
+    return suite
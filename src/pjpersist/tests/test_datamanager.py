@@ -22,6 +22,7 @@ from pprint import pprint
 
 import transaction
 import mock
+import zope.interface
 
 from pjpersist import interfaces, serialize, testing, datamanager
 
@@ -70,6 +71,21 @@ class FooItem(object):
         self.bar = 6
 
 
+@zope.interface.implementer(interfaces.IPersistentSerializationHooks)
+class HookedFoo(Foo):
+    # The names in the database, when the store hook is called.
+    stored_names = []
+
+    def _pj_after_store_hook(self, conn):
+        with conn.cursor() as cur:
+            cur.execute('SELECT data FROM %s WHERE id = %%s' % (
+                self._p_oid.table), (self._p_oid.id,))
+            self.stored_names.append(cur.fetchone()[0]['name'])
+
+    def _pj_after_load_hook(self, conn):
+        pass
+
+
 class ComplexFoo(persistent.Persistent):
     def __init__(self):
         self.item = FooItem()
@@ -248,6 +264,952 @@ def doctest_PJDataManager_flush():
         False
     """
 
+
+def doctest_PJDataManager_flush_batched():
+    r"""PJDataManager: flush() writes documents of a table in batches
+
+      >>> foos = [Foo('foo-%i' % i) for i in range(5)]
+      >>> for foo in foos:
+      ...     foo_ref = dm.insert(foo)
+      >>> dm.commit(None)
+
+    Let's modify all objects:
+
+      >>> foos = [dm.load(foo._p_oid) for foo in foos]
+      >>> for foo in foos:
+      ...     foo.name = foo.name.upper()
+
+    All the changes are written with a single statement:
+
+      >>> from pjpersist.querystats import QueryReport
+      >>> report = QueryReport()
+      >>> datamanager.register_query_stats_listener(report)
+      >>> dm.flush()
+      >>> datamanager.unregister_query_stats_listener(report)
+
+      >>> [q.query.split(' FROM ')[0] for q in report.qlog
+      ...  if not q.query.startswith('SAVEPOINT')]
+      ['UPDATE pjpersist_dot_tests_dot_test_datamanager_dot_Foo
+        SET data = v.data']
+
+      >>> dm.commit(None)
+      >>> sorted(dm.load(foo._p_oid).name for foo in foos)
+      ['FOO-0', 'FOO-1', 'FOO-2', 'FOO-3', 'FOO-4']
+
+    The batch size can be limited:
+
+      >>> for foo in foos:
+      ...     foo.name = foo.name.lower()
+
+      >>> report.clear()
+      >>> datamanager.register_query_stats_listener(report)
+      >>> with mock.patch('pjpersist.datamanager.FLUSH_BATCH_SIZE', 2):
+      ...     dm.flush()
+      >>> datamanager.unregister_query_stats_listener(report)
+
+      >>> len([q for q in report.qlog if q.query.startswith('UPDATE')])
+      3
+
+      >>> dm.commit(None)
+      >>> sorted(dm.load(foo._p_oid).name for foo in foos)
+      ['foo-0', 'foo-1', 'foo-2', 'foo-3', 'foo-4']
+    """
+
+def doctest_PJDataManager_flush_new_references():
+    r"""PJDataManager: flush() inserts referenced new objects once
+
+    New persistent objects that are only referenced by another object get
+    their id allocated first, their full document is inserted by the flush:
+
+      >>> foo = dm.load(dm.insert(Foo('foo')))
+      >>> sup_ref = dm.insert(Super('super'))
+      >>> dm.commit(None)
+
+      >>> foo = dm.load(foo._p_oid)
+      >>> foo.supers = [Super('super-%i' % i) for i in range(3)]
+
+      >>> from pjpersist.querystats import QueryReport
+      >>> report = QueryReport()
+      >>> datamanager.register_query_stats_listener(report)
+      >>> dm.flush()
+      >>> datamanager.unregister_query_stats_listener(report)
+
+      >>> [q.query.split(' VALUES ')[0].split(' SET ')[0] for q in report.qlog
+      ...  if not q.query.startswith('SAVEPOINT')]
+      ['INSERT INTO Super (id, data)',
+       'UPDATE pjpersist_dot_tests_dot_test_datamanager_dot_Foo']
+
+      >>> dm.commit(None)
+      >>> [sup.name for sup in dm.load(foo._p_oid).supers]
+      ['super-0', 'super-1', 'super-2']
+    """
+
+def doctest_PJDataManager_shared_document_cache():
+    r"""PJDataManager: documents can be shared between transactions
+
+      >>> from pjpersist import doccache
+      >>> cache = doccache.DocumentCache()
+      >>> patcher = mock.patch(
+      ...     'pjpersist.datamanager.SHARED_DOCUMENT_CACHE', cache)
+      >>> _ = patcher.start()
+
+      >>> foo_ref = dm.insert(Foo('foo'))
+      >>> dm.commit(None)
+
+    The first load reads the document and caches it:
+
+      >>> dm.load(foo_ref).name
+      'foo'
+      >>> cache.hits, cache.misses
+      (0, 1)
+      >>> dm.commit(None)
+
+    The next transaction only checks that the row did not change and uses
+    the cached document:
+
+      >>> dm.load(foo_ref).name
+      'foo'
+      >>> cache.hits, cache.misses
+      (1, 1)
+      >>> dm.commit(None)
+
+    When the row is changed by someone else, the new document is read:
+
+      >>> with conn.cursor() as cur:
+      ...     cur.execute(
+      ...         "UPDATE pjpersist_dot_tests_dot_test_datamanager_dot_Foo "
+      ...         "SET data = jsonb_set(data, '{name}', '\"bar\"')")
+      >>> conn.commit()
+
+      >>> dm.load(foo_ref).name
+      'bar'
+      >>> cache.hits, cache.misses
+      (1, 2)
+
+    Writing the document ourselves drops it from the cache:
+
+      >>> dm.load(foo_ref).name = 'baz'
+      >>> dm.commit(None)
+      >>> (foo_ref.database, foo_ref.table, foo_ref.id) in cache
+      False
+      >>> dm.load(foo_ref).name
+      'baz'
+
+    The size of an entry is the length of the document's JSON text, even
+    when the database stores it compressed:
+
+      >>> big = Foo('x' * 100000)
+      >>> big_ref = dm.insert(big)
+      >>> dm.commit(None)
+      >>> with conn.cursor() as cur:
+      ...     cur.execute(
+      ...         "SELECT pg_column_size(data) < 10000, "
+      ...         "octet_length(data::text) "
+      ...         "FROM pjpersist_dot_tests_dot_test_datamanager_dot_Foo "
+      ...         "WHERE id = %s", (big_ref.id,))
+      ...     cur.fetchone()
+      (True, 100075)
+      >>> before = cache.size
+      >>> len(dm.load(big_ref).name)
+      100000
+      >>> cache.size - before
+      100075
+
+    A cached document is only used when its version matches the row of
+    the same id, not the version of any other row loaded with it:
+
+      >>> one_ref = dm.insert(Foo('one'))
+      >>> two_ref = dm.insert(Foo('two'))
+      >>> dm.commit(None)
+      >>> one, two = dm.load_many([one_ref, two_ref])
+      >>> one.name, two.name
+      ('one', 'two')
+      >>> dm.commit(None)
+      >>> one_key = (one_ref.database, one_ref.table, one_ref.id)
+      >>> two_key = (two_ref.database, two_ref.table, two_ref.id)
+      >>> one_version = cache.get(one_key)[0]
+      >>> two_version = cache.get(two_key)[0]
+      >>> cache.put(one_key, two_version, {'name': 'stale'}, 10)
+      >>> cache.put(two_key, one_version, {'name': 'stale'}, 10)
+      >>> two, one = dm.load_many([two_ref, one_ref])
+      >>> one.name, two.name
+      ('one', 'two')
+      >>> dm.commit(None)
+
+    Entries without a known size are not cached:
+
+      >>> cache.put(('db', 'tbl', 'x'), 'v', {'name': 'x'}, None)
+      >>> ('db', 'tbl', 'x') in cache
+      False
+
+      >>> _ = patcher.stop()
+    """
+
+def doctest_PJDataManager_load_many():
+    r"""PJDataManager: load_many(dbrefs), prefetch(objs)
+
+      >>> refs = [dm.insert(Foo('foo-%i' % i)) for i in range(3)]
+      >>> refs.append(dm.insert(Super('super')))
+      >>> refs.append(dm.insert(Sub('sub')))
+      >>> dm.commit(None)
+
+    All documents are read with one query per table:
+
+      >>> from pjpersist.querystats import QueryReport
+      >>> report = QueryReport()
+      >>> datamanager.register_query_stats_listener(report)
+      >>> objs = dm.load_many(refs)
+      >>> [q.query for q in report.qlog]
+      ['SELECT id, data FROM pjpersist_dot_tests_dot_test_datamanager_dot_Foo
+        WHERE id = ANY(%s)',
+       'SELECT id, data FROM Super WHERE id = ANY(%s)']
+
+    The objects are ghosts of the right class, activating them does not query
+    the database:
+
+      >>> [obj._p_changed for obj in objs]
+      [None, None, None, None, None]
+      >>> objs
+      [<Foo foo-0>, <Foo foo-1>, <Foo foo-2>, <Super super>, <Sub sub>]
+      >>> len(report.qlog)
+      2
+      >>> dm.commit(None)
+
+    `prefetch()` activates existing ghosts the same way:
+
+      >>> report.clear()
+      >>> ghosts = [dm.load(ref, Foo) for ref in refs[:3]]
+      >>> dm.prefetch(ghosts)
+      >>> [obj._p_changed for obj in ghosts]
+      [False, False, False]
+      >>> len(report.qlog)
+      1
+
+    Objects already loaded are not read again:
+
+      >>> report.clear()
+      >>> dm.prefetch(ghosts)
+      >>> dm.load_many(refs[:3])
+      [<Foo foo-0>, <Foo foo-1>, <Foo foo-2>]
+      >>> report.qlog
+      []
+
+      >>> datamanager.unregister_query_stats_listener(report)
+    """
+
+def doctest_PJDataManager_cacheGC():
+    r"""PJDataManager: cacheGC(), PJ_OBJECT_CACHE_SIZE
+
+      >>> refs = [dm.insert(Foo('foo-%i' % i)) for i in range(4)]
+      >>> dm.commit(None)
+
+    With `PJ_OBJECT_CACHE_SIZE` the least recently loaded objects are turned
+    into ghosts, when more objects are loaded:
+
+      >>> patcher = mock.patch('pjpersist.datamanager.PJ_OBJECT_CACHE_SIZE', 2)
+      >>> _ = patcher.start()
+      >>> foos = [dm.load(ref) for ref in refs]
+      >>> [foo.name for foo in foos]
+      ['foo-0', 'foo-1', 'foo-2', 'foo-3']
+      >>> [foo._p_changed for foo in foos]
+      [None, None, False, False]
+      >>> len(dm._object_cache)
+      2
+
+    Their documents are dropped as well:
+
+      >>> foos[0]._p_oid in dm._latest_states
+      False
+      >>> foos[3]._p_oid in dm._latest_states
+      True
+
+    The ghosts are kept while they are referenced, loading them again returns
+    the same object, which reads its document again:
+
+      >>> dm.load(refs[0]) is foos[0]
+      True
+      >>> foos[0].name
+      'foo-0'
+      >>> [foo._p_changed for foo in foos]
+      [False, None, None, False]
+
+    Modified objects stay in the cache until they are written. Here the
+    change is flushed before the document of foo-1 is read:
+
+      >>> foos[3].name = 'foo-3 changed'
+      >>> [foo._p_changed for foo in foos]
+      [False, None, None, True]
+      >>> foos[1].name
+      'foo-1'
+      >>> [foo._p_changed for foo in foos]
+      [None, False, None, False]
+      >>> foos[2].name
+      'foo-2'
+      >>> [foo._p_changed for foo in foos]
+      [None, None, False, False]
+      >>> foos[3].name
+      'foo-3 changed'
+      >>> dm.commit(None)
+
+    Ghosts that are not referenced anymore are released:
+
+      >>> [dm.load(ref).name for ref in refs]
+      ['foo-0', 'foo-1', 'foo-2', 'foo-3 changed']
+      >>> len(dm._object_cache), len(dm._weak_object_cache)
+      (2, 0)
+      >>> _ = patcher.stop()
+
+    `cacheGC()` can also be called explicitly:
+
+      >>> dm.commit(None)
+      >>> foos = [dm.load(ref) for ref in refs]
+      >>> [foo.name for foo in foos]
+      ['foo-0', 'foo-1', 'foo-2', 'foo-3 changed']
+      >>> dm.cacheGC(1)
+      >>> [foo._p_changed for foo in foos]
+      [None, None, None, False]
+      >>> dm.commit(None)
+
+    A ghost gets its previous state back, while one of its sub-objects is
+    referenced elsewhere. Otherwise a change of the sub-object would be lost:
+
+      >>> first = dm.load(refs[0])
+      >>> first.items = {'nested': []}
+      >>> dm.commit(None)
+      >>> _ = patcher.start()
+      >>> first = dm.load(refs[0])
+      >>> items = first.items
+      >>> nested = items['nested']
+      >>> [dm.load(ref).name for ref in refs[1:]]
+      ['foo-1', 'foo-2', 'foo-3 changed']
+      >>> first._p_changed
+      >>> nested.append(1)
+      >>> first.items is items
+      True
+      >>> dm.commit(None)
+      >>> first = dm.load(refs[0])
+      >>> first.items == {'nested': [1]}
+      True
+
+    Once the sub-objects are gone, the ghost reads its document again:
+
+      >>> import gc
+      >>> [dm.load(ref).name for ref in refs[1:]]
+      ['foo-1', 'foo-2', 'foo-3 changed']
+      >>> first._p_changed
+      >>> len(dm._detached_states)
+      1
+      >>> _ = gc.collect()
+      >>> len(dm._detached_states)
+      0
+      >>> first.items == {'nested': [1]}
+      True
+
+    Ghosts do not stay in the cache, so activating many of them only
+    releases the least recently loaded objects:
+
+      >>> dm.commit(None)
+      >>> holder = dm.load(refs[0])
+      >>> holder.items = [Foo('item-%i' % i) for i in range(20)]
+      >>> dm.commit(None)
+      >>> holder = dm.load(refs[0])
+      >>> items = list(holder.items)
+      >>> len(dm._object_cache)
+      21
+      >>> releasable = mock.patch.object(
+      ...     dm, '_releasable', wraps=dm._releasable)
+      >>> with releasable as calls:
+      ...     names = [item.name for item in items]
+      >>> names[-1]
+      'item-19'
+      >>> len(dm._object_cache)
+      2
+      >>> calls.call_count
+      38
+      >>> _ = patcher.stop()
+    """
+
+def doctest_PJDataManager_prefetch_references():
+    r"""PJDataManager: references of a loaded document are read together
+
+    `Super` and `Sub` share a table, so the class of a reference can only be
+    resolved by reading its document:
+
+      >>> foo = Foo('foo')
+      >>> foo.items = [Super('super-%i' % i) for i in range(3)]
+      >>> foo.items.append(Sub('sub'))
+      >>> foo_ref = dm.insert(foo)
+      >>> dm.commit(None)
+
+      >>> from pjpersist.querystats import QueryReport
+      >>> report = QueryReport()
+      >>> datamanager.register_query_stats_listener(report)
+      >>> foo = dm.load(foo_ref, Foo)
+      >>> foo.items
+      [<Super super-0>, <Super super-1>, <Super super-2>, <Sub sub>]
+      >>> datamanager.unregister_query_stats_listener(report)
+
+    One query reads the document, another one all referenced documents:
+
+      >>> [q.query.split(' FROM ')[1] for q in report.qlog]
+      ['pjpersist_dot_tests_dot_test_datamanager_dot_Foo WHERE id = %s',
+       'Super WHERE id = ANY(%s)']
+
+    Activating the referenced objects does not query the database:
+
+      >>> report.clear()
+      >>> datamanager.register_query_stats_listener(report)
+      >>> [item.name for item in foo.items]
+      ['super-0', 'super-1', 'super-2', 'sub']
+      >>> datamanager.unregister_query_stats_listener(report)
+      >>> report.qlog
+      []
+
+    The prefetching can be turned off:
+
+      >>> dm.commit(None)
+      >>> report.clear()
+      >>> datamanager.register_query_stats_listener(report)
+      >>> with mock.patch('pjpersist.serialize.PREFETCH_REFERENCES', False):
+      ...     dm.load(foo_ref, Foo).items
+      [<Super super-0>, <Super super-1>, <Super super-2>, <Sub sub>]
+      >>> datamanager.unregister_query_stats_listener(report)
+      >>> len(report.qlog)
+      5
+    """
+
+def doctest_PJDataManager_prepared_statements():
+    r"""PJDataManager: point queries as prepared statements
+
+      >>> patcher = mock.patch(
+      ...     'pjpersist.datamanager.PJ_PREPARED_STATEMENTS', True)
+      >>> _ = patcher.start()
+
+      >>> refs = [dm.insert(Foo('foo-%i' % i)) for i in range(3)]
+      >>> dm.commit(None)
+
+    Loading the documents prepares the query once and executes it for every
+    document:
+
+      >>> [dm.load(ref, Foo).name for ref in refs]
+      ['foo-0', 'foo-1', 'foo-2']
+
+      >>> def prepared():
+      ...     with conn.cursor() as cur:
+      ...         cur.execute(
+      ...             "SELECT name, statement FROM pg_prepared_statements "
+      ...             "ORDER BY statement")
+      ...         return cur.fetchall()
+      >>> pprint(prepared())
+      [('pj_...',
+        'PREPARE pj_... AS SELECT data FROM '
+        'pjpersist_dot_tests_dot_test_datamanager_dot_Foo WHERE id = $1')]
+
+    The registry knows about them:
+
+      >>> sorted(datamanager.PREPARED_STATEMENTS[conn]) == sorted(
+      ...     name for name, statement in prepared())
+      True
+
+    Statements are logged with the original SQL:
+
+      >>> from pjpersist.querystats import QueryReport
+      >>> report = QueryReport()
+      >>> datamanager.register_query_stats_listener(report)
+      >>> dm.remove(dm.load(refs[0], Foo))
+      >>> datamanager.unregister_query_stats_listener(report)
+      >>> [q.query for q in report.qlog if not q.query.startswith('SAVEPOINT')]
+      ['DELETE FROM pjpersist_dot_tests_dot_test_datamanager_dot_Foo
+        WHERE id = %s']
+      >>> dm.commit(None)
+
+    Resetting the connection outside of pjpersist discards the statements,
+    the registry needs to be told:
+
+      >>> conn.reset()
+      >>> prepared()
+      []
+      >>> datamanager.forget_prepared_statements(conn)
+      >>> conn in datamanager.PREPARED_STATEMENTS
+      False
+
+      >>> _ = patcher.stop()
+    """
+
+def doctest_PJDataManager_flush_unchanged():
+    r"""PJDataManager: flush() skips documents that did not change
+
+      >>> foo_ref = dm.insert(Foo('foo'))
+      >>> dm.commit(None)
+
+      >>> from pjpersist.querystats import QueryReport
+      >>> report = QueryReport()
+      >>> datamanager.register_query_stats_listener(report)
+
+    Setting an attribute to its current value marks the object as changed,
+    but its document stays the same, so nothing is written:
+
+      >>> foo = dm.load(foo_ref)
+      >>> foo.name = 'foo'
+      >>> foo._p_changed
+      True
+      >>> dm.flush()
+      >>> [q.query for q in report.qlog if q.query.startswith('UPDATE')]
+      []
+      >>> dm.skipped_writes
+      1
+      >>> foo._p_changed
+      False
+
+    Values that are equal in Python, but not in JSON, are written:
+
+      >>> foo.name = 1
+      >>> dm.flush()
+      >>> foo.name = True
+      >>> dm.flush()
+      >>> len([q for q in report.qlog if q.query.startswith('UPDATE')])
+      2
+      >>> dm.skipped_writes
+      1
+
+      >>> datamanager.unregister_query_stats_listener(report)
+      >>> dm.commit(None)
+      >>> dm.load(foo_ref).name
+      True
+    """
+
+
+def doctest_PJDataManager_flush_partial():
+    r"""PJDataManager: flush() only writes the changed keys of big documents
+
+      >>> foo = Foo('foo')
+      >>> foo.a, foo.b, foo.c, foo.d = 1, 2, 3, 4
+      >>> foo_ref = dm.insert(foo)
+      >>> dm.commit(None)
+
+      >>> from pjpersist.querystats import QueryReport
+      >>> report = QueryReport()
+      >>> datamanager.register_query_stats_listener(report)
+
+    When only a few top-level keys change, just those are sent and merged
+    into the stored document, removed keys are dropped from it:
+
+      >>> foo = dm.load(foo_ref)
+      >>> foo.a = 10
+      >>> del foo.d
+      >>> dm.flush()
+      >>> [(q.query, q.args) for q in report.qlog
+      ...  if q.query.startswith('UPDATE')]
+      [('UPDATE pjpersist_dot_tests_dot_test_datamanager_dot_Foo
+         SET data = (data - %s::text[]) || %s::jsonb WHERE id = %s',
+        (['d'], <Json>, '0001020304050607080a0b0c0'))]
+
+    Many changes are written as a full document:
+
+      >>> report.clear()
+      >>> foo.name, foo.b, foo.c = 'FOO', 20, 30
+      >>> dm.flush()
+      >>> [q.query for q in report.qlog if q.query.startswith('UPDATE')]
+      ['UPDATE pjpersist_dot_tests_dot_test_datamanager_dot_Foo
+        SET data=%s WHERE id = %s']
+
+    Partial updates are batched with full ones:
+
+      >>> bar = Foo('bar')
+      >>> bar.a = bar.b = bar.c = 0
+      >>> bar_ref = dm.insert(bar)
+      >>> dm.commit(None)
+      >>> foo, bar = dm.load(foo_ref), dm.load(bar_ref)
+      >>> foo.a = 100
+      >>> bar.name, bar.a, bar.b, bar.c = 'BAR', 1, 2, 3
+      >>> report.clear()
+      >>> dm.flush()
+      >>> [q.query.split(' FROM ')[0] for q in report.qlog
+      ...  if q.query.startswith('UPDATE')]
+      ['UPDATE pjpersist_dot_tests_dot_test_datamanager_dot_Foo
+        SET data = CASE WHEN v.removed IS NULL THEN v.data
+        ELSE (pjpersist_dot_tests_dot_test_datamanager_dot_Foo.data
+        - v.removed) || v.data END']
+
+      >>> datamanager.unregister_query_stats_listener(report)
+      >>> dm.commit(None)
+      >>> foo = dm.load(foo_ref)
+      >>> foo.name, foo.a, foo.b, foo.c, hasattr(foo, 'd')
+      ('FOO', 100, 20, 30, False)
+      >>> bar = dm.load(bar_ref)
+      >>> bar.name, bar.a, bar.b, bar.c
+      ('BAR', 1, 2, 3)
+    """
+
+
+def doctest_PJDataManager_flush_partial_merged():
+    r"""WriteBatch: partial updates of the same document are merged
+
+    A key removed earlier and set again later is not removed anymore:
+
+      >>> batch = datamanager.WriteBatch()
+      >>> batch.add_update('db', 'tbl', '1', {'a': 10}, ['d'])
+      >>> batch.add_update('db', 'tbl', '1', {'d': 40}, ['b'])
+      >>> batch.updates
+      {('db', 'tbl'): {'1': ({'a': 10, 'd': 40}, ['b'])}}
+
+    A full document absorbs later partial updates:
+
+      >>> batch.add_update('db', 'tbl', '2', {'a': 1, 'b': 2})
+      >>> batch.add_update('db', 'tbl', '2', {'c': 3}, ['a'])
+      >>> batch.updates[('db', 'tbl')]['2']
+      ({'b': 2, 'c': 3}, None)
+    """
+
+
+def doctest_PJDataManager_flush_hint():
+    r"""PJDataManager: queries only flush the tables they read
+
+      >>> foo_ref = dm.insert(Foo('foo'))
+      >>> super_ref = dm.insert(Super('super'))
+      >>> dm.commit(None)
+
+      >>> foo = dm.load(foo_ref)
+      >>> foo.name = 'FOO'
+      >>> sup = dm.load(super_ref)
+      >>> sup.name = 'SUPER'
+
+    Querying the `Super` table only writes `sup`:
+
+      >>> with dm.getCursor() as cur:
+      ...     cur.execute('SELECT data FROM Super')
+      ...     [row['data']['name'] for row in cur.fetchall()]
+      ['SUPER']
+      >>> list(dm._registered_objects.values())
+      [<Foo FOO>]
+
+    Tables that are not known to hold documents might be views or functions
+    reading any table, so all objects are flushed:
+
+      >>> with dm.getCursor() as cur:
+      ...     cur.execute('SELECT count(*) FROM pg_catalog.pg_stat_activity')
+      >>> list(dm._registered_objects.values())
+      []
+
+    Functions called by a query may read any table as well, only the calls
+    in `SQL_SAFE_CALLS` are known not to:
+
+      >>> foo.name = 'Foo'
+      >>> sup.name = 'Super'
+      >>> with dm.getCursor() as cur:
+      ...     cur.execute("SELECT count(*), lower(data->>'name') FROM Super "
+      ...                 "GROUP BY data")
+      >>> list(dm._registered_objects.values())
+      [<Foo Foo>]
+      >>> with dm.getCursor() as cur:
+      ...     cur.execute("SELECT pg_stat_get_numscans(1) FROM Super")
+      >>> list(dm._registered_objects.values())
+      []
+
+    Set `PJ_AUTO_FLUSH_HINT` to False to always flush all objects:
+
+      >>> foo.name = 'foo'
+      >>> with mock.patch('pjpersist.datamanager.PJ_AUTO_FLUSH_HINT', False):
+      ...     with dm.getCursor() as cur:
+      ...         cur.execute('SELECT data FROM Super')
+      >>> list(dm._registered_objects.values())
+      []
+
+      >>> dm.commit(None)
+      >>> dm.load(foo_ref).name
+      'foo'
+    """
+
+
+def doctest_PJDataManager_transaction_budget():
+    r"""PJDataManager: the work of a transaction can be limited
+
+      >>> from pjpersist import querystats
+      >>> refs = [dm.insert(Foo('foo%i' % i)) for i in range(3)]
+      >>> dm.commit(None)
+
+      >>> budget = querystats.TransactionBudget(
+      ...     max_statements=2, policy=querystats.BUDGET_RAISE)
+      >>> patcher = mock.patch(
+      ...     'pjpersist.datamanager.PJ_TRANSACTION_BUDGET', budget)
+      >>> _ = patcher.start()
+
+    Loading every object with its own query soon exceeds the budget, the
+    report names the code executing the statements:
+
+      >>> names = []
+      >>> for ref in refs:
+      ...     names.append(dm.load(ref).name)
+      Traceback (most recent call last):
+      ...
+      pjpersist.interfaces.TransactionBudgetExceeded:
+      Transaction budget exceeded: statements 3 (max 2)
+      Statements: 3, time: ...ms, rows: 3, documents: 2
+      Top call sites:
+        3 statements: <doctest ...>:2 in <module>
+      >>> names
+      ['foo0', 'foo1']
+      >>> dm.abort(None)
+
+    Every transaction has its own budget. The limits are checked for the
+    documents loaded and the rows returned as well:
+
+      >>> budget.max_statements = None
+      >>> budget.max_documents = 2
+      >>> objs = dm.load_many(refs)
+      >>> [obj.name for obj in objs]
+      Traceback (most recent call last):
+      ...
+      pjpersist.interfaces.TransactionBudgetExceeded:
+      Transaction budget exceeded: documents 3 (max 2)
+      ...
+      >>> dm.abort(None)
+
+    Instead of raising, a warning can be issued or logged:
+
+      >>> budget.policy = querystats.BUDGET_WARN
+      >>> import warnings
+      >>> with warnings.catch_warnings(record=True) as caught:
+      ...     warnings.simplefilter('always')
+      ...     objs = dm.load_many(refs)
+      ...     names = [obj.name for obj in objs]
+      >>> names
+      ['foo0', 'foo1', 'foo2']
+      >>> print(caught[0].message)
+      Transaction budget exceeded: documents 3 (max 2)
+      ...
+      >>> dm.abort(None)
+
+      >>> budget.policy = querystats.BUDGET_LOG
+      >>> log = testing.setUpLogging(querystats.LOG)
+      >>> objs = dm.load_many(refs)
+      >>> names = [obj.name for obj in objs]
+      >>> print(log.getvalue())
+      Transaction budget exceeded: documents 3 (max 2)
+      ...
+      >>> testing.tearDownLogging(querystats.LOG)
+
+    The rows of named (server side) cursors are counted as they are
+    fetched:
+
+      >>> dm.abort(None)
+      >>> budget.policy = querystats.BUDGET_RAISE
+      >>> budget.max_documents = None
+      >>> budget.max_rows = 2
+      >>> cur = dm.getCursor(itersize=1)
+      >>> cur.execute(
+      ...     "SELECT id FROM "
+      ...     "pjpersist_dot_tests_dot_test_datamanager_dot_Foo")
+      >>> dm._budget_usage.rows
+      0
+      >>> cur.fetchone() is not None
+      True
+      >>> dm._budget_usage.rows
+      1
+      >>> rows = list(cur)
+      Traceback (most recent call last):
+      ...
+      pjpersist.interfaces.TransactionBudgetExceeded:
+      Transaction budget exceeded: rows 3 (max 2)
+      ...
+      >>> cur.close()
+      >>> dm.abort(None)
+
+      >>> _ = patcher.stop()
+    """
+
+
+def doctest_PJDataManager_detect_n_plus_one():
+    r"""PJDataManager: statements executed in a loop are reported
+
+      >>> from pjpersist import querystats
+      >>> refs = [dm.insert(Foo('foo%i' % i)) for i in range(3)]
+      >>> dm.commit(None)
+
+      >>> patcher = mock.patch(
+      ...     'pjpersist.datamanager.PJ_DETECT_N_PLUS_ONE', True)
+      >>> _ = patcher.start()
+      >>> log = testing.setUpLogging(datamanager.LOG)
+
+    Loading the objects one by one executes the same query for each of
+    them, from the same line:
+
+      >>> with mock.patch('pjpersist.querystats.N_PLUS_ONE_THRESHOLD', 3):
+      ...     for ref in refs:
+      ...         name = dm.load(ref).name
+      ...     dm.commit(None)
+      >>> print(log.getvalue())
+      Statement executed 3 times from <doctest ...>:3 in <module>:
+      *** SELECT data FROM pjpersist_dot_tests_dot_test_datamanager_dot_Foo
+          WHERE id = ?
+      ... Load the documents in bulk, e.g. with PJDataManager.load_many()
+          or WHERE id = ANY(...)
+
+    Loading them in bulk does not loop:
+
+      >>> log.truncate(0)
+      0
+      >>> with mock.patch('pjpersist.querystats.N_PLUS_ONE_THRESHOLD', 3):
+      ...     names = [foo.name for foo in dm.load_many(refs)]
+      ...     dm.commit(None)
+      >>> log.getvalue()
+      ''
+
+      >>> testing.tearDownLogging(datamanager.LOG)
+      >>> _ = patcher.stop()
+    """
+
+
+def doctest_PJDataManager_explain_slow_statements():
+    r"""PJDataManager: the plans of slow statements are captured
+
+      >>> foo_ref = dm.insert(Foo('foo'))
+      >>> dm.commit(None)
+
+      >>> from pjpersist.querystats import QueryReport
+      >>> report = QueryReport()
+      >>> datamanager.register_query_stats_listener(report)
+
+    Statements running longer than `PJ_EXPLAIN_THRESHOLD` seconds are
+    explained, the plan is passed to the query stats:
+
+      >>> with mock.patch('pjpersist.datamanager.PJ_EXPLAIN_THRESHOLD', 0):
+      ...     with dm.getCursor() as cur:
+      ...         cur.execute(
+      ...             "SELECT data FROM pjpersist_dot_tests_dot_test_"
+      ...             "datamanager_dot_Foo WHERE data->>'name' = %s", ('foo',))
+      ...         [row['data']['name'] for row in cur.fetchall()]
+      ...         cur.execute('SET LOCAL work_mem = 4096')
+      ['foo']
+      >>> datamanager.unregister_query_stats_listener(report)
+
+      >>> print(report.qlog[0].plan['Plan']['Node Type'])
+      Seq Scan
+      >>> print(report.calc_and_report())
+      Query report:
+      ...
+      *** SELECT data FROM pjpersist_dot_tests_dot_test_datamanager_dot_Foo
+          WHERE data->>'name' = %s
+      ... ARGS: ('foo',)
+      ... TIME: ...ms
+      ... PLAN:
+          Seq Scan on pjpersist_dot_tests_dot_test_datamanager_dot_foo
+          (cost=... rows=...)
+      ...
+
+    Other statements are not explained:
+
+      >>> report.qlog[1].query
+      'SET LOCAL work_mem = 4096'
+      >>> report.qlog[1].plan is None
+      True
+
+    Without the threshold nothing is explained:
+
+      >>> report.clear()
+      >>> datamanager.register_query_stats_listener(report)
+      >>> dm.load(foo_ref).name
+      'foo'
+      >>> datamanager.unregister_query_stats_listener(report)
+      >>> [q.plan for q in report.qlog]
+      [None]
+    """
+
+
+def doctest_PJDataManager_write_behind():
+    r"""PJDataManager: documents can be written in the background
+
+      >>> patcher = mock.patch('pjpersist.datamanager.PJ_WRITE_BEHIND', True)
+      >>> _ = patcher.start()
+
+      >>> foo_ref = dm.insert(Foo('foo'))
+      >>> dm.commit(None)
+
+    A flush hands the documents to a writer thread and returns:
+
+      >>> foo = dm.load(foo_ref)
+      >>> foo.name = 'bar'
+      >>> dm.flush()
+      >>> len(dm._pending_writes)
+      1
+
+    The next statement waits for the writes:
+
+      >>> with dm.getCursor() as cur:
+      ...     cur.execute('SELECT data FROM %s' % foo_ref.table)
+      ...     [row['data']['name'] for row in cur.fetchall()]
+      ['bar']
+      >>> dm._pending_writes
+      []
+
+    Errors of the writer are raised by the next statement, commit or vote
+    and doom the transaction:
+
+      >>> foo.name = 'baz'
+      >>> with mock.patch.object(
+      ...         dm, '_update_docs', side_effect=RuntimeError('boom')):
+      ...     dm.flush()
+      ...     dm._pending_writes[0].exception()
+      RuntimeError('boom')
+      >>> dm.commit(None)
+      Traceback (most recent call last):
+      ...
+      RuntimeError: boom
+      >>> transaction.get().isDoomed()
+      True
+      >>> dm.abort(None)
+      >>> transaction.abort()
+
+      >>> _ = patcher.stop()
+      >>> dm.load(foo_ref).name
+      'foo'
+    """
+
+
+def doctest_PJDataManager_write_behind_store_hook():
+    r"""PJDataManager: store hooks see the documents written in the background
+
+      >>> hooked_ref = dm.insert(HookedFoo('foo'))
+      >>> dm.commit(None)
+      >>> patcher = mock.patch('pjpersist.datamanager.PJ_WRITE_BEHIND', True)
+      >>> _ = patcher.start()
+
+      >>> hooked = dm.load(hooked_ref)
+      >>> hooked.name = 'bar'
+      >>> dm.flush()
+      >>> HookedFoo.stored_names
+      ['foo', 'bar']
+      >>> dm._pending_writes
+      []
+      >>> dm.commit(None)
+
+    Statement errors in the writer thread are only raised by the thread
+    waiting for the writes, which dooms its transaction:
+
+      >>> def update_docs(database, table, docs):
+      ...     with dm.getCursor() as cur:
+      ...         cur.execute('SELEC 1')
+      >>> hooked = dm.load(hooked_ref)
+      >>> hooked.name = 'baz'
+      >>> with mock.patch('pjpersist.datamanager.PJ_ACCESS_LOGGING', True), \
+      ...         mock.patch.object(dm, '_update_docs', update_docs):
+      ...     dm.flush()
+      Traceback (most recent call last):
+      ...
+      psycopg2.errors.SyntaxError: syntax error at or near "SELEC"
+      ...
+      >>> transaction.get().isDoomed()
+      True
+      >>> dm._write_behind.submit(
+      ...     lambda: transaction.get().isDoomed()).result()
+      False
+      >>> dm.abort(None)
+      >>> transaction.abort()
+      >>> _ = patcher.stop()
+      >>> del HookedFoo.stored_names[:]
+    """
+
+
 def doctest_PJDataManager_insert():
     r"""PJDataManager: insert(obj)
 
@@ -410,6 +1372,49 @@ def doctest_PJDataManager_insert_remove_modify():
 
     """
 
+def doctest_PJDataManager_remove_registered_sub_objects():
+    r"""PJDataManager: remove() unregisters the changed sub-objects
+
+      >>> foo = Foo('foo')
+      >>> foo.bar = Bar('bar')
+      >>> foo_ref = dm.insert(foo)
+      >>> other = Foo('other')
+      >>> other.bar = Bar('other bar')
+      >>> other_ref = dm.insert(other)
+      >>> dm.commit(None)
+
+    The changed sub-objects are registered, by the document object they
+    belong to:
+
+      >>> foo.bar.name = 'bar 2'
+      >>> other.bar.name = 'other bar 2'
+      >>> sorted(dm._registered_objects.values(), key=repr)
+      [<Bar bar 2>, <Bar other bar 2>]
+      >>> dm._registered_by_doc[id(foo)] == {id(foo.bar)}
+      True
+
+    Removing the document unregisters its sub-objects only:
+
+      >>> dm.remove(foo)
+      >>> list(dm._registered_objects.values())
+      [<Bar other bar 2>]
+      >>> id(foo) in dm._registered_by_doc
+      False
+
+    Flushing unregisters the written objects:
+
+      >>> dm.flush()
+      >>> dm._registered_objects
+      {}
+      >>> dm._registered_by_doc
+      {}
+      >>> dm._registered_doc_ids
+      {}
+      >>> dm.reset()
+
+    """
+
+
 def doctest_PJDataManager_remove_modify_flush():
     r"""PJDataManager: An object is modified after removal.
 
@@ -1147,6 +2152,109 @@ def doctest_PJDataManager_sub_doc_multi_flush():
     """
 
 
+def doctest_PJDataManager_known_tables():
+    r"""PJDataManager: statements on known tables run without a savepoint
+
+      >>> executed = []
+      >>> plain_execute = datamanager.PJPersistCursor._plain_execute
+      >>> def log_plain_execute(self, sql, args=None):
+      ...     executed.append(sql)
+      ...     return plain_execute(self, sql, args)
+      >>> patcher = mock.patch.object(
+      ...     datamanager.PJPersistCursor, '_plain_execute', log_plain_execute)
+      >>> _ = patcher.start()
+
+    The tables of a database are read once, new tables are only known after
+    the transaction creating them is committed:
+
+      >>> foo_ref = dm.insert(Foo('foo'))
+      >>> dm.flush()
+      >>> executed
+      ['SAVEPOINT before_execute;',
+       'ROLLBACK TO SAVEPOINT before_execute;',
+       'SAVEPOINT before_execute;',
+       'SAVEPOINT before_execute;']
+      >>> table = 'pjpersist_dot_tests_dot_test_datamanager_dot_foo'
+      >>> table in datamanager.KNOWN_TABLES[testing.DBNAME]
+      False
+      >>> dm._is_known_table(table)
+      True
+      >>> dm.commit(None)
+      >>> table in datamanager.KNOWN_TABLES[testing.DBNAME]
+      True
+
+    From now on no savepoints are needed:
+
+      >>> executed = []
+      >>> foo = dm.load(foo_ref)
+      >>> foo.name = 'bar'
+      >>> dm.commit(None)
+      >>> executed
+      []
+
+    A table created in an aborted transaction is not known:
+
+      >>> dm.create_tables(['Bar'])
+      >>> 'bar' in datamanager.KNOWN_TABLES[testing.DBNAME]
+      True
+      >>> bar_ref = dm.insert(Bar('bar'))
+      >>> dm.flush()
+      >>> dm.abort(None)
+      >>> table = 'pjpersist_dot_tests_dot_test_datamanager_dot_bar'
+      >>> dm._is_known_table(table)
+      False
+
+    Dropped tables are forgotten:
+
+      >>> with dm.getCursor() as cur:
+      ...     cur.execute('DROP TABLE Bar')
+      >>> dm._is_known_table('bar')
+      False
+      >>> dm.commit(None)
+
+      >>> _ = patcher.stop()
+    """
+
+
+def doctest_get_sql_tables():
+    r"""get_sql_tables(): Find the tables of an SQL statement
+
+      >>> from pjpersist.datamanager import get_sql_tables
+      >>> sorted(get_sql_tables(
+      ...     'SELECT * FROM Foo, public."Bar" JOIN baz ON true'))
+      ['Bar', 'baz', 'foo']
+      >>> sorted(get_sql_tables('UPDATE foo SET data = v.data '
+      ...                       'FROM (VALUES (%s, %s)) AS v(id, data)'))
+      ['foo']
+      >>> sorted(get_sql_tables('insert into foo (id) values (%s)'))
+      ['foo']
+      >>> sorted(get_sql_tables('DROP TABLE IF EXISTS foo'))
+      ['foo']
+      >>> sorted(get_sql_tables(
+      ...     'SELECT f.data FROM foo AS f, bar b WHERE f.id = b.id'))
+      ['bar', 'foo']
+      >>> sorted(get_sql_tables('SELECT 1'))
+      []
+    """
+
+
+def doctest_get_sql_calls():
+    r"""get_sql_calls(): Find the functions called by an SQL statement
+
+      >>> from pjpersist.datamanager import get_sql_calls
+      >>> sorted(get_sql_calls(
+      ...     'SELECT count(*), app.total(data) FROM foo '
+      ...     'WHERE pg_catalog.LOWER(name) IN (%s) AND "Check"(data)'))
+      ['"Check"', 'app.total', 'count', 'in', 'lower']
+
+    Column alias lists are not calls:
+
+      >>> sorted(get_sql_calls('UPDATE foo SET data = v.data '
+      ...                      'FROM (VALUES (%s, %s)) AS v(id, data)'))
+      ['from', 'values']
+    """
+
+
 def doctest_get_database_name_from_dsn():
     """Test dsn parsing
 
@@ -1272,7 +2380,8 @@ class DatamanagerConflictTest(testing.PJTestCase):
 
         # start another transaction and verify the traceback
         # is reset
-        datamanager.PJDataManager(testing.DummyConnectionPool(conn2))
+        dm2 = datamanager.PJDataManager(testing.DummyConnectionPool(conn2))
+        dm2.getCursor()
 
         ctb = datamanager.CONFLICT_TRACEBACK_INFO.traceback
         self.assertIsNone(ctb)
@@ -1368,6 +2477,7 @@ class QueryLoggingTestCase(testing.PJTestCase):
         with self.conn.cursor() as cur:
             cur.execute("DROP TABLE IF EXISTS mytab")
             cur.execute("CREATE TABLE mytab (class int NOT NULL, value varchar NOT NULL )")
+        self.conn.commit()
 
         pjal_patch = mock.patch("pjpersist.datamanager.PJ_ACCESS_LOGGING",
                                 True)
@@ -1472,13 +2582,101 @@ class TransactionOptionsTestCase(testing.PJTestCase):
         self.assertEqual(res[0], default_level)
 
 
+class ReplicaTestCase(testing.PJTestCase):
+
+    def setUp(self):
+        super(ReplicaTestCase, self).setUp()
+        transaction.abort()
+        # The "replica" is a second connection to the test database.
+        self.replica_conn = testing.getConnection(testing.DBNAME)
+        self.replica_pool = testing.DummyConnectionPool(self.replica_conn)
+        self.dm = datamanager.PJDataManager(
+            testing.DummyConnectionPool(self.conn),
+            replica_pool=self.replica_pool)
+        transaction.commit()
+
+    def tearDown(self):
+        transaction.abort()
+        self.replica_conn.close()
+        datamanager.REPLICA_PINS.__dict__.clear()
+        super(ReplicaTestCase, self).tearDown()
+
+    def execute(self, sql):
+        cur = self.dm.getCursor()
+        cur.execute(sql)
+        return cur.fetchone()[0]
+
+    def test_readonly(self):
+        self.dm.setTransactionOptions(readonly=True)
+        self.execute('SELECT 1')
+        self.assertTrue(self.dm.on_replica())
+        self.assertTrue(self.replica_pool.isTaken())
+        transaction.commit()
+        self.assertFalse(self.replica_pool.isTaken())
+
+        # The next transaction is not read-only anymore.
+        self.execute('SELECT 1')
+        self.assertFalse(self.dm.on_replica())
+        self.assertFalse(self.replica_pool.isTaken())
+
+    def test_serializable(self):
+        # Replicas do not support serializable transactions.
+        self.dm.setTransactionOptions(
+            readonly=True, isolation_level='SERIALIZABLE')
+        self.assertEqual(
+            self.execute("SELECT current_setting('transaction_isolation')"),
+            'repeatable read')
+
+    @mock.patch('pjpersist.datamanager.PJ_REPLICA_REQUIRE_DEFERRABLE', True)
+    def test_require_deferrable(self):
+        self.dm.setTransactionOptions(readonly=True)
+        self.execute('SELECT 1')
+        self.assertFalse(self.dm.on_replica())
+        transaction.commit()
+
+        self.dm.setTransactionOptions(readonly=True, deferrable=True)
+        self.execute('SELECT 1')
+        self.assertTrue(self.dm.on_replica())
+
+    @mock.patch('pjpersist.datamanager.PJ_REPLICA_MAX_LAG', 5)
+    def test_max_lag(self):
+        self.dm.setTransactionOptions(readonly=True)
+        self.execute('SELECT 1')
+        self.assertTrue(self.dm.on_replica())
+        transaction.commit()
+
+        with mock.patch('pjpersist.datamanager.REPLICA_LAG_SQL',
+                        'SELECT 10'):
+            self.dm.setTransactionOptions(readonly=True)
+            self.execute('SELECT 1')
+        self.assertFalse(self.dm.on_replica())
+        self.assertFalse(self.replica_pool.isTaken())
+
+    @mock.patch('pjpersist.datamanager.PJ_REPLICA_PIN_AFTER_WRITE', 60)
+    def test_pin_after_write(self):
+        self.dm.root['foo'] = Foo('foo')
+        transaction.commit()
+
+        # Our own write might not be replicated yet.
+        self.dm.setTransactionOptions(readonly=True)
+        self.assertEqual(self.dm.root['foo'].name, 'foo')
+        self.assertFalse(self.dm.on_replica())
+        transaction.commit()
+
+        datamanager.REPLICA_PINS.last_write -= 60
+        self.dm.setTransactionOptions(readonly=True)
+        self.assertEqual(self.dm.root['foo'].name, 'foo')
+        self.assertTrue(self.dm.on_replica())
+
+
 class DirtyTestCase(testing.PJTestCase):
 
     def setUp(self):
         super(DirtyTestCase, self).setUp()
 
-        # get rid of the previous transaction
-        transaction.abort()
+        # The first use of the root creates its table.
+        len(self.dm.root)
+        transaction.commit()
 
         tpc_patch = mock.patch(
             "pjpersist.datamanager.PJ_TWO_PHASE_COMMIT_ENABLED", True)
@@ -1491,8 +2689,7 @@ class DirtyTestCase(testing.PJTestCase):
         for p in self.patches:
             p.start()
 
-        # First PJDataManager instantiation creates tables, what makes the dm
-        # dirty, which we want to avoid here.
+        # Creating the tables makes the dm dirty, which we want to avoid here.
         self.conn = testing.getConnection(testing.DBNAME)
         self.dm = datamanager.PJDataManager(testing.DummyConnectionPool(self.conn))
 
@@ -1713,5 +2910,6 @@ def test_suite():
         unittest.makeSuite(DatamanagerConflictTest),
         unittest.makeSuite(QueryLoggingTestCase),
         unittest.makeSuite(TransactionOptionsTestCase),
+        unittest.makeSuite(ReplicaTestCase),
         unittest.makeSuite(DirtyTestCase),
         ))
@@ -0,0 +1,71 @@
+##############################################################################
+#
+# Copyright (c) 2014 Shoobx, Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Document cache tests"""
+import doctest
+
+from pjpersist import doccache, testing
+
+
+def doctest_DocumentCache():
+    r"""DocumentCache: LRU cache with a size budget
+
+      >>> cache = doccache.DocumentCache(max_size=100)
+
+    Documents are stored with their row version and size:
+
+      >>> cache.put(('db', 'tbl', '1'), '10:(0,1)', {'name': 'one'}, 40)
+      >>> cache.put(('db', 'tbl', '2'), '11:(0,2)', {'name': 'two'}, 40)
+      >>> cache.get(('db', 'tbl', '1'))
+      ('10:(0,1)', {'name': 'one'})
+      >>> cache.get(('db', 'tbl', '3')) is None
+      True
+      >>> len(cache), cache.size
+      (2, 80)
+
+    Once the budget is exceeded, the least recently used entries are
+    evicted. Document 1 was just used, so 2 goes:
+
+      >>> cache.put(('db', 'tbl', '3'), '12:(0,3)', {'name': 'three'}, 40)
+      >>> sorted(key[2] for key in cache._entries)
+      ['1', '3']
+      >>> cache.size
+      80
+
+    Storing a key again replaces the entry:
+
+      >>> cache.put(('db', 'tbl', '1'), '13:(0,4)', {'name': 'ONE'}, 30)
+      >>> cache.get(('db', 'tbl', '1'))
+      ('13:(0,4)', {'name': 'ONE'})
+      >>> cache.size
+      70
+
+    Documents larger than the whole budget are not cached at all:
+
+      >>> cache.put(('db', 'tbl', '4'), '14:(0,5)', {'name': 'big'}, 200)
+      >>> ('db', 'tbl', '4') in cache
+      False
+
+    Entries can be invalidated one by one or all together:
+
+      >>> cache.invalidate(('db', 'tbl', '1'))
+      >>> len(cache), cache.size
+      (1, 40)
+      >>> cache.clear()
+      >>> len(cache), cache.size
+      (0, 0)
+    """
+
+
+def test_suite():
+    return doctest.DocTestSuite(optionflags=testing.OPTIONFLAGS)
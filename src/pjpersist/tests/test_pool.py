@@ -0,0 +1,211 @@
+##############################################################################
+#
+# Copyright (c) 2014 Shoobx, Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Connection pool tests"""
+import threading
+import time
+import unittest
+
+import mock
+import psycopg2.pool
+import transaction
+
+from pjpersist import pool, testing
+
+
+def createPool(minconn=1, maxconn=2, **kwargs):
+    return pool.PJConnectionPool(
+        minconn, maxconn, database=testing.DBNAME,
+        host='localhost', port=5432, user='pjpersist', password='pjpersist',
+        **kwargs)
+
+
+class PJConnectionPoolTest(unittest.TestCase):
+    layer = testing.db_layer
+
+    def setUp(self):
+        self.pool = createPool(timeout=0.1)
+
+    def tearDown(self):
+        self.pool.closeall()
+
+    def test_min_connections(self):
+        self.assertEqual(self.pool.stats()['idle'], 1)
+        self.assertEqual(self.pool.stats()['connections_opened'], 1)
+
+    def test_reuse(self):
+        conn = self.pool.getconn()
+        self.assertEqual(self.pool.stats()['in_use'], 1)
+        self.pool.putconn(conn)
+        self.assertIs(self.pool.getconn(), conn)
+        stats = self.pool.stats()
+        self.assertEqual(stats['connections_opened'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+
+    def test_rollback_on_put(self):
+        conn = self.pool.getconn()
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        self.pool.putconn(conn)
+        self.assertEqual(
+            conn.status, psycopg2.extensions.STATUS_READY)
+
+    def test_timeout(self):
+        conns = [self.pool.getconn(), self.pool.getconn()]
+        with self.assertRaises(psycopg2.pool.PoolError):
+            self.pool.getconn()
+        self.assertEqual(self.pool.stats()['timeouts'], 1)
+        for conn in conns:
+            self.pool.putconn(conn)
+
+    def test_wait_for_connection(self):
+        self.pool.timeout = 5
+        conns = [self.pool.getconn(), self.pool.getconn()]
+        got = []
+
+        @testing.run_in_thread
+        def checkout():
+            got.append(self.pool.getconn())
+
+        while not self.pool.stats()['waiters']:
+            time.sleep(0.01)
+        self.pool.putconn(conns[0])
+        checkout.join(5)
+        self.assertEqual(got, [conns[0]])
+        self.assertEqual(self.pool.stats()['waiters'], 0)
+        self.pool.putconn(conns[1])
+        self.pool.putconn(got[0])
+
+    def test_max_lifetime(self):
+        self.pool.max_lifetime = 0
+        conn = self.pool.getconn()
+        self.pool.putconn(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(self.pool.stats()['size'], 0)
+
+    def test_max_idle(self):
+        self.pool.max_idle = 0
+        conns = [self.pool.getconn(), self.pool.getconn()]
+        for conn in conns:
+            self.pool.putconn(conn)
+        time.sleep(0.01)
+        # Idle connections are closed down to `minconn`.
+        conn = self.pool.getconn()
+        self.assertEqual(self.pool.stats()['size'], 1)
+        self.assertEqual(sum(c.closed for c in conns), 1)
+        self.pool.putconn(conn)
+
+    def test_dead_connection(self):
+        self.pool.check_idle = 0
+        conn = self.pool.getconn()
+        self.pool.putconn(conn)
+        with mock.patch.object(self.pool, '_is_alive', return_value=False):
+            # The dead connection is replaced by a new one.
+            new = self.pool.getconn()
+        self.assertIsNot(new, conn)
+        self.assertTrue(conn.closed)
+        self.pool.putconn(new)
+
+    def test_closeall(self):
+        conn = self.pool.getconn()
+        self.pool.closeall()
+        self.assertTrue(conn.closed)
+        with self.assertRaises(psycopg2.pool.PoolError):
+            self.pool.getconn()
+        self.pool.reopen()
+        self.pool.putconn(self.pool.getconn())
+
+
+class PJDataManagerProviderTest(unittest.TestCase):
+    layer = testing.db_layer
+
+    def setUp(self):
+        self.provider = pool.PJDataManagerProvider(
+            user='pjpersist', password='pjpersist', pool_max_conn=2)
+
+    def tearDown(self):
+        transaction.abort()
+        pool.LOCAL.__dict__.clear()
+        for dbpool in list(self.provider.pools.values()) + list(
+                self.provider.replica_pools.values()):
+            dbpool.closeall()
+
+    def test_get(self):
+        dm = self.provider.get(testing.DBNAME)
+        self.assertIs(self.provider.get(testing.DBNAME), dm)
+        # The connection is only checked out when it is used.
+        dbpool = self.provider.pools[testing.DBNAME]
+        self.assertEqual(dbpool.stats()['in_use'], 0)
+        self.assertEqual(dm.database, testing.DBNAME)
+        self.assertEqual(dbpool.stats()['in_use'], 0)
+        dm.getCursor().execute('SELECT 1')
+        self.assertEqual(dbpool.stats()['in_use'], 1)
+        # The connection is returned at the end of the transaction and the
+        # next transaction gets a new data manager.
+        transaction.commit()
+        self.assertEqual(dbpool.stats()['in_use'], 0)
+        self.assertIsNot(self.provider.get(testing.DBNAME), dm)
+
+    def test_get_unused(self):
+        # A transaction that does not use the data manager does not hold a
+        # connection.
+        self.provider.get(testing.DBNAME)
+        transaction.commit()
+        stats = self.provider.pools[testing.DBNAME].stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['checkouts'], 0)
+
+    def test_threads(self):
+        dms = []
+
+        def get():
+            dms.append(self.provider.get(testing.DBNAME))
+            transaction.abort()
+
+        threads = [threading.Thread(target=get) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(set(map(id, dms))), 4)
+        self.assertEqual(
+            self.provider.pools[testing.DBNAME].stats()['in_use'], 0)
+
+    def test_replica(self):
+        self.provider.replica_host = 'localhost'
+        # Create the root table.
+        self.provider.get(testing.DBNAME).root.keys()
+        transaction.commit()
+        # The data manager only connects when it is used, so transaction
+        # options set after getting it decide where it runs.
+        for i in range(2):
+            dm = self.provider.get(testing.DBNAME)
+            dm.setTransactionOptions(readonly=True)
+            self.assertEqual(dm.root.keys(), [])
+            self.assertTrue(dm.on_replica())
+            self.assertTrue(dm._conn.readonly)
+            replica_pool = self.provider.replica_pools[testing.DBNAME]
+            self.assertEqual(replica_pool.stats()['in_use'], 1)
+            transaction.commit()
+            self.assertEqual(replica_pool.stats()['in_use'], 0)
+        # Other transactions use the primary.
+        dm = self.provider.get(testing.DBNAME)
+        self.assertEqual(dm.root.keys(), [])
+        self.assertFalse(dm.on_replica())
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(PJConnectionPoolTest),
+        unittest.makeSuite(PJDataManagerProviderTest),
+    ))
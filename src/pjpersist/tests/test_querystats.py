@@ -16,7 +16,8 @@
 import doctest
 
 from pjpersist import testing
-from pjpersist.querystats import QueryReport
+from pjpersist.querystats import LogHistogram, QueryAggregator, QueryReport
+from pjpersist.querystats import fingerprint, format_plan
 
 
 def doctest_calculate_empty():
@@ -91,6 +92,160 @@ def doctest_calc_and_report_several():
     """
 
 
+def doctest_fingerprint():
+    """
+    Literals, parameters and lists of values are replaced
+
+        >>> fingerprint("SELECT * FROM foo WHERE id = %s AND n > 5")
+        'SELECT * FROM foo WHERE id = ? AND n > ?'
+        >>> fingerprint("SELECT * FROM foo WHERE data->>'name' = 'it''s'")
+        'SELECT * FROM foo WHERE data->>? = ?'
+        >>> fingerprint("SELECT * FROM foo WHERE id IN ('a', 'b', 'c')")
+        'SELECT * FROM foo WHERE id IN (...)'
+        >>> fingerprint("SELECT * FROM foo WHERE id = ANY(ARRAY[%s, %s])")
+        'SELECT * FROM foo WHERE id = ANY(ARRAY[...])'
+        >>> fingerprint('''
+        ...     INSERT INTO foo (id, data)
+        ...     VALUES (%s, %s::jsonb), (%s, %s::jsonb) -- two rows
+        ...     ''')
+        'INSERT INTO foo (id, data) VALUES (...)'
+
+    Identifiers containing digits are kept
+
+        >>> fingerprint("SELECT t1.x FROM t1 LIMIT 10")
+        'SELECT t1.x FROM t1 LIMIT ?'
+    """
+
+
+def doctest_LogHistogram():
+    """
+    Quantiles are accurate within the relative accuracy
+
+        >>> hist = LogHistogram(relative_accuracy=0.01)
+        >>> hist.quantile(0.5) is None
+        True
+        >>> for i in range(1, 1001):
+        ...     hist.add(i / 1000)
+        >>> for q, expected in [(0.5, 0.5), (0.95, 0.95), (0.99, 0.99)]:
+        ...     print(q, abs(hist.quantile(q) - expected) / expected < 0.02)
+        0.5 True
+        0.95 True
+        0.99 True
+
+    Memory is bounded, the lowest buckets are merged
+
+        >>> hist = LogHistogram(relative_accuracy=0.01, max_buckets=10)
+        >>> for i in range(1, 1001):
+        ...     hist.add(i / 1000)
+        >>> len(hist.buckets)
+        10
+        >>> hist.count
+        1000
+        >>> round(hist.quantile(0.99), 2)
+        0.99
+    """
+
+
+def doctest_QueryAggregator():
+    """
+    Queries are aggregated by fingerprint
+
+        >>> qa = QueryAggregator(traceback_sample_rate=1, max_tracebacks=2)
+        >>> qa.record("SELECT * FROM foo WHERE id = 'a'", None, 0.002)
+        >>> qa.record("SELECT * FROM foo WHERE id = 'b'", None, 0.004)
+        >>> qa.record("SELECT * FROM foo WHERE id = 'c'", None, 0.003)
+        >>> qa.record("SELECT 1", [], 0.02)
+
+        >>> stats = qa.stats()
+        >>> [(s.fingerprint, s.count) for s in stats]
+        [('SELECT ?', 1), ('SELECT * FROM foo WHERE id = ?', 3)]
+        >>> foo = stats[1]
+        >>> round(foo.total_time, 4), foo.min_time, foo.max_time
+        (0.009, 0.002, 0.004)
+        >>> round(foo.p50, 4), round(foo.p99, 4)
+        (0.003, 0.004)
+
+    Tracebacks are sampled
+
+        >>> len(foo.tracebacks)
+        2
+        >>> print(foo.tracebacks[0])
+        File ...
+
+    The number of fingerprints is limited
+
+        >>> qa.max_fingerprints = 2
+        >>> qa.record("SELECT 2 FROM bar", [], 0.001)
+        >>> qa.record("SELECT 3 FROM baz", [], 0.001)
+        >>> [(s.fingerprint, s.count) for s in qa.stats()]
+        [('SELECT ?', 1),
+         ('SELECT * FROM foo WHERE id = ?', 3),
+         ('<other>', 2)]
+
+        >>> qa.clear()
+        >>> qa.stats()
+        []
+    """
+
+
+def doctest_QueryAggregator_calc_and_report():
+    """
+    Produce a report of the most expensive statements
+
+        >>> qa = QueryAggregator()
+        >>> print(qa.calc_and_report())
+        Query report: no queries were executed
+
+        >>> qa.record("SELECT * FROM foo WHERE id = 'a'", None, 0.002)
+        >>> qa.record("SELECT * FROM foo WHERE id = 'b'", None, 0.004)
+        >>> qa.record("SELECT 1", [], 0.001)
+        >>> print(qa.calc_and_report())
+        Query report:
+        ------------------------------------------------------------
+        10 most expensive statements:
+        *** SELECT ?
+        ... COUNT: 1
+        ... TIME: 1.0000ms (min 1.0000ms, max 1.0000ms)
+        ... P50: 1.0000ms, P95: 1.0000ms, P99: 1.0000ms
+        <BLANKLINE>
+        *** SELECT * FROM foo WHERE id = ?
+        ... COUNT: 2
+        ... TIME: 6.0000ms (min 2.0000ms, max 4.0000ms)
+        ... P50: 2.0087ms, P95: 3.9651ms, P99: 3.9651ms
+        <BLANKLINE>
+        ------------------------------------------------------------
+        Queries executed: 3
+        Time spent: 7.0000ms
+    """
+
+
+def doctest_format_plan():
+    """
+    Plans are formatted one node per line
+
+        >>> plan = {'Plan': {
+        ...     'Node Type': 'Bitmap Heap Scan', 'Relation Name': 'foo',
+        ...     'Startup Cost': 4.2, 'Total Cost': 9.5, 'Plan Rows': 3,
+        ...     'Plans': [{
+        ...         'Node Type': 'Bitmap Index Scan',
+        ...         'Index Name': 'foo_data_gin',
+        ...         'Startup Cost': 0, 'Total Cost': 4.2, 'Plan Rows': 3}]}}
+        >>> print(format_plan(plan))
+        Bitmap Heap Scan on foo (cost=4.20..9.50 rows=3)
+          Bitmap Index Scan using foo_data_gin (cost=0.00..4.20 rows=3)
+
+    The aggregator keeps the plan of the slowest explained execution
+
+        >>> qa = QueryAggregator()
+        >>> qa.record("SELECT * FROM foo WHERE id = 'a'", None, 0.2, plan=plan)
+        >>> qa.record("SELECT * FROM foo WHERE id = 'b'", None, 0.1,
+        ...           plan={'Plan': {'Node Type': 'Seq Scan'}})
+        >>> print(format_plan(qa.stats()[0].plan))
+        Bitmap Heap Scan on foo (cost=4.20..9.50 rows=3)
+          Bitmap Index Scan using foo_data_gin (cost=0.00..4.20 rows=3)
+    """
+
+
 def test_suite():
     dtsuite = doctest.DocTestSuite(
         optionflags=testing.OPTIONFLAGS)
@@ -194,6 +194,13 @@ def doctest_DBRef():
       >>> dbref1 in [dbref2]
       False
 
+    References are compared by their database, table and id, not by a
+    string built from them:
+
+      >>> serialize.DBRef('table1', '0001', 'db') == serialize.DBRef(
+      ...     'table10', '001', 'db')
+      False
+
     Serialization also works well.
 
       >>> refp = pickle.dumps(dbref1)
@@ -1253,6 +1260,59 @@ def doctest_ObjectReader_get_object_collections_abc_mappingviews_failed():
       >>> testing.tearDownLogging(serialize.LOG)
     """
 
+
+def doctest_ObjectReader_get_object_serializers():
+    """ObjectReader: get_object(): custom serializers
+
+    Serializers with a `py_type` read all states with this `_py_type`,
+    without being asked:
+
+      >>> class Ordinal(serialize.ObjectSerializer):
+      ...     py_type = 'ordinal'
+      ...     def can_read(self, state):
+      ...         raise AssertionError('not asked')
+      ...     def read(self, state):
+      ...         return datetime.date.fromordinal(state['value'])
+
+    Other serializers are asked for every state:
+
+      >>> class Upper(serialize.ObjectSerializer):
+      ...     def can_read(self, state):
+      ...         return isinstance(state, str) and state.isupper()
+      ...     def read(self, state):
+      ...         return state.lower()
+
+      >>> serialize.SERIALIZERS = [Ordinal(), Upper()]
+      >>> reader = serialize.ObjectReader(dm)
+      >>> reader.get_object(['ABC', 'def', {'_py_type': 'ordinal',
+      ...                                   'value': 737425}], None)
+      ['abc', 'def', datetime.date(2020, 1, 1)]
+
+    Registered serializers replace the built-in conversions, the first one
+    wins:
+
+      >>> from pjpersist.serializers import DateTimeSerializer
+      >>> class LocalDateTime(DateTimeSerializer):
+      ...     def read(self, state):
+      ...         return 'local ' + state['value']
+      >>> serialize.SERIALIZERS = [LocalDateTime(), DateTimeSerializer()]
+      >>> reader.get_object({'_py_type': 'datetime.datetime',
+      ...                    'value': '2020-01-02T03:04:05'}, None)
+      'local 2020-01-02T03:04:05'
+
+    Values written by `DateTimeSerializer` are read by it, without the
+    warning about the old format of the built-in conversion:
+
+      >>> import warnings
+      >>> serialize.SERIALIZERS = [DateTimeSerializer()]
+      >>> with warnings.catch_warnings():
+      ...     warnings.simplefilter('error')
+      ...     reader.get_object({'_py_type': 'datetime.datetime',
+      ...                        'value': '2020-01-02T03:04:05'}, None)
+      datetime.datetime(2020, 1, 2, 3, 4, 5)
+      >>> serialize.SERIALIZERS = []
+    """
+
 def doctest_ObjectReader_get_ghost():
     """ObjectReader: get_ghost()
 
@@ -1516,6 +1576,92 @@ def doctest_ObjectWriter_date_short_year():
     """
 
 
+def doctest_ObjectWriter_datetime_timezone():
+    """ObjectWriter/ObjectReader: timezone aware datetimes and times
+
+    The UTC offset is written after the value:
+
+      >>> import datetime
+      >>> tz = datetime.timezone(datetime.timedelta(hours=-5))
+      >>> writer = serialize.ObjectWriter(dm)
+      >>> reader = serialize.ObjectReader(dm)
+      >>> state = writer.get_state(
+      ...     datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=tz))
+      >>> state
+      {'_py_type': 'datetime.datetime',
+       'value': '2020-01-02T03:04:05.000000-05:00'}
+      >>> reader.get_object(state, None)
+      datetime.datetime(2020, 1, 2, 3, 4, 5,
+        tzinfo=datetime.timezone(datetime.timedelta(days=-1, seconds=68400)))
+
+      >>> state = writer.get_state(datetime.time(3, 4, tzinfo=tz))
+      >>> state
+      {'_py_type': 'datetime.time', 'value': '03:04:00.000000-05:00'}
+      >>> reader.get_object(state, None) == datetime.time(3, 4, tzinfo=tz)
+      True
+
+    Values read recently are reused:
+
+      >>> serialize.parse_datetime('2020-01-02T03:04:05.000000') is \\
+      ...     serialize.parse_datetime('2020-01-02T03:04:05.000000')
+      True
+
+    The size of the caches can be changed at any time:
+
+      >>> serialize.set_datetime_cache_size(0)
+      >>> serialize.parse_datetime.cache_info().maxsize
+      0
+      >>> serialize.parse_datetime('2020-01-02T03:04:05.000000') is \\
+      ...     serialize.parse_datetime('2020-01-02T03:04:05.000000')
+      False
+      >>> serialize.set_datetime_cache_size(4096)
+      >>> serialize.DATETIME_CACHE_SIZE
+      4096
+    """
+
+def doctest_ObjectWriter_get_state_dispatch():
+    """ObjectWriter: get_state() finds the conversion of a type once
+
+      >>> serialize.SERIALIZERS = []
+      >>> serialize.WRITE_DISPATCH.reset()
+      >>> writer = serialize.ObjectWriter(dm)
+      >>> import datetime
+      >>> writer.get_state({'date': datetime.date(2020, 1, 2), 'tags': ()})
+      {'date': {'_py_type': 'datetime.date', 'value': '2020-01-02'},
+       'tags': []}
+      >>> handlers = serialize.WRITE_DISPATCH.handlers
+      >>> sorted((cls.__name__, t.__name__) for cls, t in handlers)
+      [('ObjectWriter', 'date'), ('ObjectWriter', 'dict'),
+       ('ObjectWriter', 'tuple')]
+
+    The methods are kept per writer class, so subclasses can override
+    them:
+
+      >>> class DayWriter(serialize.ObjectWriter):
+      ...     def _get_date_state(self, obj, pobj):
+      ...         return {'_py_type': 'day', 'value': obj.toordinal()}
+      >>> DayWriter(dm).get_state(datetime.date(2020, 1, 2))
+      {'_py_type': 'day', 'value': 737426}
+      >>> writer.get_state(datetime.date(2020, 1, 2))
+      {'_py_type': 'datetime.date', 'value': '2020-01-02'}
+
+    Serializers are asked for every object, so they can look at the object
+    itself:
+
+      >>> class EpochSerializer(serialize.ObjectSerializer):
+      ...     def can_write(self, obj):
+      ...         return obj == datetime.date(1970, 1, 1)
+      ...     def write(self, obj):
+      ...         return {'_py_type': 'epoch'}
+      >>> serialize.SERIALIZERS.append(EpochSerializer())
+      >>> writer.get_state(datetime.date(2020, 1, 2))
+      {'_py_type': 'datetime.date', 'value': '2020-01-02'}
+      >>> writer.get_state(datetime.date(1970, 1, 1))
+      {'_py_type': 'epoch'}
+      >>> serialize.WRITE_DISPATCH.handlers is handlers
+      True
+    """
+
 class CustomDict(collections.UserDict, object):
     def __getstate__(self):
         return self.data
@@ -140,6 +140,9 @@ class PJContainer(contained.Contained,
     _pj_id_column = 'id'
     _pj_data_column = 'data'
     _pj_column_fields = (_pj_id_column, _pj_data_column)
+    # Set to a number of rows to stream `raw_find()` results with a server
+    # side cursor instead of reading the whole result at once.
+    _pj_find_itersize = None
 
     def __init__(self, table=None,
                  mapping_key=None, parent_key=None):
@@ -297,6 +300,26 @@ class PJContainer(contained.Contained,
             cache[obj.__name__] = obj
         return obj
 
+    def _stream(self, result):
+        """Load the objects of streamed rows, yielding the rows with them.
+
+        The objects are not added to the container cache, and the documents
+        of the objects already streamed are released as the next row is
+        read, unless the objects were modified. This keeps the caches of the
+        data manager bounded, see `PJDataManager.cacheGC()`.
+        """
+        jar = self._pj_jar
+        obj = None
+        for row in result:
+            if obj is not None:
+                jar._release(obj)
+            obj = self._load_one(
+                row[self._pj_id_column], row[self._pj_data_column],
+                use_cache=False)
+            yield row, obj
+        if obj is not None:
+            jar._release(obj)
+
     def __cmp__(self, other):
         # UserDict implements the semantics of implementing comparison of
         # items to determine equality, which is not what we want for a
@@ -442,6 +465,11 @@ class PJContainer(contained.Contained,
         if self._cache_complete:
             return self._cache.items()
         result = self.raw_find()
+        if self._pj_find_itersize is not None:
+            # Stream the items, keeping all of them around in the container
+            # cache would defeat the purpose.
+            return ((row[self._pj_data_column][self._pj_mapping_key], obj)
+                    for row, obj in self._stream(result))
         items = [(row[self._pj_data_column][self._pj_mapping_key],
                   self._load_one(
                       row[self._pj_id_column], row[self._pj_data_column]))
@@ -492,32 +520,54 @@ class PJContainer(contained.Contained,
         qry = c.convert(spec)
         return qry
 
-    def raw_find(self, qry=None, fields=(), **kwargs):
+    def _get_find_select(self, qry, fields, **kwargs):
         if isinstance(qry, dict):
             qry = self.convert_mongo_query(qry)
         qry = self._combine_filters(self._pj_get_list_filter(), qry)
+        fields = self._get_sb_fields(fields)
+        if qry is None:
+            return sb.Select(fields, **kwargs)
+        return sb.Select(fields, qry, **kwargs)
+
+    def raw_find(self, qry=None, fields=(), itersize=None, **kwargs):
+        select = self._get_find_select(qry, fields, **kwargs)
+        if itersize is None:
+            itersize = self._pj_find_itersize
 
         # returning the cursor instead of fetchall at the cost of not closing it
         # iterating over the cursor is better and this way we expose rowcount
         # and friends
-        cur = self._pj_jar.getCursor()
-        fields = self._get_sb_fields(fields)
-        if qry is None:
-            cur.execute(sb.Select(fields, **kwargs),
-                        flush_hint=[self._pj_table])
-        else:
-            cur.execute(sb.Select(fields, qry, **kwargs),
-                        flush_hint=[self._pj_table])
+        # With `itersize` we use a server side cursor, rows are fetched while
+        # iterating, but rowcount is not known upfront then.
+        cur = self._pj_jar.getCursor(itersize=itersize)
+        cur.execute(select, flush_hint=[self._pj_table])
         return cur
 
-    def find(self, qry=None, **kwargs):
+    def find(self, qry=None, itersize=None, **kwargs):
         # Search for matching objects.
-        result = self.raw_find(qry, **kwargs)
+        if itersize is None:
+            itersize = self._pj_find_itersize
+        result = self.raw_find(qry, itersize=itersize, **kwargs)
+        if itersize is not None:
+            for _, obj in self._stream(result):
+                yield obj
+            return
         for row in result:
             obj = self._load_one(
                 row[self._pj_id_column], row[self._pj_data_column])
             yield obj
 
+    async def afind(self, qry=None, itersize=None, **kwargs):
+        # Search for matching objects with an AsyncPJDataManager.
+        if itersize is None:
+            itersize = self._pj_find_itersize
+        select = self._get_find_select(qry, (), **kwargs)
+        use_cache = itersize is None
+        async for row in self._pj_jar.aiterate(select, itersize=itersize):
+            yield self._load_one(
+                row[self._pj_id_column], row[self._pj_data_column],
+                use_cache=use_cache)
+
     def raw_find_one(self, qry=None, id=None):
         if qry is None and id is None:
             raise ValueError(
@@ -639,6 +689,10 @@ class IdNamesPJContainer(PJContainer):
             return viewitems(self._cache)
         # Load all objects from the database.
         result = self.raw_find()
+        if self._pj_find_itersize is not None:
+            # Stream the items, see `PJContainer.iteritems()`.
+            return ((row[self._pj_id_column], obj)
+                    for row, obj in self._stream(result))
         items = [(row[self._pj_id_column],
                   self._load_one(
                       row[self._pj_id_column], row[self._pj_data_column]))
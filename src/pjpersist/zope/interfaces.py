@@ -62,6 +62,15 @@ class IPJContainer(zope.interface.Interface):
         default=('id', 'data'),
         required=True)
 
+    _pj_find_itersize = zope.schema.Int(
+        title='Find Iteration Size',
+        description=(
+            'When set, `raw_find` and `find` use a server side cursor and '
+            'fetch this many rows at a time, so big results are streamed '
+            'instead of being read into memory at once.'),
+        required=False,
+        default=None)
+
     def _pj_get_parent_key_value():
         """Returns the value that is used to specify a particular container as
         the parent of the item.
@@ -78,24 +87,35 @@ class IPJContainer(zope.interface.Interface):
     def convert_mongo_query(spec):
         """BBB: providing support for mongo style queries"""
 
-    def raw_find(qry, fields=(), **kwargs):
+    def raw_find(qry, fields=(), itersize=None, **kwargs):
         """Return a raw psycopg result cursor for the specified query.
 
         The qry is updated to also contain the container's filter condition.
         ``kwargs`` allows you to pass parameters to sqlbuilder.Select
 
+        With ``itersize`` (or ``_pj_find_itersize``) a server side cursor is
+        returned, fetching ``itersize`` rows at a time while iterating.
+
         Note: The user is responsible of closing the cursor after use.
         """
 
-    def find(qry, **kwargs):
+    def find(qry, itersize=None, **kwargs):
         """Return a Python object result set for the specified query.
 
         The qry is updated to also contain the container's filter condition.
         ``kwargs`` allows you to pass parameters to sqlbuilder.Select
+        ``itersize`` streams the result as in ``raw_find``.
 
         Note: The user is responsible of closing the cursor after use.
         """
 
+    def afind(qry=None, itersize=None, **kwargs):
+        """Asynchronously iterate over the Python objects matching a query.
+
+        Like ``find``, but for containers stored with a
+        ``pjpersist.aio.AsyncPJDataManager``, use it with ``async for``.
+        """
+
     def raw_find_one(qry=None, id=None):
         """Return the record for the specified query.
 
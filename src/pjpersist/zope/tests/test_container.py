@@ -915,6 +915,138 @@ def doctest_PJContainer_find():
       <Person Stephan>
     """
 
+def doctest_PJContainer_find_streaming():
+    r"""PJContainer: find with a server side cursor
+
+      >>> dm.root['people'] = container.PJContainer('person')
+      >>> for name in ('Stephan', 'Roy', 'Roger', 'Adam', 'Albertas'):
+      ...     dm.root['people'][name.lower()] = Person(name)
+
+    With `itersize` the rows are fetched in chunks while iterating:
+
+      >>> res = dm.root['people'].raw_find(
+      ...     orderBy=["(data->'name')"], itersize=2)
+      >>> res.name
+      'pj_cursor_...'
+      >>> res.itersize
+      2
+      >>> [row['data']['name'] for row in res]
+      ['Adam', 'Albertas', 'Roger', 'Roy', 'Stephan']
+
+      >>> res = dm.root['people'].find(orderBy=["(data->'name')"], itersize=2)
+      >>> pprint(list(res))
+      [<Person Adam>,
+       <Person Albertas>,
+       <Person Roger>,
+       <Person Roy>,
+       <Person Stephan>]
+
+    Streamed objects are not added to the container cache:
+
+      >>> dm.root['people']._cache_complete
+      False
+
+    Streaming can be turned on for all queries of a container:
+
+      >>> transaction.commit()
+      >>> people = dm.root['people']
+      >>> people._pj_find_itersize = 2
+      >>> sorted(people.keys())
+      ['adam', 'albertas', 'roger', 'roy', 'stephan']
+      >>> items = people.iteritems()
+      >>> next(items)
+      ('stephan', <Person Stephan>)
+      >>> people._cache_complete
+      False
+
+    The documents of the objects already streamed are released, so the
+    caches of the data manager stay bounded:
+
+      >>> transaction.commit()
+      >>> people = dm.root['people']
+      >>> sizes = []
+      >>> for person in people.find(itersize=2):
+      ...     sizes.append((len(dm._latest_states), len(dm._object_cache)))
+      >>> sizes
+      [(2, 2), (2, 2), (2, 2), (2, 2), (2, 2)]
+      >>> len(dm._latest_states), len(dm._object_cache)
+      (1, 1)
+
+    Modified objects are kept:
+
+      >>> for name, person in people.iteritems():
+      ...     if name == 'roy':
+      ...         person.name = 'Roy Mustang'
+      >>> len(dm._latest_states), len(dm._object_cache)
+      (2, 2)
+      >>> transaction.commit()
+      >>> dm.root['people']['roy']
+      <Person Roy Mustang>
+
+    Tables are still created on the fly:
+
+      >>> transaction.commit()
+      >>> dm.root['things'] = container.PJContainer('things')
+      >>> list(dm.root['things'].find(itersize=2))
+      []
+    """
+
+
+def doctest_IdNamesPJContainer_streaming():
+    r"""IdNamesPJContainer: items are streamed with `_pj_find_itersize`
+
+      >>> dm.root['people'] = container.IdNamesPJContainer('person')
+      >>> for name in ('Stephan', 'Roy', 'Roger'):
+      ...     dm.root['people'][name.lower()] = Person(name)
+      >>> transaction.commit()
+
+      >>> people = dm.root['people']
+      >>> people._pj_find_itersize = 2
+      >>> sizes = []
+      >>> items = []
+      >>> for id, person in people.iteritems():
+      ...     sizes.append((len(dm._latest_states), len(dm._object_cache)))
+      ...     items.append((id, person.name))
+      >>> sorted(items)
+      [('roger', 'Roger'), ('roy', 'Roy'), ('stephan', 'Stephan')]
+      >>> sizes
+      [(2, 2), (2, 2), (2, 2)]
+      >>> people._cache_complete
+      False
+    """
+
+
+def doctest_PJContainer_afind():
+    r"""PJContainer: find with an asyncio data manager
+
+      >>> dm.root['people'] = container.PJContainer('person')
+      >>> for name in ('Stephan', 'Roy', 'Roger'):
+      ...     dm.root['people'][name.lower()] = Person(name)
+      >>> people_ref = dm.root['people']._p_oid
+      >>> transaction.commit()
+
+    Containers loaded by an `AsyncPJDataManager` are searched with `async
+    for`:
+
+      >>> import asyncio
+      >>> from pjpersist import aio
+      >>> async def find(**kwargs):
+      ...     adm = aio.AsyncPJDataManager(
+      ...         await testing.getAsyncConnection(testing.DBNAME))
+      ...     try:
+      ...         people = await adm.aload(people_ref)
+      ...         return [person async for person in people.afind(
+      ...             orderBy=["(data->'name')"], **kwargs)]
+      ...     finally:
+      ...         await adm.aclose()
+
+      >>> pprint(asyncio.run(find()))
+      [<Person Roger>, <Person Roy>, <Person Stephan>]
+      >>> pprint(asyncio.run(find(itersize=2)))
+      [<Person Roger>, <Person Roy>, <Person Stephan>]
+    """
+
+
 def doctest_PJ_Container_count():
   """
   count() provides a quick way to count items without fetching them from database